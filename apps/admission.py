@@ -0,0 +1,158 @@
+# admission.py
+"""
+Admission control for LLM calls and command subprocesses.
+
+Each resource is a gate: a concurrency limit plus a bounded FIFO wait queue.
+A caller that cannot get a slot waits in line (and is told its position);
+when the line itself is full it is rejected straight away with
+AdmissionRejected so the user gets a fast "busy" reply instead of piling
+more load onto the provider or the pod.
+
+LLM calls pass two gates: the global LLM_MAX_CONCURRENCY gate, then the
+provider's LLM_MAX_CONCURRENCY_<PROVIDER> gate (OPENAI, CLAUDE, GEMINI,
+BEDROCK; 0 = only the global limit applies).
+
+A gate only queues when more job workers than its limit want in at once, so
+both limits stay below JOB_WORKERS (16 by default).
+"""
+import os
+import time
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", 8))
+COMMAND_MAX_CONCURRENCY = int(os.getenv("COMMAND_MAX_CONCURRENCY", 4))
+ADMISSION_MAX_WAITERS = int(os.getenv("ADMISSION_MAX_WAITERS", 32))
+ADMISSION_WAIT_TIMEOUT = float(os.getenv("ADMISSION_WAIT_TIMEOUT", 120))
+
+# Callback(position) for the current event, told when it has to wait in line
+_queued_notifier = contextvars.ContextVar("admission_queued_notifier", default=None)
+
+
+class AdmissionRejected(Exception):
+    """Raised when a gate's wait queue is full or the wait timed out."""
+
+    def __init__(self, resource, message):
+        super().__init__(message)
+        self.resource = resource
+
+
+class Gate:
+    """Counting semaphore with a bounded FIFO wait queue."""
+
+    def __init__(self, name, limit, max_waiters=ADMISSION_MAX_WAITERS):
+        self.name = name
+        self.limit = int(limit)
+        self.max_waiters = int(max_waiters)
+        self._in_use = 0
+        self._waiters = deque()
+        self._cond = threading.Condition()
+        self._counters = {"admitted": 0, "queued": 0, "rejected": 0, "timed_out": 0}
+
+    def acquire(self, timeout=ADMISSION_WAIT_TIMEOUT, on_queued=None):
+        if self.limit <= 0:
+            return
+        with self._cond:
+            if self._in_use < self.limit and not self._waiters:
+                self._in_use += 1
+                self._counters["admitted"] += 1
+                return
+            if len(self._waiters) >= self.max_waiters:
+                self._counters["rejected"] += 1
+                raise AdmissionRejected(self.name, f"{self.name} is busy ({self.limit} running, {len(self._waiters)} waiting)")
+            ticket = object()
+            self._waiters.append(ticket)
+            self._counters["queued"] += 1
+            position = len(self._waiters)
+        if on_queued:
+            on_queued(position)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not (self._waiters[0] is ticket and self._in_use < self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._waiters.remove(ticket)
+                    self._counters["timed_out"] += 1
+                    self._cond.notify_all()
+                    raise AdmissionRejected(self.name, f"Timed out after {timeout:.0f}s waiting for {self.name}")
+                self._cond.wait(remaining)
+            self._waiters.popleft()
+            self._in_use += 1
+            self._counters["admitted"] += 1
+            self._cond.notify_all()
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {"limit": self.limit, "in_use": self._in_use, "waiting": len(self._waiters), **self._counters}
+
+
+_gates = {}
+_gates_lock = threading.Lock()
+
+
+def _gate(name, limit):
+    with _gates_lock:
+        gate = _gates.get(name)
+        if gate is None:
+            gate = _gates[name] = Gate(name, limit)
+        return gate
+
+
+@contextmanager
+def _hold(gates, logger=None):
+    notify = _queued_notifier.get()
+    held = []
+
+    def on_queued(position):
+        if logger:
+            logger.info("Waiting for %s, queued at position %d", gates[len(held)].name, position)
+        if notify:
+            notify(position)
+
+    try:
+        for gate in gates:
+            gate.acquire(on_queued=on_queued)
+            held.append(gate)
+        yield
+    finally:
+        for gate in reversed(held):
+            gate.release()
+
+
+def llm_slot(provider, logger=None):
+    """Context manager holding a global and a per-provider LLM slot."""
+    provider = provider.upper()
+    return _hold([
+        _gate("llm", LLM_MAX_CONCURRENCY),
+        _gate(f"llm:{provider.lower()}", int(os.getenv(f"LLM_MAX_CONCURRENCY_{provider}", 0))),
+    ], logger)
+
+
+def command_slot(logger=None):
+    """Context manager holding a command subprocess slot."""
+    return _hold([_gate("command", COMMAND_MAX_CONCURRENCY)], logger)
+
+
+@contextmanager
+def admission_notifier(callback):
+    """Call callback(position) whenever the current event has to queue for a slot."""
+    token = _queued_notifier.set(callback)
+    try:
+        yield
+    finally:
+        _queued_notifier.reset(token)
+
+
+def admission_stats():
+    with _gates_lock:
+        gates = list(_gates.values())
+    return {gate.name: gate.stats() for gate in gates}
@@ -0,0 +1,122 @@
+# agent_loop.py
+"""
+Bounded AUTO_RUN loop.
+
+With AUTO_RUN=true the assistant's recommended command is executed, its
+output is fed back to the LLM, and the next recommendation is executed in
+turn. The loop stops when the assistant stops recommending commands or when
+one of the limits is hit: AGENT_MAX_STEPS commands, AGENT_DEADLINE_SECONDS of
+wall-clock time, or AGENT_TOKEN_BUDGET estimated prompt+completion tokens.
+
+Thread history is loaded once and kept in memory between steps. New
+messages go to the event's conversation context, which is flushed to storage
+before the first step and after every step.
+"""
+import os
+import time
+
+from generic_storage import update_message, get_thread_messages
+from execute_run_command import execute_run_command
+from send_response import send_response
+from stream_reply import llm_reply
+from count_tokens import estimate_tokens
+from conversation_context import flush_context
+
+AGENT_MAX_STEPS = int(os.getenv("AGENT_MAX_STEPS", 5))
+AGENT_DEADLINE_SECONDS = float(os.getenv("AGENT_DEADLINE_SECONDS", 300))
+AGENT_TOKEN_BUDGET = int(os.getenv("AGENT_TOKEN_BUDGET", 60000))
+
+COMMAND_OUTPUT_HANDLER_TEXT = "Be brief. Less than 75 words. Analyze this command output, if there are errors, try to fix them. Use the command with --help to get more info to fix the errors, example: ```argocd app manifests --help```. Recommend a new command if you can fix the errors, otherwise ask user for help. Summarize with a focus on which Problem Resources are not in Synced or Healthy state. We will later investigate those manifests of Problem Resources. Offer command options too"
+
+
+def extract_command(content):
+    """Return the command in the first fenced code block of content, or None."""
+    lines = (content or "").splitlines()
+    for idx, line in enumerate(lines):
+        stripped = line.strip()
+
+        if stripped.startswith("```"):
+            if stripped.startswith("```yaml"):
+                continue
+            # Case 1: backticks and command on the same line
+            if stripped.startswith("```bash"):
+                if len(stripped) > 7:
+                    return stripped[7:].strip("` ").strip()
+            if len(stripped) > 3:
+                return stripped[3:].strip("` ").strip()
+
+            # Case 2: command is on the next line, closed by ``` on the line after
+            if idx + 1 < len(lines):
+                command_candidate = lines[idx + 1].strip()
+                if idx + 2 < len(lines) and lines[idx + 2].strip().startswith("```"):
+                    return command_candidate
+    return None
+
+
+def run_agent_loop(payload, thread_ts, logger, max_response_tokens, temperature,
+                   max_steps=None, deadline_seconds=None, token_budget=None):
+    """
+    Execute the assistant's recommended commands until it stops recommending
+    one or a limit is reached. The last assistant message in the thread must
+    not have been sent to the user yet. Returns a summary dict.
+    """
+    max_steps = AGENT_MAX_STEPS if max_steps is None else max_steps
+    deadline_seconds = AGENT_DEADLINE_SECONDS if deadline_seconds is None else deadline_seconds
+    token_budget = AGENT_TOKEN_BUDGET if token_budget is None else token_budget
+
+    started = time.monotonic()
+    history = list(get_thread_messages(thread_ts, logger=logger) or [])
+    history_tokens = estimate_tokens(history)
+    tokens_used = 0
+    steps = 0
+    last_sent = False
+    stop_reason = "max_steps"
+
+    # The reply that started the loop is visible before the first command runs
+    flush_context(thread_ts)
+    while steps < max_steps:
+        last = history[-1] if history else {}
+        command = extract_command(last.get("content")) if last.get("role") == "assistant" else None
+        if not command:
+            stop_reason = "no_command"
+            break
+        if time.monotonic() - started >= deadline_seconds:
+            stop_reason = "deadline"
+            break
+        if tokens_used >= token_budget:
+            stop_reason = "token_budget"
+            break
+
+        steps += 1
+        logger.info("Agent loop step %d/%d for thread %s: %s", steps, max_steps, thread_ts, command)
+        output = execute_run_command(command, logger=logger)
+        tool_text = f"TOOL Command: {command}\nCommand Output:\n{output['stdout']}\nCommand Error:\n{output['stderr']}\nReturn Code:\n{output['returncode']}"
+        history_tokens += _append(history, thread_ts, "user", COMMAND_OUTPUT_HANDLER_TEXT + "\n" + tool_text, logger)
+
+        response = llm_reply(payload, thread_ts, logger, max_response_tokens, temperature, messages=history)
+        last_sent = True
+        tokens_used += history_tokens
+        reply_tokens = _append(history, thread_ts, "assistant", response, logger)
+        history_tokens += reply_tokens
+        tokens_used += reply_tokens
+        flush_context(thread_ts)
+
+    if not last_sent and history and history[-1].get("role") == "assistant":
+        send_response(payload, thread_ts, "NAUT " + (history[-1].get("content") or ""), logger)
+    if stop_reason == "no_command":
+        send_response(payload, thread_ts, "NAUT AI resolved the issue or further user input needed, type just HELP, all caps, for more options", logger)
+    else:
+        send_response(payload, thread_ts, f"NAUT Auto-run stopped after {steps} step(s) ({stop_reason.replace('_', ' ')}). Type RUN all caps to run the last suggested command", logger)
+
+    elapsed = time.monotonic() - started
+    logger.info("Agent loop for thread %s finished: steps=%d reason=%s tokens=%d elapsed=%.1fs",
+                thread_ts, steps, stop_reason, tokens_used, elapsed)
+    return {"steps": steps, "stop_reason": stop_reason, "tokens_used": tokens_used, "elapsed": round(elapsed, 3)}
+
+
+def _append(history, thread_ts, role, content, logger):
+    """Append one message to the in-memory history and storage; return its token estimate."""
+    message = {"role": role, "content": content}
+    history.append(message)
+    update_message(thread_ts, role, content, logger=logger)
+    return estimate_tokens([message])
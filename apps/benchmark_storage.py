@@ -0,0 +1,326 @@
+# benchmark_storage.py
+"""
+Benchmark suite for the storage backends in generic_storage.
+
+For every backend (file_storage, elasticsearch, elasticsearch_messages,
+sqlite), every thread length in --lengths and every message size in
+--sizes it builds a fresh thread and measures:
+
+  bulk_append  building the thread in batches (messages/s, MB/s)
+  full_read    reading the whole thread
+  tail_read    reading its last --tail messages
+  append       appending one message to it
+
+and then, per entry of --writers, the throughput of that many concurrent
+writer threads appending single messages for --duration seconds, each to
+its own thread ("distinct") and all to one thread ("shared").
+
+Latencies are reported as mean / p50 / p95 / p99 / max in milliseconds.
+Full reads of big threads are taken fewer times (down to one) so that each
+thread is read about --read-bytes in total. Combinations larger than
+--max-thread-bytes (1 GiB: every size up to 1,000 messages of 1 MB) are
+listed as skipped, and a backend that can't be reached is listed with its error. The results, with
+the storage settings they were taken under, are written as JSON to
+--output (default stdout). With --baseline, results whose p50 latency or
+throughput is more than --tolerance worse than the baseline file's are
+reported as regressions and the exit status is 1.
+
+The benchmark writes to the configured FS_INDEX, SQLITE_PATH and
+Elasticsearch indices, using thread ids starting with "bench-", and
+deletes its threads afterwards (--keep leaves them). Point those settings
+at scratch locations when benchmarking on a live pod.
+
+Example:
+    python benchmark_storage.py --backends file_storage,sqlite --output bench.json
+    python benchmark_storage.py --baseline bench.json --tolerance 0.25
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import string
+import socket
+import logging
+import argparse
+import platform
+import threading
+from datetime import datetime, timezone
+
+import generic_storage
+import file_storage
+import sqlite_storage
+import elastic_messages
+
+BENCH_LENGTHS = os.getenv("BENCH_LENGTHS", "10,100,1000,10000")
+BENCH_SIZES = os.getenv("BENCH_SIZES", "100,1024,16384,1048576")
+BENCH_WRITERS = os.getenv("BENCH_WRITERS", "1,4,16")
+BENCH_SAMPLES = int(os.getenv("BENCH_SAMPLES", 50))
+BENCH_READ_SAMPLES = int(os.getenv("BENCH_READ_SAMPLES", 10))
+BENCH_TAIL = int(os.getenv("BENCH_TAIL", 20))
+BENCH_DURATION = float(os.getenv("BENCH_DURATION", 5))
+BENCH_THROUGHPUT_SIZE = int(os.getenv("BENCH_THROUGHPUT_SIZE", 1024))
+# Threads bigger than this (length x size) are skipped
+BENCH_MAX_THREAD_BYTES = int(os.getenv("BENCH_MAX_THREAD_BYTES", 1024 * 1024 * 1024))
+# Full reads of one thread stop after this many bytes (but at least one is taken)
+BENCH_READ_BYTES = int(os.getenv("BENCH_READ_BYTES", 256 * 1024 * 1024))
+# Messages per append while building a thread, also capped at 8 MiB per append
+BENCH_PREFILL_BATCH = int(os.getenv("BENCH_PREFILL_BATCH", 500))
+
+# Compared against a baseline: lower is better for latencies, higher for throughput
+_LATENCY_KEY = "p50_ms"
+_THROUGHPUT_KEY = "messages_per_s"
+
+_payloads = {}
+
+
+def _int_list(text):
+    return [int(value) for value in str(text).split(",") if value.strip()]
+
+
+def _payload(size):
+    if size not in _payloads:
+        _payloads[size] = "".join(random.choices(string.ascii_letters + string.digits + " ", k=size))
+    return _payloads[size]
+
+
+def _messages(start, count, size):
+    """count messages of size characters, numbered from start so no two are identical."""
+    body = _payload(size)
+    return [{"role": "user" if (start + i) % 2 else "assistant",
+             "content": (f"{start + i:08d} " + body)[:size]} for i in range(count)]
+
+
+def _append(backend, thread_ts, messages):
+    generic_storage.apply_write(backend, "append", thread_ts, {"messages": messages})
+
+
+def latency_summary(latencies):
+    """mean / p50 / p95 / p99 / max, in milliseconds, of latencies given in seconds."""
+    if not latencies:
+        return {"samples": 0}
+    ordered = sorted(latencies)
+
+    def percentile(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))] * 1000
+
+    return {"samples": len(ordered), "mean_ms": sum(ordered) / len(ordered) * 1000,
+            "p50_ms": percentile(0.50), "p95_ms": percentile(0.95), "p99_ms": percentile(0.99),
+            "max_ms": ordered[-1] * 1000}
+
+
+def _timed(fn, samples):
+    latencies = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latency_summary(latencies)
+
+
+def _prefill(backend, thread_ts, length, size):
+    batch = max(1, min(BENCH_PREFILL_BATCH, 8 * 1024 * 1024 // max(size, 1)))
+    start = time.perf_counter()
+    for first in range(0, length, batch):
+        _append(backend, thread_ts, _messages(first, min(batch, length - first), size))
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "messages_per_s": length / elapsed if elapsed else None,
+            "mb_per_s": length * size / elapsed / 1e6 if elapsed else None}
+
+
+def bench_thread(backend, thread_ts, length, size, samples, read_samples, tail, read_bytes=BENCH_READ_BYTES):
+    """Build one thread of length messages of size bytes and time reads and appends on it."""
+    case = {"backend": backend, "messages": length, "message_bytes": size}
+    results = [dict(case, test="bulk_append", **_prefill(backend, thread_ts, length, size))]
+    read_samples = max(1, min(read_samples, read_bytes // max(length * size, 1)))
+    # Reads first, so they see exactly length messages
+    results.append(dict(case, test="full_read", **_timed(
+        lambda: generic_storage.read_messages_on(backend, thread_ts), read_samples)))
+    after_seq = length - tail - 1 if length > tail else None
+    results.append(dict(case, test="tail_read", tail=tail, **_timed(
+        lambda: generic_storage.read_messages_on(backend, thread_ts, after_seq, tail), samples)))
+    seq = iter(range(length, length + samples))
+    results.append(dict(case, test="append", **_timed(
+        lambda: _append(backend, thread_ts, _messages(next(seq), 1, size)), samples)))
+    return results
+
+
+def bench_throughput(backend, thread_ids, size, duration):
+    """
+    One writer thread per entry of thread_ids appending single messages for
+    duration seconds (the same id repeated means a shared thread).
+    """
+    writers = len(thread_ids)
+    latencies = [[] for _ in range(writers)]
+    errors = []
+    ready = threading.Barrier(writers + 1)
+    deadline = [0.0]
+
+    def writer(n, thread_ts):
+        ready.wait()
+        i = 0
+        try:
+            while time.perf_counter() < deadline[0]:
+                message = _messages(n * 1_000_000 + i, 1, size)
+                start = time.perf_counter()
+                _append(backend, thread_ts, message)
+                latencies[n].append(time.perf_counter() - start)
+                i += 1
+        except Exception as e:
+            errors.append(str(e))
+
+    threads = [threading.Thread(target=writer, args=(n, thread_ts), daemon=True)
+               for n, thread_ts in enumerate(thread_ids)]
+    for thread in threads:
+        thread.start()
+    start = time.perf_counter()
+    deadline[0] = start + duration
+    ready.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    messages = sum(len(samples) for samples in latencies)
+    result = {"backend": backend, "test": "throughput", "writers": writers,
+              "mode": "shared" if len(set(thread_ids)) == 1 and writers > 1 else "distinct",
+              "message_bytes": size, "seconds": elapsed, "messages": messages,
+              "messages_per_s": messages / elapsed, "mb_per_s": messages * size / elapsed / 1e6,
+              **latency_summary([latency for samples in latencies for latency in samples])}
+    if errors:
+        result["errors"] = errors[:5]
+    return result
+
+
+def bench_backend(backend, lengths, sizes, writers, samples=BENCH_SAMPLES, read_samples=BENCH_READ_SAMPLES,
+                  tail=BENCH_TAIL, duration=BENCH_DURATION, throughput_size=BENCH_THROUGHPUT_SIZE,
+                  max_thread_bytes=BENCH_MAX_THREAD_BYTES, read_bytes=BENCH_READ_BYTES, run_id=None, keep=False,
+                  logger=None):
+    """Every benchmark for one backend. Returns a list of result records."""
+    run_id = run_id or uuid.uuid4().hex[:8]
+    generic_storage.ensure_index_exists_on(backend, logger)
+    results, created = [], []
+    try:
+        for length in lengths:
+            for size in sizes:
+                if length * size > max_thread_bytes:
+                    results.append({"backend": backend, "messages": length, "message_bytes": size,
+                                    "skipped": f"larger than --max-thread-bytes {max_thread_bytes}"})
+                    continue
+                thread_ts = f"bench-{run_id}-{length}-{size}"
+                created.append(thread_ts)
+                if logger:
+                    logger.info(f"{backend}: {length} message(s) of {size} bytes")
+                results.extend(bench_thread(backend, thread_ts, length, size, samples, read_samples, tail,
+                                            read_bytes))
+        for count in writers:
+            distinct = [f"bench-{run_id}-w{count}-{n}" for n in range(count)]
+            shared = [f"bench-{run_id}-w{count}-shared"] * count
+            for thread_ids in ([distinct, shared] if count > 1 else [distinct]):
+                created.extend(sorted(set(thread_ids)))
+                if logger:
+                    logger.info(f"{backend}: {count} concurrent writer(s) for {duration}s")
+                results.append(bench_throughput(backend, thread_ids, throughput_size, duration))
+    finally:
+        if created and not keep:
+            generic_storage.delete_threads_on(backend, created, logger)
+    return results
+
+
+def _settings():
+    return {"FS_INDEX": file_storage.FS_INDEX, "FS_LAYOUT": file_storage.FS_LAYOUT, "FS_FSYNC": file_storage.FS_FSYNC,
+            "SQLITE_PATH": sqlite_storage.SQLITE_PATH, "SQLITE_SYNCHRONOUS": sqlite_storage.SQLITE_SYNCHRONOUS,
+            "es_index": os.getenv("es_index"), "ES_MESSAGES_REFRESH": elastic_messages.ES_MESSAGES_REFRESH}
+
+
+def _key(result):
+    return tuple(result.get(field) for field in ("backend", "test", "messages", "message_bytes", "writers", "mode"))
+
+
+def compare(results, baseline, tolerance):
+    """Results more than tolerance (a fraction) slower than the matching baseline result."""
+    previous = {_key(result): result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(_key(result))
+        if not before:
+            continue
+        if result.get("test") in ("throughput", "bulk_append"):
+            key, worse = _THROUGHPUT_KEY, lambda new, old: new < old * (1 - tolerance)
+        else:
+            key, worse = _LATENCY_KEY, lambda new, old: new > old * (1 + tolerance)
+        if result.get(key) is not None and before.get(key) and worse(result[key], before[key]):
+            regressions.append({"key": dict(zip(("backend", "test", "messages", "message_bytes", "writers", "mode"),
+                                                _key(result))),
+                                "metric": key, "baseline": before[key], "current": result[key]})
+    return regressions
+
+
+def run(backends, lengths, sizes, writers, logger=None, **options):
+    """Benchmark every backend; returns the JSON-ready report."""
+    run_id = uuid.uuid4().hex[:8]
+    report = {"run_id": run_id, "started_at": datetime.now(timezone.utc).isoformat(),
+              "host": socket.gethostname(), "python": platform.python_version(),
+              "settings": _settings(), "results": []}
+    for backend in backends:
+        try:
+            report["results"].extend(bench_backend(backend, lengths, sizes, writers, run_id=run_id,
+                                                   logger=logger, **options))
+        except Exception as e:
+            if logger:
+                logger.exception(f"Benchmark of {backend} failed: {e}")
+            report["results"].append({"backend": backend, "error": str(e)})
+    report["finished_at"] = datetime.now(timezone.utc).isoformat()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the conversation storage backends")
+    parser.add_argument("--backends", default=",".join(generic_storage.BACKENDS),
+                        help="comma-separated backends (default: all)")
+    parser.add_argument("--lengths", default=BENCH_LENGTHS, help="thread lengths, comma-separated")
+    parser.add_argument("--sizes", default=BENCH_SIZES, help="message sizes in bytes, comma-separated")
+    parser.add_argument("--writers", default=BENCH_WRITERS, help="concurrent writer counts, comma-separated")
+    parser.add_argument("--samples", type=int, default=BENCH_SAMPLES, help="timed appends and tail reads per thread")
+    parser.add_argument("--read-samples", type=int, default=BENCH_READ_SAMPLES, help="timed full reads per thread")
+    parser.add_argument("--read-bytes", type=int, default=BENCH_READ_BYTES,
+                        help="fewer full reads of threads bigger than this / --read-samples")
+    parser.add_argument("--tail", type=int, default=BENCH_TAIL, help="messages per tail read")
+    parser.add_argument("--duration", type=float, default=BENCH_DURATION, help="seconds per throughput run")
+    parser.add_argument("--throughput-size", type=int, default=BENCH_THROUGHPUT_SIZE,
+                        help="message size for the throughput runs")
+    parser.add_argument("--max-thread-bytes", type=int, default=BENCH_MAX_THREAD_BYTES)
+    parser.add_argument("--keep", action="store_true", help="leave the benchmark threads in place")
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    parser.add_argument("--baseline", help="earlier JSON report to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("BenchmarkStorage")
+    backends = [backend for backend in args.backends.split(",") if backend]
+    unknown = set(backends) - set(generic_storage.BACKENDS)
+    if unknown:
+        parser.error(f"unknown backend(s): {', '.join(sorted(unknown))}")
+
+    report = run(backends, _int_list(args.lengths), _int_list(args.sizes), _int_list(args.writers), logger,
+                 samples=args.samples, read_samples=args.read_samples, tail=args.tail, duration=args.duration,
+                 throughput_size=args.throughput_size, max_thread_bytes=args.max_thread_bytes,
+                 read_bytes=args.read_bytes, keep=args.keep)
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            report["regressions"] = compare(report["results"], json.load(f)["results"], args.tolerance)
+        for regression in report["regressions"]:
+            logger.warning(f"Regression: {regression}")
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if report.get("regressions"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,260 @@
+# blob_store.py
+"""
+Content-addressed store for large command outputs.
+
+RUN and TOOL turns used to keep the full stdout/stderr of commands such as
+`argocd app manifests` inline in the message, so one thread could carry
+megabytes of the same YAML over and over. generic_storage now passes every
+new message through externalize(): each "Command Output:" / "Command Error:"
+section of at least BLOB_MIN_BYTES is written once to BLOB_STORE_PATH as a
+zlib-compressed file named by its SHA-256, and the message keeps a short
+reference in its place:
+
+    [argonaut-blob sha256=<hex> bytes=<size>]
+
+Identical outputs share one blob. BLOB_STORE_PATH defaults to the volume at
+DATA_DIR, which every pod mounts, so any pod can resolve any reference; a
+blob is fsynced before put() returns its reference, so a stored message
+never points at a blob lost in a crash. References are resolved only where the
+text is needed: the LLM context (only the messages in the summary view) and
+GET /threads with ?resolve=true; GET /blobs/<sha256> serves a single blob.
+
+Blobs are shared, so deleting a thread leaves its blobs behind.
+collect_garbage() removes the blobs no stored message references, once
+they are older than BLOB_GC_GRACE_SECONDS; the grace period covers a
+blob whose reference is still on its way to storage. retention runs it
+after every sweep that deletes threads.
+"""
+import os
+import re
+import zlib
+import hashlib
+import time
+import threading
+from collections import OrderedDict
+
+from data_dir import DATA_DIR
+
+BLOB_STORE_PATH = os.getenv("BLOB_STORE_PATH", os.path.join(DATA_DIR, "blob_store"))
+# Sections smaller than this stay inline (0 disables the blob store)
+BLOB_MIN_BYTES = int(os.getenv("BLOB_MIN_BYTES", 4096))
+BLOB_COMPRESSION_LEVEL = int(os.getenv("BLOB_COMPRESSION_LEVEL", 6))
+# Decompressed blobs kept in memory per process, LRU, bounded by their size (0 = no cache)
+BLOB_CACHE_BYTES = int(os.getenv("BLOB_CACHE_BYTES", 16 * 1024 * 1024))
+BLOB_GC_GRACE_SECONDS = float(os.getenv("BLOB_GC_GRACE_SECONDS", 24 * 3600))
+
+DIGEST_RE = re.compile(r"[0-9a-f]{64}")
+REFERENCE_RE = re.compile(r"\[argonaut-blob sha256=([0-9a-f]{64}) bytes=(\d+)\]")
+# The sections written by the RUN handler, the agent loop and the command runner
+_SECTION_RE = re.compile(r"(Command (?:Output|Error):\n)(.*?)(?=\nCommand Error:\n|\nReturn Code:\n|\Z)", re.S)
+
+_stats = {"stored": 0, "deduplicated": 0, "stored_bytes": 0, "resolved": 0, "missing": 0,
+          "collected": 0, "collected_bytes": 0}
+_stats_lock = threading.Lock()
+
+_cache = OrderedDict()
+_cache_bytes = 0
+_cache_lock = threading.Lock()
+_cache_counters = {"cache_hits": 0, "cache_misses": 0, "cache_evictions": 0}
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+def _blob_path(digest):
+    # Shard by the first two hex digits so no directory grows past a few thousand files
+    return os.path.join(BLOB_STORE_PATH, digest[:2], digest + ".z")
+
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def reference(digest, size):
+    return f"[argonaut-blob sha256={digest} bytes={size}]"
+
+
+def put(text):
+    """Store text (once per distinct content) and return its reference."""
+    data = text.encode("utf-8")
+    digest = hashlib.sha256(data).hexdigest()
+    path = _blob_path(digest)
+    if os.path.exists(path):
+        try:
+            # A fresh mtime puts the blob back inside collect_garbage()'s grace period
+            os.utime(path)
+        except FileNotFoundError:
+            return put(text)
+        _count("deduplicated")
+        return reference(digest, len(data))
+    shard = os.path.dirname(path)
+    if not os.path.isdir(shard):
+        os.makedirs(shard, exist_ok=True)
+        _fsync_dir(BLOB_STORE_PATH)
+    compressed = zlib.compress(data, BLOB_COMPRESSION_LEVEL)
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(compressed)
+        f.flush()
+        os.fsync(f.fileno())
+    # Same name for the same content, so a concurrent writer of the same blob is harmless
+    os.replace(tmp_path, path)
+    # The reference goes into a message after this returns; the blob must outlive a crash first
+    _fsync_dir(shard)
+    _count("stored")
+    _count("stored_bytes", len(compressed))
+    return reference(digest, len(data))
+
+
+def _cache_get(digest):
+    with _cache_lock:
+        text = _cache.get(digest)
+        if text is None:
+            _cache_counters["cache_misses"] += 1
+            return None
+        _cache.move_to_end(digest)
+        _cache_counters["cache_hits"] += 1
+        return text
+
+
+def _cache_put(digest, text):
+    global _cache_bytes
+    if len(text) > BLOB_CACHE_BYTES:
+        return
+    with _cache_lock:
+        if digest in _cache:
+            return
+        _cache[digest] = text
+        _cache_bytes += len(text)
+        while _cache_bytes > BLOB_CACHE_BYTES:
+            _, evicted = _cache.popitem(last=False)
+            _cache_bytes -= len(evicted)
+            _cache_counters["cache_evictions"] += 1
+
+
+def get(digest):
+    """The text stored under digest, or None if there is no such blob."""
+    text = _cache_get(digest)
+    if text is not None:
+        return text
+    try:
+        with open(_blob_path(digest), "rb") as f:
+            text = zlib.decompress(f.read()).decode("utf-8")
+    except FileNotFoundError:
+        return None
+    _cache_put(digest, text)
+    return text
+
+
+def exists(digest):
+    return os.path.exists(_blob_path(digest))
+
+
+def references(content):
+    """The digests referenced by content."""
+    if not isinstance(content, str) or "[argonaut-blob " not in content:
+        return set()
+    return {match.group(1) for match in REFERENCE_RE.finditer(content)}
+
+
+def collect_garbage(referenced, grace_seconds=None, dry_run=False, logger=None):
+    """
+    Delete every blob whose digest is not in referenced and that is older
+    than grace_seconds (BLOB_GC_GRACE_SECONDS), plus temp files left by
+    crashed writers. Returns {"collected", "collected_bytes", "kept"}.
+    """
+    global _cache_bytes
+    grace_seconds = BLOB_GC_GRACE_SECONDS if grace_seconds is None else grace_seconds
+    cutoff = time.time() - grace_seconds
+    collected = collected_bytes = kept = 0
+    if not os.path.isdir(BLOB_STORE_PATH):
+        return {"collected": 0, "collected_bytes": 0, "kept": 0}
+    for shard in os.scandir(BLOB_STORE_PATH):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            digest = entry.name[:-len(".z")] if entry.name.endswith(".z") else None
+            stale_tmp = ".tmp." in entry.name
+            if not stale_tmp and (digest is None or not DIGEST_RE.fullmatch(digest)):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if stat.st_mtime >= cutoff or (not stale_tmp and digest in referenced):
+                kept += not stale_tmp
+                continue
+            if not dry_run:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                if digest:
+                    with _cache_lock:
+                        text = _cache.pop(digest, None)
+                        if text is not None:
+                            _cache_bytes -= len(text)
+            collected += 1
+            collected_bytes += stat.st_size
+    if not dry_run:
+        _count("collected", collected)
+        _count("collected_bytes", collected_bytes)
+    if logger:
+        logger.info(f"Blob store: {'would collect' if dry_run else 'collected'} {collected} unreferenced "
+                    f"file(s), {collected_bytes} bytes; kept {kept} blob(s).")
+    return {"collected": collected, "collected_bytes": collected_bytes, "kept": kept}
+
+
+def externalize(content):
+    """Replace large command output sections of content with blob references."""
+    if not BLOB_MIN_BYTES or not isinstance(content, str) or len(content) < BLOB_MIN_BYTES:
+        return content
+
+    def replace(match):
+        body = match.group(2)
+        if len(body) < BLOB_MIN_BYTES or REFERENCE_RE.fullmatch(body):
+            return match.group(0)
+        return match.group(1) + put(body)
+
+    return _SECTION_RE.sub(replace, content)
+
+
+def externalize_messages(messages):
+    return [{**m, "content": externalize(m.get("content"))} if m else m for m in messages]
+
+
+def resolve(content, logger=None):
+    """Expand the blob references in content. Missing blobs keep their reference."""
+    if not isinstance(content, str) or "[argonaut-blob " not in content:
+        return content
+
+    def replace(match):
+        text = get(match.group(1))
+        if text is None:
+            _count("missing")
+            if logger:
+                logger.warning(f"Blob {match.group(1)} referenced by a message is missing.")
+            return match.group(0)
+        _count("resolved")
+        return text
+
+    return REFERENCE_RE.sub(replace, content)
+
+
+def resolve_messages(messages, logger=None):
+    """Copies of messages with their blob references expanded."""
+    return [{**m, "content": resolve(m.get("content"), logger)} if m else m for m in messages]
+
+
+def blob_stats():
+    with _stats_lock:
+        stats = dict(_stats)
+    with _cache_lock:
+        stats.update(_cache_counters, cache_size=len(_cache), cache_bytes=_cache_bytes, cache_max_bytes=BLOB_CACHE_BYTES)
+    return stats
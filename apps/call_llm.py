@@ -5,6 +5,7 @@ import requests
 from typing import List, Dict, Any
 from openai import OpenAI
 from generic_storage import get_thread_messages
+from admission import llm_slot, AdmissionRejected
 
 GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta/openai/"
 CLAUDE_BASE_URL = "https://api.anthropic.com/v1/"
@@ -129,7 +130,33 @@ def _call_bedrock_webhook(messages: List[Dict[str, str]], system_text: str,
 
     return text
 
-def get_llm_response(thread_ts, max_response_tokens, temperature, logger=None):
+def _stream_completion(client, messages, model, max_tokens, temperature, on_delta) -> str:
+    """Run a streamed chat completion, calling on_delta(text_so_far) per chunk."""
+    stream = client.chat.completions.create(
+        messages=messages,
+        model=model,
+        max_tokens=max_tokens,
+        temperature=temperature,
+        top_p=float(os.getenv("top_p", 0.5)),
+        stream=True,
+    )
+    pieces: List[str] = []
+    for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content
+        if delta:
+            pieces.append(delta)
+            on_delta("".join(pieces))
+    return "".join(pieces)
+
+def get_llm_response(thread_ts, max_response_tokens, temperature, logger=None, messages=None, on_delta=None):
+    """Return the LLM reply to the thread's history (or to `messages` when the caller already has it).
+
+    With on_delta, OpenAI-compatible providers stream the completion and
+    on_delta(text_so_far) is called as tokens arrive. Bedrock and encrypted
+    threads cannot be streamed piecewise; they just return the full text.
+    """
     use_bedrock = os.getenv("USE_BEDROCK", "false").lower() == "true" or bool(os.getenv("CLAUDE_WEBHOOK_URL"))
     openai_key = os.getenv("OPENAI_API_KEY")
     claude_key = os.getenv("CLAUDE_API_KEY") or os.getenv("ANTHROPIC_API_KEY")  # optional
@@ -140,8 +167,8 @@ def get_llm_response(thread_ts, max_response_tokens, temperature, logger=None):
     model_to_use = None
 
     try:
-        # Load history (unchanged)
-        msgs = get_thread_messages(thread_ts, logger=logger)
+        # Load history unless the caller passed it in
+        msgs = messages if messages is not None else get_thread_messages(thread_ts, logger=logger)
         chat_messages = [{
             "role": m.get("role", "") or "user",
             "content": m.get("content", "") or ""
@@ -157,30 +184,34 @@ def get_llm_response(thread_ts, max_response_tokens, temperature, logger=None):
         # 1) Bedrock (via webhook)
         if use_bedrock:
             provider = "BedrockWebhook"
-            raw = _call_bedrock_webhook(
-                messages=non_system_msgs,   # already encrypted
-                system_text=system_text,    # already encrypted
-                temperature=temperature,
-                max_tokens=max_response_tokens,
-                logger=logger,
-            )
+            with llm_slot("bedrock", logger=logger):
+                raw = _call_bedrock_webhook(
+                    messages=non_system_msgs,   # already encrypted
+                    system_text=system_text,    # already encrypted
+                    temperature=temperature,
+                    max_tokens=max_response_tokens,
+                    logger=logger,
+                )
             return _decrypt_text(raw, scope_id=str(thread_ts), logger=logger)
 
         # 2) OpenAI
         if openai_key:
             provider = "OpenAI"
+            provider_slot = "openai"
             client = OpenAI(api_key=openai_key)
             model_to_use = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 
         # 3) Claude (OpenAI-compatible)
         elif claude_key:
             provider = "Claude(OpenAI-compat)"
+            provider_slot = "claude"
             client = OpenAI(api_key=claude_key, base_url=CLAUDE_BASE_URL)
             model_to_use = os.getenv("CLAUDE_MODEL", "claude-sonnet-4-5")
 
         # 4) Gemini (OpenAI-compatible)
         elif gemini_key:
             provider = "Gemini(OpenAI-compat)"
+            provider_slot = "gemini"
             client = OpenAI(api_key=gemini_key, base_url=GEMINI_BASE_URL)
             model_to_use = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 
@@ -192,18 +223,26 @@ def get_llm_response(thread_ts, max_response_tokens, temperature, logger=None):
             logger.info(f"Using provider: {provider} with model: {model_to_use}")
 
         # For OpenAI/Claude-compat/Gemini, send the ENCRYPTED list with system intact
-        completion = client.chat.completions.create(
-            messages=enc_messages,      # ⬅️ encrypted messages
-            model=model_to_use,
-            max_tokens=max_response_tokens,
-            temperature=temperature,
-            top_p=float(os.getenv("top_p", 0.5)),
-        )
-        raw_text = completion.choices[0].message.content or ""
+        with llm_slot(provider_slot, logger=logger):
+            if on_delta is not None and not _enc_enabled():
+                raw_text = _stream_completion(client, enc_messages, model_to_use,
+                                              max_response_tokens, temperature, on_delta)
+            else:
+                completion = client.chat.completions.create(
+                    messages=enc_messages,      # ⬅️ encrypted messages
+                    model=model_to_use,
+                    max_tokens=max_response_tokens,
+                    temperature=temperature,
+                    top_p=float(os.getenv("top_p", 0.5)),
+                )
+                raw_text = completion.choices[0].message.content or ""
 
         # 🔓 Decrypt before returning
         return _decrypt_text(raw_text, scope_id=str(thread_ts), logger=logger)
 
+    except AdmissionRejected:
+        # Let the event handler turn this into a "busy" reply
+        raise
     except requests.HTTPError as e:
         if logger:
             logger.error(f"Webhook HTTP error: {e} - {getattr(e.response, 'text', '')}")
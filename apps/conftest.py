@@ -0,0 +1,41 @@
+# conftest.py
+"""
+Shared setup for the tests in this directory (run them with pytest).
+
+Every storage setting points into one temporary directory for the whole
+session, overriding whatever the environment has, so a test run never
+touches real threads. The storage modules read their settings when they
+are imported, which happens while pytest collects the test files, so the
+environment is set in pytest_configure, before collection. Tests that need
+other settings change the module attributes themselves.
+"""
+import os
+import shutil
+import tempfile
+
+import pytest
+
+_DATA_DIR = tempfile.mkdtemp(prefix="argonaut-test-")
+
+
+def pytest_configure(config):
+    os.environ.update({
+        "DATA_DIR": _DATA_DIR,
+        "FS_INDEX": os.path.join(_DATA_DIR, "file_index"),
+        "SQLITE_PATH": os.path.join(_DATA_DIR, "argonaut.db"),
+        "THREAD_CATALOG_PATH": os.path.join(_DATA_DIR, "thread_catalog.db"),
+        "BLOB_STORE_PATH": os.path.join(_DATA_DIR, "blob_store"),
+        "REPLICATION_OUTBOX_PATH": os.path.join(_DATA_DIR, "replication_outbox.db"),
+        "STORAGE_BACKENDS": "file_storage",
+        "STORAGE_PRIMARY": "file_storage",
+    })
+
+
+def pytest_unconfigure(config):
+    shutil.rmtree(_DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def data_dir():
+    """The session's temporary DATA_DIR; FS_INDEX, SQLITE_PATH and the other stores live under it."""
+    return _DATA_DIR
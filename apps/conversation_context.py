@@ -0,0 +1,127 @@
+# conversation_context.py
+"""
+Request-scoped conversation context.
+
+One event used to re-read its thread from storage for every
+get_thread_messages / get_llm_response call and write every message
+separately. Inside `with thread_context(thread_ts, logger):` the thread is
+loaded once, generic_storage serves reads for that thread from memory, new
+messages are kept in memory, and everything is flushed to storage in one
+batch when the block exits. Long-running work flushes at its step boundaries
+with flush_context(), so viewers see progress and a crash loses at most the
+current step.
+"""
+import os
+import contextvars
+from contextlib import contextmanager
+
+import generic_storage
+
+_current = contextvars.ContextVar("conversation_context", default=None)
+
+
+def summary_view(messages, summary_index):
+    """
+    With SAVE_TOKEN_USE_SUMMARY=true: the system message, the summary message
+    and everything after it. Otherwise (or without a valid summary_index) a
+    copy of the full history.
+    """
+    save_token_use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
+    if not save_token_use_summary or not isinstance(summary_index, int) or summary_index >= len(messages):
+        return list(messages)
+    return [messages[0], messages[summary_index]] + messages[summary_index + 1:]
+
+
+class ConversationContext:
+    """In-memory view of one thread plus the writes not yet flushed."""
+
+    def __init__(self, thread_ts, logger=None):
+        self.thread_ts = thread_ts
+        self.logger = logger
+        self._messages = None
+        self._summary_index = None
+        self._hot_only = False
+        self.pending = []
+        self.pending_summary_index = None
+
+    def _load(self, full=False):
+        """
+        Load the thread once. With SAVE_TOKEN_USE_SUMMARY=true only the hot
+        part is read (compacted messages stay None) until full history is needed.
+        """
+        if self._messages is not None and not (full and self._hot_only):
+            return
+        save_token_use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
+        doc = generic_storage.load_thread(self.thread_ts, self.logger,
+                                          hot_only=save_token_use_summary and not full) or {}
+        self._messages = list(doc.get("messages", [])) + self.pending
+        self._hot_only = bool(doc.get("hot_only"))
+        if self.pending_summary_index is None:
+            self._summary_index = doc.get("summary_index")
+        if self.logger:
+            self.logger.debug("Loaded %d message(s) for thread %s into context", len(self._messages), self.thread_ts)
+
+    @property
+    def messages(self):
+        """Full message history, including unflushed appends."""
+        self._load(full=True)
+        return self._messages
+
+    def append(self, role, content):
+        self._load()
+        message = {"role": role, "content": content}
+        self._messages.append(message)
+        self.pending.append(message)
+
+    def set_summary_index(self):
+        self._load()
+        if not self._messages:
+            if self.logger:
+                self.logger.warning(f"No messages in thread {self.thread_ts}.")
+            return False
+        self._summary_index = self.pending_summary_index = len(self._messages) - 1
+        return True
+
+    def context_messages(self):
+        """Same view as the storage backends' get_thread_messages."""
+        self._load()
+        view = summary_view(self._messages, self._summary_index)
+        if None in view:
+            view = summary_view(self.messages, self._summary_index)
+        return view
+
+    def flush(self):
+        """Write pending messages (and summary_index) to storage in one batch."""
+        if self.pending:
+            generic_storage.append_messages(self.thread_ts, self.pending, self.logger)
+            self.pending = []
+        if self.pending_summary_index is not None:
+            generic_storage.set_summary_index(self.thread_ts, self.logger, summary_index=self.pending_summary_index)
+            self.pending_summary_index = None
+
+
+def current_context(thread_ts):
+    """Return the open context for thread_ts, or None."""
+    ctx = _current.get()
+    if ctx is not None and ctx.thread_ts == thread_ts:
+        return ctx
+    return None
+
+
+def flush_context(thread_ts):
+    """Write out the open context's pending writes for thread_ts now (no-op outside a context)."""
+    ctx = current_context(thread_ts)
+    if ctx is not None:
+        ctx.flush()
+
+
+@contextmanager
+def thread_context(thread_ts, logger=None):
+    """Open a context for thread_ts; flush it on exit, even after an error."""
+    ctx = ConversationContext(thread_ts, logger)
+    token = _current.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _current.reset(token)
+        ctx.flush()
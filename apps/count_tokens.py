@@ -24,6 +24,30 @@ def count_tokens(messages, model):
     num_tokens += 3  # for assistant reply primer
     return num_tokens
 
+_estimate_encoding = None
+
+def estimate_tokens(messages):
+    """Approximate token count of messages for any provider (cl100k_base).
+
+    tiktoken downloads its encoding on first use; if that is not possible
+    (air-gapped pod) fall back to ~4 characters per token.
+    """
+    global _estimate_encoding
+    if _estimate_encoding is None:
+        try:
+            _estimate_encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception:
+            _estimate_encoding = False
+    num_tokens = 0
+    for message in messages:
+        content = message.get("content") or ""
+        num_tokens += 3
+        if _estimate_encoding:
+            num_tokens += len(_estimate_encoding.encode(content, disallowed_special=()))
+        else:
+            num_tokens += len(content) // 4 + 1
+    return num_tokens
+
 def main():
     model = os.environ.get("MODEL_NAME")
     if not model:
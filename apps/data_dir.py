@@ -0,0 +1,10 @@
+# data_dir.py
+"""
+DATA_DIR: where state that outlives a process lives (the replication
+outbox, the thread catalog, the blob store). Relative by default, like
+FS_INDEX and SQLITE_PATH, so CLI runs and tests work from a checkout; the
+image sets it to the persistent volume every pod mounts.
+"""
+import os
+
+DATA_DIR = os.getenv("DATA_DIR", "data")
@@ -0,0 +1,125 @@
+# dedup.py
+"""
+TTL-bounded de-duplication of webhook deliveries.
+
+Slack, n8n, Google Chat and the email bridge all re-deliver events they think
+were lost. Each delivery is reduced to a key (event id, client message id or
+a hash of the payload) and the first delivery's job is remembered for a while;
+re-deliveries attach to that job instead of starting another LLM round trip.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "true").lower() == "true"
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", 600))  # seconds an id-keyed delivery is remembered
+# Payload hashes cannot tell a retry from a user deliberately repeating "RUN",
+# so they are only remembered briefly.
+DEDUP_PAYLOAD_HASH_TTL = int(os.getenv("DEDUP_PAYLOAD_HASH_TTL", 60))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", 10000))
+
+# Fields that identify a delivery, most specific first
+_ID_FIELDS = ("event_id", "client_msg_id", "message_id", "messageId")
+# Keys the sender sets once per event and repeats on every retry. Not
+# X-Request-Id: proxies mint a fresh one per request, so retries never match.
+_ID_HEADERS = ("Idempotency-Key", "X-Idempotency-Key")
+
+
+def event_key(payload, headers=None):
+    """Return (key, ttl) identifying this delivery of payload."""
+    if headers:
+        for name in _ID_HEADERS:
+            value = headers.get(name)
+            if value:
+                return f"header:{value}", DEDUP_TTL
+    candidates = [payload]
+    if isinstance(payload.get("event"), dict):
+        candidates.append(payload["event"])
+    if isinstance(payload.get("message"), dict):
+        candidates.append(payload["message"])
+    for source in candidates:
+        for field in _ID_FIELDS:
+            value = source.get(field)
+            if value:
+                return f"{field}:{payload.get('thread_ts')}:{value}", DEDUP_TTL
+    # Google Chat message resource name
+    if isinstance(payload.get("message"), dict) and payload["message"].get("name"):
+        return f"name:{payload['message']['name']}", DEDUP_TTL
+    digest = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"sha256:{digest}", DEDUP_PAYLOAD_HASH_TTL
+
+
+class DedupCache:
+    """
+    Single-flight map of delivery key -> value (a job_queue.Job).
+
+    An entry lives for its ttl, but never expires while its value reports
+    done() == False, so a slow in-flight job keeps absorbing re-deliveries.
+    """
+
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES):
+        self.max_entries = int(max_entries)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "evicted": 0}
+
+    @staticmethod
+    def _in_flight(value):
+        done = getattr(value, "done", None)
+        return callable(done) and not done()
+
+    def _expired(self, entry, now):
+        value, expires_at = entry
+        return now >= expires_at and not self._in_flight(value)
+
+    def get_or_create(self, key, factory, ttl=DEDUP_TTL):
+        """
+        Return (value, created). The first caller for key runs factory() and
+        gets created=True; callers within ttl get the same value back.
+        Exceptions from factory propagate and nothing is remembered.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and not self._expired(entry, now):
+                self._counters["hits"] += 1
+                return entry[0], False
+            value = factory()
+            self._entries[key] = (value, now + ttl)
+            self._entries.move_to_end(key)
+            self._counters["misses"] += 1
+            self._evict(now)
+            return value, True
+
+    def _evict(self, now):
+        # Drop expired entries from the old end, then the oldest finished ones
+        # if we are still over capacity.
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_entries and not self._expired(self._entries[key], now):
+                break
+            if not self._in_flight(self._entries[key][0]):
+                del self._entries[key]
+                self._counters["evicted"] += 1
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), **self._counters}
+
+
+_default_cache = DedupCache()
+
+
+def dedup_submit(payload, factory, headers=None):
+    """Run factory() once per delivery of payload. Returns (value, duplicate)."""
+    if not DEDUP_ENABLED:
+        return factory(), False
+    key, ttl = event_key(payload, headers)
+    value, created = _default_cache.get_or_create(key, factory, ttl)
+    return value, not created
+
+
+def dedup_stats():
+    return _default_cache.stats()
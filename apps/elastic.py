@@ -2,24 +2,56 @@
 from datetime import datetime, timezone
 import os
 import logging
-from elasticsearch import Elasticsearch
+import threading
+from elasticsearch import Elasticsearch, NotFoundError, BadRequestError, helpers
 
 ES_URL = os.getenv("ES_URL")
 ES_USER = os.getenv("ES_USER")
 ES_PWD = os.getenv("ES_PWD")
 ES_CA_CERTS = os.getenv("es_ca_certs")
 ES_INDEX = os.getenv("es_index")
+# How often a scripted update is retried when a concurrent write bumped the seq_no
+ES_RETRY_ON_CONFLICT = int(os.getenv("ES_RETRY_ON_CONFLICT", 5))
+
+# Connection pool and retry settings for the shared client
+ES_MAX_CONNECTIONS = int(os.getenv("ES_MAX_CONNECTIONS", 10))
+ES_REQUEST_TIMEOUT = float(os.getenv("ES_REQUEST_TIMEOUT", 10))
+ES_MAX_RETRIES = int(os.getenv("ES_MAX_RETRIES", 3))
+
+_es_client = None
+_es_client_pid = None
+_es_client_lock = threading.Lock()
+_index_ready = False
 
 def get_es_client():
-    return Elasticsearch(
-        ES_URL,
-        basic_auth=(ES_USER, ES_PWD),
-        verify_certs=True,
-        ca_certs=ES_CA_CERTS
-    )
+    """
+    Return the process-wide Elasticsearch client. It keeps a pool of up to
+    ES_MAX_CONNECTIONS keep-alive connections and is rebuilt after a fork,
+    since pooled sockets must not be shared between gunicorn workers.
+    """
+    global _es_client, _es_client_pid
+    if _es_client is not None and _es_client_pid == os.getpid():
+        return _es_client
+    with _es_client_lock:
+        if _es_client is None or _es_client_pid != os.getpid():
+            _es_client = Elasticsearch(
+                ES_URL,
+                basic_auth=(ES_USER, ES_PWD),
+                verify_certs=True,
+                ca_certs=ES_CA_CERTS,
+                connections_per_node=ES_MAX_CONNECTIONS,
+                request_timeout=ES_REQUEST_TIMEOUT,
+                max_retries=ES_MAX_RETRIES,
+                retry_on_timeout=True
+            )
+            _es_client_pid = os.getpid()
+    return _es_client
 
 def ensure_index_exists(logger=None):
-    """Create the Elasticsearch index with mappings if it doesn't exist."""
+    """Create the Elasticsearch index with mappings if it doesn't exist (checked once per process)."""
+    global _index_ready
+    if _index_ready:
+        return
     es = get_es_client()
 
     if not es.indices.exists(index=ES_INDEX):
@@ -36,83 +68,129 @@ def ensure_index_exists(logger=None):
                     },
                     "summary_index": {"type": "integer"},
                     "created_at": {"type": "date"},
+                    "updated_at": {"type": "date"},
                     "reaction": {"type": "text"}
                 }
             }
         }
-        es.indices.create(index=ES_INDEX, body=mappings)
-        if logger:
-            logger.info(f"Index '{ES_INDEX}' created with mappings.")
+        try:
+            es.indices.create(index=ES_INDEX, body=mappings)
+            if logger:
+                logger.info(f"Index '{ES_INDEX}' created with mappings.")
+        except BadRequestError as e:
+            # Another worker created it between our exists check and create
+            if e.error != "resource_already_exists_exception":
+                raise
+    _index_ready = True
 
 def update_elasticsearch(es, thread_ts, role, content, logger=None):
     """Updates an Elasticsearch thread with a new message, or creates it if not found."""
-    esresponse = es.get(index=ES_INDEX, id=thread_ts, ignore=404)
+    append_messages_es(es, thread_ts, [{"role": role, "content": content}], logger)
 
-    if esresponse.get('found'):
-        # Get existing messages
-        thread_data = esresponse['_source']
-        messages = thread_data.get('messages', [])
+# Appends run server-side so the thread is never read into the client and
+# sent back. The script runs under the document's seq_no/primary_term;
+# retry_on_conflict re-runs it when another writer got there first, so
+# concurrent appends to one thread are all kept.
+_APPEND_SCRIPT = """
+if (ctx._source.messages == null) { ctx._source.messages = params.messages; }
+else { ctx._source.messages.addAll(params.messages); }
+ctx._source.updated_at = params.now;
+"""
 
-        # Append the new message
-        new_message = {
-            "role": role,
-            "content": content
-        }
-        messages.append(new_message)
+_SUMMARY_INDEX_SCRIPT = """
+int size = ctx._source.messages == null ? 0 : ctx._source.messages.size();
+if (size == 0) { ctx.op = 'noop'; }
+else { ctx._source.summary_index = params.summary_index == null ? size - 1 : params.summary_index; }
+"""
 
-        # Update the thread
-        es.update(index=ES_INDEX, id=thread_ts, body={"doc": {"messages": messages}})
-        if logger:
-            logger.info(f"Thread {thread_ts} updated with message from {role}.")
-    else:
-        if logger:
-            logger.info(f"Thread {thread_ts} not found. Creating a new thread.")
-
-        new_thread_data = {
-            "messages": [{
-                "role": role,
-                "content": content
-            }],
-            "created_at": datetime.now(timezone.utc).isoformat()
+def append_messages_es(es, thread_ts, messages, logger=None):
+    """Append a batch of messages to a thread document in one scripted update, creating it if not found."""
+    roles = ", ".join(m.get("role", "") for m in messages)
+    now = datetime.now(timezone.utc).isoformat()
+    esresponse = es.update(index=ES_INDEX, id=thread_ts, body={
+        "script": {"source": _APPEND_SCRIPT, "lang": "painless", "params": {"messages": list(messages), "now": now}},
+        "upsert": {
+            "messages": list(messages),
+            "created_at": now,
+            "updated_at": now
         }
+    }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
+
+    if logger:
+        if esresponse.get('result') == 'created':
+            logger.info(f"New thread {thread_ts} created with {len(messages)} message(s) from {roles}.")
+        else:
+            logger.info(f"Thread {thread_ts} updated with {len(messages)} message(s) from {roles}.")
 
-        es.index(index=ES_INDEX, id=thread_ts, body=new_thread_data)
+def load_thread_es(es, thread_ts, logger=None):
+    """Return the whole thread document (_source) or None."""
+    try:
+        esresponse = es.get(index=ES_INDEX, id=thread_ts, ignore=404)
+    except Exception as e:
         if logger:
-            logger.info(f"New thread {thread_ts} created with message from {role}.")
+            logger.error(f"Error retrieving thread {thread_ts} from Elasticsearch: {e}")
+        return None
+    if not esresponse.get('found'):
+        return None
+    return esresponse['_source']
+
+def load_header_es(es, thread_ts):
+    """The thread document without its messages, plus message_count (counted on the server), or None."""
+    hits = es.search(index=ES_INDEX, body={
+        "query": {"ids": {"values": [thread_ts]}},
+        "_source": {"excludes": ["messages"]},
+        "script_fields": {"message_count": {"script": {
+            "source": "params._source.messages == null ? 0 : params._source.messages.size()"}}}
+    })["hits"]["hits"]
+    if not hits:
+        return None
+    header = hits[0]["_source"]
+    header["message_count"] = hits[0]["fields"]["message_count"][0]
+    return header
+
+def read_messages_es(es, thread_ts, after_seq=None, limit=None, logger=None):
+    """Messages with seq > after_seq (all when None), at most limit of them (sliced from the thread document)."""
+    messages = (load_thread_es(es, thread_ts, logger) or {}).get("messages", [])
+    start = 0 if after_seq is None else after_seq + 1
+    return messages[start:start + limit] if limit is not None else messages[start:]
 
-def set_summary_index_es(es, thread_ts, logger=None):
+def thread_exists_es(es, thread_ts):
+    return bool(es.exists(index=ES_INDEX, id=thread_ts))
+
+def list_threads_es(es):
+    """All thread ids in the index (a full scan)."""
+    return [hit["_id"] for hit in helpers.scan(es, index=ES_INDEX, query={"query": {"match_all": {}}}, _source=False)]
+
+def thread_version_es(es, thread_ts):
+    """Cheap change marker for caches: (_seq_no, _primary_term) without fetching _source."""
+    esresponse = es.get(index=ES_INDEX, id=thread_ts, _source=False, ignore=404)
+    if not esresponse.get('found'):
+        return None
+    return (esresponse.get('_seq_no'), esresponse.get('_primary_term'))
+
+def set_summary_index_es(es, thread_ts, logger=None, summary_index=None):
     """
     Set the summary_index field to the highest index in the messages array
-    for the given thread_ts document in Elasticsearch.
+    (or to summary_index when given) for the given thread_ts document in Elasticsearch.
     """
     try:
-        esresponse = es.get(index=ES_INDEX, id=thread_ts, ignore=404)
-
-        if not esresponse.get('found'):
-            if logger:
-                logger.warning(f"Document with thread_ts '{thread_ts}' not found.")
-            return False
-
-        thread_data = esresponse['_source']
-        messages = thread_data.get("messages", [])
+        esresponse = es.update(index=ES_INDEX, id=thread_ts, body={
+            "script": {"source": _SUMMARY_INDEX_SCRIPT, "lang": "painless", "params": {"summary_index": summary_index}}
+        }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
 
-        if not messages:
+        if esresponse.get('result') == 'noop':
             if logger:
                 logger.warning(f"No messages found in thread '{thread_ts}'. Cannot set summary_index.")
             return False
 
-        highest_index = len(messages) - 1
-
-        es.update(index=ES_INDEX, id=thread_ts, body={
-            "doc": {
-                "summary_index": highest_index
-            }
-        })
-
         if logger:
-            logger.info(f"summary_index set to {highest_index} for thread {thread_ts}.")
+            logger.info(f"summary_index set for thread {thread_ts}.")
         return True
 
+    except NotFoundError:
+        if logger:
+            logger.warning(f"Document with thread_ts '{thread_ts}' not found.")
+        return False
     except Exception as e:
         if logger:
             logger.error(f"Error setting summary_index for thread {thread_ts}: {e}")
@@ -170,13 +248,40 @@ def get_thread_messages(es, thread_ts, logger=None):
             logger.error(f"Error building summary-based context for thread {thread_ts}: {e}")
         return messages
 
+def delete_threads_es(es, thread_ids, logger=None):
+    """Delete whole thread documents in one delete-by-query. Returns how many were deleted."""
+    esresponse = es.delete_by_query(index=ES_INDEX, body={"query": {"ids": {"values": list(thread_ids)}}},
+                                    conflicts="proceed")
+    if logger:
+        logger.info(f"Deleted {esresponse.get('deleted', 0)} thread(s) from '{ES_INDEX}'.")
+    return esresponse.get("deleted", 0)
+
+def inactive_query(before):
+    """Documents last written before `before`; ones written before updated_at existed go by created_at."""
+    return {"bool": {"should": [
+        {"range": {"updated_at": {"lt": before}}},
+        {"bool": {"must_not": {"exists": {"field": "updated_at"}}, "filter": {"range": {"created_at": {"lt": before}}}}}
+    ], "minimum_should_match": 1}}
+
+def inactive_thread_ids_es(es, before):
+    """Yield the ids of thread documents with no write since `before` (an ISO timestamp)."""
+    for hit in helpers.scan(es, index=ES_INDEX, query={"query": inactive_query(before)}, _source=False):
+        yield hit["_id"]
+
+def set_created_at_es(es, thread_ts, created_at, logger=None):
+    """Overwrite created_at (used when threads are copied from another backend)."""
+    es.update(index=ES_INDEX, id=thread_ts, body={"doc": {"created_at": created_at}},
+              retry_on_conflict=ES_RETRY_ON_CONFLICT)
+    return True
+
 def update_reaction(es, index_name, thread_ts, reaction, logger=None):
     try:
         result = es.update(index=index_name, id=thread_ts, body={
             "doc": {
-                "reaction": reaction
+                "reaction": reaction,
+                "updated_at": datetime.now(timezone.utc).isoformat()
             }
-        }, refresh=True)
+        }, refresh=True, retry_on_conflict=ES_RETRY_ON_CONFLICT)
 
         if logger:
             logger.info("Directly updated reaction for thread_ts %s: %s", thread_ts, result)
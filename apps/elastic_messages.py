@@ -0,0 +1,424 @@
+# elastic_messages.py
+"""
+Message-per-document Elasticsearch storage (STORAGE_BACKENDS=elasticsearch_messages).
+
+Layout, next to the single-document index used by elastic.py:
+  <es_index>-threads   one header per thread: message_count, summary_index,
+                       reaction, created_at, updated_at
+  <es_index>-messages  one document per message, id "<thread_ts>:<seq>",
+                       with thread_ts, seq, role, content, created_at
+
+An append reserves a seq range with a scripted update of the header,
+bulk-indexes only the new messages, and then touches the header again, so
+its cost does not grow with the thread and the header's version (what
+caches validate against) only moves past a reservation once its messages
+are in. A failed bulk gives its seqs back when nothing was appended after
+them, and otherwise lists them in the header's missing_seqs.
+
+Reads take message_count from the header and fetch ids "<thread_ts>:<seq>"
+with realtime multi-gets, so they see an append without waiting for a
+refresh, and callers can read just the tail of a thread or the part after
+the summary. Seqs that were reserved but never written are skipped.
+
+Migrate existing threads from the single-document index with:
+    python elastic_messages.py migrate
+"""
+import os
+import logging
+import itertools
+import threading
+from datetime import datetime, timezone
+
+from elasticsearch import NotFoundError, BadRequestError, helpers
+
+from elastic import get_es_client, inactive_query, ES_INDEX, ES_RETRY_ON_CONFLICT
+
+ES_THREADS_INDEX = os.getenv("es_threads_index", f"{ES_INDEX}-threads")
+ES_MESSAGES_INDEX = os.getenv("es_messages_index", f"{ES_INDEX}-messages")
+ES_PAGE_SIZE = int(os.getenv("ES_PAGE_SIZE", 500))
+# Reads are realtime gets, so appends need no refresh; set to wait_for for searches
+ES_MESSAGES_REFRESH = os.getenv("ES_MESSAGES_REFRESH", "false")
+
+_indices_ready = False
+_indices_lock = threading.Lock()
+
+_THREADS_MAPPINGS = {
+    "properties": {
+        "thread_ts": {"type": "keyword"},
+        "message_count": {"type": "long"},
+        "missing_seqs": {"type": "long"},
+        "summary_index": {"type": "integer"},
+        "reaction": {"type": "text"},
+        "created_at": {"type": "date"},
+        "updated_at": {"type": "date"}
+    }
+}
+
+_MESSAGES_MAPPINGS = {
+    "properties": {
+        "thread_ts": {"type": "keyword"},
+        "seq": {"type": "long"},
+        "role": {"type": "keyword"},
+        "content": {"type": "text"},
+        "created_at": {"type": "date"}
+    }
+}
+
+# Keep each thread's messages together on disk, in order
+_MESSAGES_SETTINGS = {"index": {"sort.field": ["thread_ts", "seq"], "sort.order": ["asc", "asc"]}}
+
+# Reserve params.n sequence numbers; the caller's range ends at the new message_count
+_RESERVE_SCRIPT = """
+ctx._source.message_count = (ctx._source.message_count == null ? 0 : ctx._source.message_count) + params.n;
+ctx._source.updated_at = params.now;
+"""
+
+# Undo a reservation whose messages were not written: give the seqs back when
+# no later append has reserved after them, otherwise record them as missing
+_RELEASE_SCRIPT = """
+if (ctx._source.message_count == params.end) { ctx._source.message_count = params.start; }
+else {
+  if (ctx._source.missing_seqs == null) { ctx._source.missing_seqs = []; }
+  ctx._source.missing_seqs.addAll(params.seqs);
+}
+ctx._source.updated_at = params.now;
+"""
+
+_SUMMARY_INDEX_SCRIPT = """
+long size = ctx._source.message_count == null ? 0 : ctx._source.message_count;
+if (size == 0) { ctx.op = 'noop'; }
+else { ctx._source.summary_index = params.summary_index == null ? size - 1 : params.summary_index; }
+"""
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _create_index(es, index, body, logger=None):
+    if es.indices.exists(index=index):
+        return
+    try:
+        es.indices.create(index=index, body=body)
+        if logger:
+            logger.info(f"Index '{index}' created with mappings.")
+    except BadRequestError as e:
+        # Another worker created it between our exists check and create
+        if e.error != "resource_already_exists_exception":
+            raise
+
+
+def ensure_index_exists(logger=None):
+    """Create the threads and messages indices if they don't exist (checked once per process)."""
+    global _indices_ready
+    if _indices_ready:
+        return
+    with _indices_lock:
+        if _indices_ready:
+            return
+        es = get_es_client()
+        _create_index(es, ES_THREADS_INDEX, {"mappings": _THREADS_MAPPINGS}, logger)
+        _create_index(es, ES_MESSAGES_INDEX, {"settings": _MESSAGES_SETTINGS, "mappings": _MESSAGES_MAPPINGS}, logger)
+        _indices_ready = True
+
+
+def _message_doc(thread_ts, seq, message, created_at):
+    return {
+        "_index": ES_MESSAGES_INDEX,
+        "_id": f"{thread_ts}:{seq}",
+        "_source": {
+            "thread_ts": thread_ts,
+            "seq": seq,
+            "role": message.get("role"),
+            "content": message.get("content"),
+            "created_at": created_at
+        }
+    }
+
+
+def _release_seqs(es, thread_ts, start, end, failed_seqs, logger=None):
+    try:
+        es.update(index=ES_THREADS_INDEX, id=thread_ts, body={
+            "script": {"source": _RELEASE_SCRIPT, "lang": "painless",
+                       "params": {"start": start, "end": end, "seqs": failed_seqs, "now": _now()}}
+        }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
+    except Exception as e:
+        # The seqs stay reserved; reads skip them since they have no document
+        if logger:
+            logger.error(f"Could not release seqs {start}..{end - 1} of thread {thread_ts}: {e}")
+
+
+def append_messages(thread_ts, messages, logger=None):
+    """
+    Append a batch of messages: reserve seqs on the header, bulk-index the
+    new messages only, then touch the header so its version moves. Raises
+    when any message could not be indexed, after releasing the reservation.
+    """
+    if not messages:
+        return
+    es = get_es_client()
+    now = _now()
+    roles = ", ".join(m.get("role", "") for m in messages)
+    esresponse = es.update(index=ES_THREADS_INDEX, id=thread_ts, body={
+        "script": {"source": _RESERVE_SCRIPT, "lang": "painless", "params": {"n": len(messages), "now": now}},
+        "upsert": {"thread_ts": thread_ts, "message_count": len(messages), "created_at": now, "updated_at": now},
+        "_source": ["message_count"]
+    }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
+    end_seq = esresponse["get"]["_source"]["message_count"]
+    first_seq = end_seq - len(messages)
+
+    docs = [_message_doc(thread_ts, first_seq + i, m, now) for i, m in enumerate(messages)]
+    try:
+        _, errors = helpers.bulk(es, docs, refresh=ES_MESSAGES_REFRESH, raise_on_error=False)
+    except Exception:
+        _release_seqs(es, thread_ts, first_seq, end_seq, list(range(first_seq, end_seq)), logger)
+        raise
+    if errors:
+        failed = [int(next(iter(item.values()))["_id"].rsplit(":", 1)[1]) for item in errors]
+        _release_seqs(es, thread_ts, first_seq, end_seq, failed, logger)
+        raise RuntimeError(f"{len(errors)} of {len(messages)} message(s) for thread {thread_ts} were not indexed: "
+                           f"{next(iter(errors[0].values())).get('error')}")
+
+    # The reservation already moved the version; move it again now that the
+    # messages are readable, so a cache filled in between is revalidated
+    es.update(index=ES_THREADS_INDEX, id=thread_ts, body={"doc": {"updated_at": _now()}, "detect_noop": False},
+              retry_on_conflict=ES_RETRY_ON_CONFLICT)
+
+    if logger:
+        if esresponse.get("result") == "created":
+            logger.info(f"New thread {thread_ts} created with {len(messages)} message(s) from {roles}.")
+        else:
+            logger.info(f"Thread {thread_ts} updated with {len(messages)} message(s) from {roles}.")
+
+
+def update_message(thread_ts, role, content, logger=None):
+    append_messages(thread_ts, [{"role": role, "content": content}], logger)
+
+
+def iter_messages(thread_ts, seqs, page_size=ES_PAGE_SIZE):
+    """Yield (seq, message) for the given seqs in order, one realtime mget per page; unwritten seqs are skipped."""
+    es = get_es_client()
+    seqs = iter(seqs)
+    while True:
+        page = list(itertools.islice(seqs, page_size))
+        if not page:
+            return
+        docs = es.mget(index=ES_MESSAGES_INDEX, body={"ids": [f"{thread_ts}:{seq}" for seq in page]},
+                       _source=["role", "content"])["docs"]
+        for seq, doc in zip(page, docs):
+            if doc.get("found"):
+                yield seq, {"role": doc["_source"]["role"], "content": doc["_source"]["content"]}
+
+
+def read_messages(thread_ts, after_seq=None, limit=None):
+    """Messages with seq > after_seq (all when None), at most limit of them."""
+    header = load_header(thread_ts)
+    if not header:
+        return []
+    start = 0 if after_seq is None else after_seq + 1
+    messages = []
+    for _, message in iter_messages(thread_ts, range(start, header.get("message_count", 0)),
+                                    page_size=min(limit, ES_PAGE_SIZE) if limit else ES_PAGE_SIZE):
+        messages.append(message)
+        if limit and len(messages) >= limit:
+            break
+    return messages
+
+
+def tail_messages(thread_ts, count):
+    """The last count messages of a thread."""
+    header = load_header(thread_ts)
+    if not header:
+        return []
+    size = header.get("message_count", 0)
+    return [m for _, m in iter_messages(thread_ts, range(max(0, size - count), size))]
+
+
+def load_header(thread_ts):
+    esresponse = get_es_client().get(index=ES_THREADS_INDEX, id=thread_ts, ignore=404)
+    if not esresponse.get("found"):
+        return None
+    return esresponse["_source"]
+
+
+def load_thread(thread_ts, logger=None):
+    """Return the whole thread document (header fields plus messages) or None."""
+    try:
+        header = load_header(thread_ts)
+        if header is None:
+            return None
+        header["messages"] = [m for _, m in iter_messages(thread_ts, range(header.get("message_count", 0)))]
+        return header
+    except Exception as e:
+        if logger:
+            logger.error(f"Error retrieving thread {thread_ts} from Elasticsearch: {e}")
+        return None
+
+
+def list_threads():
+    """All thread ids in the threads index (a full scan)."""
+    es = get_es_client()
+    return [hit["_id"] for hit in helpers.scan(es, index=ES_THREADS_INDEX, query={"query": {"match_all": {}}}, _source=False)]
+
+
+def thread_version(thread_ts):
+    """Cheap change marker for caches: every write goes through the header, so its seq_no."""
+    esresponse = get_es_client().get(index=ES_THREADS_INDEX, id=thread_ts, _source=False, ignore=404)
+    if not esresponse.get("found"):
+        return None
+    return (esresponse.get("_seq_no"), esresponse.get("_primary_term"))
+
+
+def get_thread_messages(thread_ts, logger=None):
+    """
+    Retrieve conversation messages for a given thread_ts. With
+    SAVE_TOKEN_USE_SUMMARY=true only messages[0], messages[summary_index]
+    and everything after it are fetched.
+    """
+    save_token_use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
+    try:
+        header = load_header(thread_ts)
+        if header is None:
+            if logger:
+                logger.info(f"Thread {thread_ts} not found.")
+            return []
+        summary_index = header.get("summary_index")
+        size = header.get("message_count", 0)
+        if not save_token_use_summary or not isinstance(summary_index, int) or summary_index >= size:
+            return [m for _, m in iter_messages(thread_ts, range(size))]
+        seqs = itertools.chain([0], range(max(summary_index, 1), size))
+        return [m for _, m in iter_messages(thread_ts, seqs)]
+    except Exception as e:
+        if logger:
+            logger.error(f"Error retrieving thread {thread_ts} from Elasticsearch: {e}")
+        return []
+
+
+def set_summary_index(thread_ts, logger=None, summary_index=None):
+    """Set summary_index on the header (default: the last message)."""
+    try:
+        esresponse = get_es_client().update(index=ES_THREADS_INDEX, id=thread_ts, body={
+            "script": {"source": _SUMMARY_INDEX_SCRIPT, "lang": "painless", "params": {"summary_index": summary_index}}
+        }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
+        if esresponse.get("result") == "noop":
+            if logger:
+                logger.warning(f"No messages in thread {thread_ts}.")
+            return False
+        if logger:
+            logger.info(f"summary_index set for thread {thread_ts}.")
+        return True
+    except NotFoundError:
+        if logger:
+            logger.warning(f"Thread {thread_ts} not found.")
+        return False
+    except Exception as e:
+        if logger:
+            logger.error(f"Error setting summary_index for thread {thread_ts}: {e}")
+        return False
+
+
+def update_reaction(thread_ts, reaction, logger=None):
+    try:
+        get_es_client().update(index=ES_THREADS_INDEX, id=thread_ts, body={
+            "doc": {"reaction": reaction, "updated_at": _now()}
+        }, retry_on_conflict=ES_RETRY_ON_CONFLICT)
+        if logger:
+            logger.info(f"Reaction updated for thread {thread_ts}.")
+        return True
+    except Exception as e:
+        if logger:
+            logger.exception("Failed to update reaction for thread_ts %s: %s", thread_ts, e)
+        return False
+
+
+def inactive_thread_ids(before):
+    """Yield the ids of threads whose header has not been written since `before` (an ISO timestamp)."""
+    es = get_es_client()
+    query = {"query": inactive_query(before)}
+    for hit in helpers.scan(es, index=ES_THREADS_INDEX, query=query, _source=False):
+        yield hit["_id"]
+
+
+def set_created_at(thread_ts, created_at, logger=None):
+    """Overwrite created_at on the header (used when threads are copied from another backend)."""
+    get_es_client().update(index=ES_THREADS_INDEX, id=thread_ts, body={"doc": {"created_at": created_at}},
+                           retry_on_conflict=ES_RETRY_ON_CONFLICT)
+    return True
+
+
+def delete_threads(thread_ids, logger=None):
+    """
+    Delete whole threads: their messages with one delete-by-query, then the
+    headers. A failure leaves the headers behind, so a retry finds the
+    threads again. Returns how many headers were deleted.
+    """
+    es = get_es_client()
+    thread_ids = list(thread_ids)
+    messages = es.delete_by_query(index=ES_MESSAGES_INDEX, body={"query": {"terms": {"thread_ts": thread_ids}}},
+                                  conflicts="proceed")
+    headers = es.delete_by_query(index=ES_THREADS_INDEX, body={"query": {"ids": {"values": thread_ids}}},
+                                 conflicts="proceed")
+    if logger:
+        logger.info(f"Deleted {headers.get('deleted', 0)} thread(s) with {messages.get('deleted', 0)} message(s).")
+    return headers.get("deleted", 0)
+
+
+def migrate_from_single_document(source_index=ES_INDEX, logger=None):
+    """
+    Copy every thread from the single-document index into the header and
+    messages indices. Message ids are "<thread_ts>:<seq>", so a re-run
+    overwrites instead of duplicating.
+    """
+    ensure_index_exists(logger)
+    es = get_es_client()
+    threads = messages = 0
+
+    def actions():
+        nonlocal threads, messages
+        for hit in helpers.scan(es, index=source_index, query={"query": {"match_all": {}}}):
+            thread_ts = hit["_id"]
+            doc = hit["_source"]
+            thread_messages = doc.get("messages", [])
+            created_at = doc.get("created_at") or _now()
+            header = {
+                "thread_ts": thread_ts,
+                "message_count": len(thread_messages),
+                "created_at": created_at,
+                # Documents written before updated_at existed only have created_at
+                "updated_at": doc.get("updated_at") or created_at
+            }
+            for field in ("summary_index", "reaction"):
+                if doc.get(field) is not None:
+                    header[field] = doc[field]
+            yield {"_index": ES_THREADS_INDEX, "_id": thread_ts, "_source": header}
+            for seq, message in enumerate(thread_messages):
+                yield _message_doc(thread_ts, seq, message, created_at)
+            threads += 1
+            messages += len(thread_messages)
+            if logger and threads % 100 == 0:
+                logger.info(f"Migrated {threads} thread(s), {messages} message(s) so far.")
+
+    helpers.bulk(es, actions(), chunk_size=ES_PAGE_SIZE)
+    es.indices.refresh(index=[ES_THREADS_INDEX, ES_MESSAGES_INDEX])
+    if logger:
+        logger.info(f"Migrated {threads} thread(s), {messages} message(s) from '{source_index}'.")
+    return {"threads": threads, "messages": messages}
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Message-per-document Elasticsearch storage tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate = sub.add_parser("migrate", help="copy threads from the single-document index")
+    migrate.add_argument("--source-index", default=ES_INDEX)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("ElasticMessages")
+    if args.command == "migrate":
+        migrate_from_single_document(args.source_index, logger)
+
+
+if __name__ == "__main__":
+    main()
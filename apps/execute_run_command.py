@@ -3,6 +3,7 @@ import re
 import html
 import json
 import subprocess
+from admission import command_slot
 
 def execute_run_command(command, logger):
     # Check if execution is enabled via environment variable
@@ -21,7 +22,8 @@ def execute_run_command(command, logger):
     REPO_BASE = os.path.dirname(__file__)  # points to /tmp/slack-chatgpt-argocd
     script_path = os.path.join(REPO_BASE, 'run-command.py')
     args = ['python3', script_path, command]
-    result = subprocess.run(args, capture_output=True, text=True)
+    with command_slot(logger=logger):
+        result = subprocess.run(args, capture_output=True, text=True)
     try:
         return json.loads(result.stdout)
     except json.JSONDecodeError:
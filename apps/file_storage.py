@@ -1,13 +1,287 @@
 import os
+import gzip
 import json
-from datetime import datetime, timezone
+import fcntl
+import hashlib
+import itertools
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 
+# On-disk layout per thread:
+#   <thread_ts>.jsonl      append-only message log, one JSON message per line
+#   <thread_ts>.meta.json  small header: created_at, summary_index, reaction
+#   <thread_ts>.lock       lock file; every write to the thread holds an flock on it
+# Threads written by older versions live in a single <thread_ts>.json
+# document; they are read as-is and converted on their first write.
+#
+# Compaction (compact_thread) moves messages 1 .. summary_index-1, which the
+# LLM no longer sees once a summary exists, into gzip cold segments
+# <thread_ts>.cold-<start>-<end>.jsonl.gz. The hot log then starts with a
+# {"__compaction__": {...}} line listing the segments, followed by the
+# system message and the messages from summary_index on. Full reads stitch
+# the segments back in; summary-based reads never open them.
+#
+# Several workers, or pods sharing one volume, can write the same thread:
+# appends, header updates, legacy conversion and compaction all run under
+# the thread's lock, and every file other than the log is replaced
+# atomically (write to a temp file, fsync, rename). Readers take no lock;
+# they see either the old or the new file, and ignore a torn last log line
+# (one without its newline), which the next append cuts off.
+#
+# FS_LAYOUT decides which directory under FS_INDEX holds a thread's files:
+#   flat    FS_INDEX itself (the original layout)
+#   hashed  FS_INDEX/ab/cd/, from the SHA-1 of thread_ts (65536 shards)
+#   date    FS_INDEX/YYYY/MM/DD/, from the epoch in thread_ts (UTC);
+#           ids that aren't timestamps go to FS_INDEX/undated/ab/cd/
+# Threads still in another layout are found there and moved into the
+# configured one on their next write, or by migrate_layout(), which
+# flask_runner.start_pod_tasks runs in the background. Every writer must
+# use the same FS_LAYOUT.
 FS_INDEX = os.getenv("FS_INDEX", "file_index")
 os.makedirs(FS_INDEX, exist_ok=True)
+FS_LAYOUT = os.getenv("FS_LAYOUT", "flat").lower()
+LAYOUTS = ("flat", "hashed", "date")
+# Compact a thread when its summary leaves at least this many messages behind (0 = never)
+FS_COMPACT_MIN_MESSAGES = int(os.getenv("FS_COMPACT_MIN_MESSAGES", 20))
+FS_COMPACT_ON_SUMMARY = os.getenv("FS_COMPACT_ON_SUMMARY", "true").lower() == "true"
+# When writes reach the disk:
+#   always    fsync every write before returning
+#   batch     the same guarantee, but writers that arrive while an fsync is
+#             running share the next one (group commit); FS_FSYNC_BATCH_WINDOW_MS
+#             optionally waits that long for more writers to join
+#   interval  fsync in the background every FS_FSYNC_INTERVAL_MS; a power
+#             loss can lose that much, an application crash loses nothing
+#   never     leave it to the OS
+FS_FSYNC = os.getenv("FS_FSYNC", "batch").lower()
+FS_FSYNC_BATCH_WINDOW_MS = float(os.getenv("FS_FSYNC_BATCH_WINDOW_MS", 0))
+FS_FSYNC_INTERVAL_MS = float(os.getenv("FS_FSYNC_INTERVAL_MS", 1000))
+
+LOG_SUFFIX = ".jsonl"
+META_SUFFIX = ".meta.json"
+LEGACY_SUFFIX = ".json"
+LOCK_SUFFIX = ".lock"
+COMPACTION_KEY = "__compaction__"
+
+
+def _hashed_shard(thread_ts):
+    digest = hashlib.sha1(thread_ts.encode("utf-8")).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+
+def _thread_day(thread_ts):
+    """The UTC day encoded in a Slack-style thread_ts, or None."""
+    try:
+        return datetime.fromtimestamp(float(thread_ts), timezone.utc).date()
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+def _layout_dir(thread_ts, layout=None):
+    layout = layout or FS_LAYOUT
+    if layout == "hashed":
+        return os.path.join(FS_INDEX, _hashed_shard(thread_ts))
+    if layout == "date":
+        day = _thread_day(thread_ts)
+        if day is None:
+            return os.path.join(FS_INDEX, "undated", _hashed_shard(thread_ts))
+        return os.path.join(FS_INDEX, f"{day:%Y}", f"{day:%m}", f"{day:%d}")
+    return FS_INDEX
+
+
+def _stored_in(directory, thread_ts):
+    return (os.path.exists(os.path.join(directory, f"{thread_ts}{LOG_SUFFIX}"))
+            or os.path.exists(os.path.join(directory, f"{thread_ts}{LEGACY_SUFFIX}")))
+
+
+# Threads known to be in their FS_LAYOUT directory. Threads only ever move
+# into that directory, so an entry never goes stale.
+_settled = {}
+_SETTLED_MAX = 65536
+
+
+def _settle(thread_ts):
+    if len(_settled) >= _SETTLED_MAX:
+        _settled.clear()
+    _settled[thread_ts] = True
+
+
+def _thread_dir(thread_ts):
+    """Directory holding the thread's files: its FS_LAYOUT directory, or wherever an older layout left it."""
+    home = _layout_dir(thread_ts)
+    if thread_ts in _settled:
+        return home
+    if _stored_in(home, thread_ts):
+        _settle(thread_ts)
+        return home
+    for layout in LAYOUTS:
+        directory = _layout_dir(thread_ts, layout)
+        if directory != home and _stored_in(directory, thread_ts):
+            return directory
+    return home
 
 
 def _get_file_path(thread_ts):
-    return os.path.join(FS_INDEX, f"{thread_ts}.json")
+    """Path of the legacy single-document thread file."""
+    return os.path.join(_thread_dir(thread_ts), f"{thread_ts}{LEGACY_SUFFIX}")
+
+
+def _log_path(thread_ts):
+    return os.path.join(_thread_dir(thread_ts), f"{thread_ts}{LOG_SUFFIX}")
+
+
+def _meta_path(thread_ts):
+    return os.path.join(_thread_dir(thread_ts), f"{thread_ts}{META_SUFFIX}")
+
+
+def _lock_path(thread_ts):
+    # Always in the FS_LAYOUT directory, so it doesn't move with the thread
+    return os.path.join(_layout_dir(thread_ts), f"{thread_ts}{LOCK_SUFFIX}")
+
+
+# flock is held per open file, so two threads of one process would each get
+# their own; they serialise on one of these first
+_local_locks = [threading.Lock() for _ in range(64)]
+
+
+def _acquire_lock_file(path, thread_ts):
+    """Open and flock the lock file; returns the descriptor."""
+    while True:
+        try:
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # First thread in this shard
+            os.makedirs(_layout_dir(thread_ts), exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        # delete_thread removes the lock file; a lock on a removed file excludes nobody
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd
+        except FileNotFoundError:
+            pass
+        os.close(fd)
+
+
+@contextmanager
+def _thread_lock(thread_ts):
+    """Exclusive write lock on one thread, across threads, processes and (via the shared volume) pods."""
+    with _local_locks[hash(thread_ts) % len(_local_locks)]:
+        fd = _acquire_lock_file(_lock_path(thread_ts), thread_ts)
+        try:
+            yield
+        finally:
+            # Closing the descriptor releases the flock
+            os.close(fd)
+
+
+def _fsync_path(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        # Replaced since it was written; its successor is synced on its own
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Syncer:
+    """Background fsync of the files written by this process, shared by concurrent writers."""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = set()
+        self._generation = 0
+        self._synced = -1
+        self._error = None
+        self._thread = None
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._loop, name="file-storage-fsync", daemon=True)
+        self._thread.start()
+
+    def sync(self, paths, wait):
+        """Queue paths for the next fsync round; with wait, return once it is done."""
+        with self._cond:
+            self._ensure_started()
+            self._pending.update(paths)
+            ticket = self._generation
+            self._cond.notify_all()
+            if not wait:
+                return
+            while self._synced < ticket:
+                self._cond.wait()
+            if self._error and self._error[0] == ticket:
+                raise self._error[1]
+
+    def _loop(self):
+        window = (FS_FSYNC_INTERVAL_MS if FS_FSYNC == "interval" else FS_FSYNC_BATCH_WINDOW_MS) / 1000
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+            if window:
+                # Let other writers join this round
+                time.sleep(window)
+            with self._cond:
+                paths, self._pending = self._pending, set()
+                generation = self._generation
+                self._generation += 1
+            error = None
+            for path in paths:
+                try:
+                    _fsync_path(path)
+                except OSError as e:
+                    error = e
+            with self._cond:
+                self._synced = generation
+                if error is not None:
+                    self._error = (generation, error)
+                self._cond.notify_all()
+
+
+_syncer = _Syncer()
+
+
+def _reset_after_fork():
+    global _local_locks, _syncer
+    # Locks held and the fsync thread running at fork time don't exist in the child
+    _local_locks = [threading.Lock() for _ in range(64)]
+    _syncer = _Syncer()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _sync(*paths, barrier=False):
+    """
+    Make paths durable according to FS_FSYNC. barrier=True syncs right away
+    in every mode but never (used before a rename, which must not overtake
+    the data).
+    """
+    if FS_FSYNC == "never":
+        return
+    if FS_FSYNC == "always" or barrier:
+        for path in paths:
+            _fsync_path(path)
+        return
+    _syncer.sync(paths, wait=FS_FSYNC == "batch")
+
+
+def _atomic_write(path, data):
+    """Replace path with data; readers see the old or the new file, never a partial one."""
+    tmp_path = f"{path}.tmp.{os.getpid()}.{threading.get_ident()}"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    _sync(tmp_path, barrier=True)
+    os.replace(tmp_path, path)
+    _sync(os.path.dirname(path) or ".")
 
 
 def ensure_index_exists(logger=None):
@@ -17,74 +291,522 @@ def ensure_index_exists(logger=None):
         logger.info(f"File index folder '{FS_INDEX}' ensured.")
 
 
+def _read_meta(thread_ts):
+    try:
+        with open(_meta_path(thread_ts), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_meta(thread_ts, meta):
+    _atomic_write(_meta_path(thread_ts), json.dumps(meta).encode("utf-8"))
+
+
+def _segment_path(thread_ts, name):
+    return os.path.join(os.path.dirname(_log_path(thread_ts)), name)
+
+
+def _compaction_header(line):
+    """The compaction record if line is the log's compaction header, else None."""
+    if line is None:
+        return None
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    if not line.startswith('{"' + COMPACTION_KEY):
+        return None
+    return json.loads(line)[COMPACTION_KEY]
+
+
+def _iter_cold(thread_ts, compaction, start, logger=None):
+    """
+    Yield (seq, message) from the cold segments, from seq start on. Like the
+    hot log, an unreadable line is skipped, and a truncated segment yields
+    what could be read of it.
+    """
+    for segment in compaction["segments"]:
+        if segment["end"] <= start:
+            continue
+        try:
+            with gzip.open(_segment_path(thread_ts, segment["file"]), "rt", encoding="utf-8") as f:
+                for seq, line in enumerate((l for l in f if l.strip()), segment["start"]):
+                    if seq < start:
+                        continue
+                    try:
+                        message = json.loads(line)
+                    except json.JSONDecodeError:
+                        if logger:
+                            logger.warning(f"Skipping unreadable line in cold segment {segment['file']}.")
+                        continue
+                    yield seq, message
+        except (EOFError, gzip.BadGzipFile, zlib.error) as e:
+            if logger:
+                logger.warning(f"Cold segment {segment['file']} of thread {thread_ts} is truncated: {e}")
+
+
+def _iter_messages(thread_ts, after_seq=None, cold=True, logger=None):
+    """
+    Yield (seq, message) in order from seq after_seq + 1 on. Lines before the
+    start are skipped unparsed; with cold=False compacted messages are
+    yielded as None instead of being read from their segments.
+    """
+    start = 0 if after_seq is None else after_seq + 1
+    with open(_log_path(thread_ts), "r", encoding="utf-8") as f:
+        lines = (line for line in f if line.strip() and line.endswith("\n"))
+        first = next(lines, None)
+        compaction = _compaction_header(first)
+        if compaction is None and first is not None:
+            lines = itertools.chain([first], lines)
+        seq = 0
+        for line in lines:
+            if seq >= start:
+                try:
+                    yield seq, json.loads(line)
+                except json.JSONDecodeError:
+                    # A damaged line keeps its seq, so the messages after it keep theirs
+                    if logger:
+                        logger.warning(f"Skipping unreadable line in thread {thread_ts} log.")
+            if compaction is not None and seq == 0:
+                # The cold range sits between the system message and the hot tail
+                upto = compaction["upto"]
+                if start < upto:
+                    if cold:
+                        yield from _iter_cold(thread_ts, compaction, max(start, 1), logger)
+                    else:
+                        for cold_seq in range(max(start, 1), upto):
+                            yield cold_seq, None
+                seq = upto
+            else:
+                seq += 1
+
+
+def _read_compaction(thread_ts):
+    with open(_log_path(thread_ts), "r", encoding="utf-8") as f:
+        return _compaction_header(f.readline())
+
+
+def _count_log_messages(thread_ts):
+    with open(_log_path(thread_ts), "rb") as f:
+        lines = (line for line in f if line.strip() and line.endswith(b"\n"))
+        first = next(lines, None)
+        if first is None:
+            return 0
+        compaction = _compaction_header(first)
+        if compaction is None:
+            return 1 + sum(1 for _ in lines)
+        return compaction["upto"] - 1 + sum(1 for _ in lines)
+
+
+def _torn_tail_start(path):
+    """Offset of the log's torn last line (an append cut short before its newline), or None."""
+    with open(path, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        if not end:
+            return None
+        f.seek(end - 1)
+        if f.read(1) == b"\n":
+            return None
+        pos = end
+        while pos > 0:
+            step = min(pos, 65536)
+            f.seek(pos - step)
+            newline = f.read(step).rfind(b"\n")
+            if newline != -1:
+                return pos - step + newline + 1
+            pos -= step
+        return 0
+
+
+def _relocate(thread_ts, logger=None):
+    """
+    Move a thread stored under another layout into its FS_LAYOUT directory.
+    Call with the thread lock held. Files are hard-linked into place before
+    the old names go, log last, so readers always find a complete thread.
+    """
+    source, target = _thread_dir(thread_ts), _layout_dir(thread_ts)
+    if source == target:
+        return
+    names = [f"{thread_ts}{META_SUFFIX}", f"{thread_ts}{LEGACY_SUFFIX}"]
+    if os.path.exists(os.path.join(source, f"{thread_ts}{LOG_SUFFIX}")):
+        compaction = _read_compaction(thread_ts)
+        names += [segment["file"] for segment in (compaction or {}).get("segments", [])]
+        names.append(f"{thread_ts}{LOG_SUFFIX}")
+    names = [name for name in names if os.path.exists(os.path.join(source, name))]
+    os.makedirs(target, exist_ok=True)
+    for name in names:
+        try:
+            os.link(os.path.join(source, name), os.path.join(target, name))
+        except FileExistsError:
+            # Left over from an interrupted move
+            os.replace(os.path.join(source, name), os.path.join(target, name))
+    _sync(target)
+    for name in reversed(names):
+        try:
+            os.remove(os.path.join(source, name))
+        except FileNotFoundError:
+            pass
+    _sync(source)
+    _settle(thread_ts)
+    if logger:
+        logger.debug(f"Thread {thread_ts} moved to the {FS_LAYOUT} layout.")
+
+
+def _prepare_write(thread_ts, logger=None):
+    """Bring the thread into the current layout and format. Call with the thread lock held."""
+    _relocate(thread_ts, logger)
+    _migrate_legacy(thread_ts, logger)
+
+
+def _migrate_legacy(thread_ts, logger=None):
+    """Convert a legacy <thread_ts>.json document into log + header. Call with the thread lock held."""
+    legacy_path = _get_file_path(thread_ts)
+    if os.path.exists(_log_path(thread_ts)) or not os.path.exists(legacy_path):
+        return
+    with open(legacy_path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+    messages = data.pop("messages", [])
+    _write_meta(thread_ts, data)
+    _atomic_write(_log_path(thread_ts), "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages).encode("utf-8"))
+    os.remove(legacy_path)
+    if logger:
+        logger.info(f"Thread {thread_ts} converted to the append-only log format.")
+
+
+def thread_exists(thread_ts):
+    return os.path.exists(_log_path(thread_ts)) or os.path.exists(_get_file_path(thread_ts))
+
+
+def thread_version(thread_ts):
+    """Cheap change marker for caches: identity, size and mtime of the thread's files."""
+    version = []
+    for path in (_log_path(thread_ts), _meta_path(thread_ts), _get_file_path(thread_ts)):
+        try:
+            st = os.stat(path)
+            version.append((st.st_ino, st.st_size, st.st_mtime_ns))
+        except FileNotFoundError:
+            version.append(None)
+    return tuple(version)
+
+
+def _period(parts):
+    """Start and end of the day, month or year named by a date-layout shard path."""
+    numbers = [int(part) for part in parts]
+    year, month, day = (numbers + [1, 1])[:3]
+    start = datetime(year, month, day, tzinfo=timezone.utc)
+    if len(numbers) >= 3:
+        return start, start + timedelta(days=1)
+    if len(numbers) == 2:
+        return start, datetime(year + month // 12, month % 12 + 1, 1, tzinfo=timezone.utc)
+    return start, datetime(year + 1, 1, 1, tzinfo=timezone.utc)
+
+
+def _shard_dirs(directory, parts, created_after, created_before):
+    for entry in sorted(os.scandir(directory), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        path = parts + [entry.name]
+        if path[0].isdigit() and len(path[0]) == 4:
+            # A date shard: skip the whole year, month or day when it is out of range
+            try:
+                start, end = _period(path)
+            except ValueError:
+                continue
+            if (created_before and start >= created_before) or (created_after and end <= created_after):
+                continue
+        yield entry.path
+        yield from _shard_dirs(entry.path, path, created_after, created_before)
+
+
+def _scan(created_after=None, created_before=None):
+    """Yield (directory, thread_ts) for every stored thread, in any layout."""
+    for directory in [FS_INDEX, *_shard_dirs(FS_INDEX, [], created_after, created_before)]:
+        for name in os.listdir(directory):
+            if name.endswith(LOG_SUFFIX):
+                thread_ts = name[:-len(LOG_SUFFIX)]
+            elif name.endswith(LEGACY_SUFFIX) and not name.endswith(META_SUFFIX):
+                thread_ts = name[:-len(LEGACY_SUFFIX)]
+            else:
+                continue
+            if created_after or created_before:
+                try:
+                    created = datetime.fromtimestamp(float(thread_ts), timezone.utc)
+                except (ValueError, OverflowError, OSError):
+                    continue
+                if (created_after and created < created_after) or (created_before and created >= created_before):
+                    continue
+            yield directory, thread_ts
+
+
+def list_threads(created_after=None, created_before=None):
+    """
+    Return the ids of all stored threads, in either format and any layout.
+    created_after / created_before (aware datetimes) keep only threads whose
+    thread_ts falls in that range; the date layout skips whole shards for it.
+    """
+    return sorted({thread_ts for _, thread_ts in _scan(created_after, created_before)})
+
+
+def migrate_layout(logger=None):
+    """Move every thread not yet in its FS_LAYOUT directory there. Returns how many were moved."""
+    moved = 0
+    for directory, thread_ts in list(_scan()):
+        if directory == _layout_dir(thread_ts):
+            continue
+        with _thread_lock(thread_ts):
+            if _thread_dir(thread_ts) != _layout_dir(thread_ts):
+                _relocate(thread_ts, logger)
+                moved += 1
+    if logger:
+        logger.info(f"Moved {moved} thread(s) to the {FS_LAYOUT} layout.")
+    return moved
+
+
 def update_file_storage(thread_ts, role, content, logger=None):
-    """Update or create a JSON file for the given thread_ts."""
-    file_path = _get_file_path(thread_ts)
-    new_message = {"role": role, "content": content}
-
-    if os.path.exists(file_path):
-        with open(file_path, "r+", encoding="utf-8") as f:
-            data = json.load(f)
-            data["messages"].append(new_message)
-            f.seek(0)
-            json.dump(data, f, indent=2)
-            f.truncate()
-        if logger:
-            logger.info(f"Thread {thread_ts} updated with message from {role}.")
+    """Append a message to the thread, creating it if needed."""
+    append_messages(thread_ts, [{"role": role, "content": content}], logger)
+
+
+def append_messages(thread_ts, messages, logger=None):
+    """Append a batch of messages to the thread log; O(batch) regardless of thread length."""
+    roles = ", ".join(m.get("role", "") for m in messages)
+    lines = "".join(json.dumps(m, ensure_ascii=False) + "\n" for m in messages)
+    with _thread_lock(thread_ts):
+        _prepare_write(thread_ts, logger)
+        is_new = not os.path.exists(_log_path(thread_ts))
+        if is_new:
+            _write_meta(thread_ts, {"created_at": datetime.now(timezone.utc).isoformat()})
+        with open(_log_path(thread_ts), "ab") as f:
+            # Cut off what an interrupted append left: its batch was never acknowledged, and
+            # left in the middle of the log the torn line would still take up a seq
+            torn = _torn_tail_start(f.name) if f.tell() else None
+            if torn is not None:
+                f.truncate(torn)
+                if logger:
+                    logger.warning(f"Removed a torn last line from thread {thread_ts} log.")
+            f.write(lines.encode("utf-8"))
+    # Outside the lock, so other writers of the thread don't wait for the disk
+    if is_new:
+        _sync(_log_path(thread_ts), _layout_dir(thread_ts))
     else:
-        data = {
-            "messages": [new_message],
-            "created_at": datetime.now(timezone.utc).isoformat()
-        }
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
-        if logger:
-            logger.info(f"New thread {thread_ts} created with message from {role}.")
+        _sync(_log_path(thread_ts))
 
+    if logger:
+        if is_new:
+            logger.info(f"New thread {thread_ts} created with {len(messages)} message(s) from {roles}.")
+        else:
+            logger.info(f"Thread {thread_ts} updated with {len(messages)} message(s) from {roles}.")
 
-def set_summary_index(thread_ts, logger=None):
-    """Set the summary_index field in the file."""
-    file_path = _get_file_path(thread_ts)
-    if not os.path.exists(file_path):
-        if logger:
-            logger.warning(f"File {file_path} not found.")
-        return False
 
-    with open(file_path, "r+", encoding="utf-8") as f:
-        data = json.load(f)
-        messages = data.get("messages", [])
-        if not messages:
+def load_thread(thread_ts, logger=None, hot_only=False):
+    """
+    Return the whole thread document (messages, summary_index, ...) or None.
+    hot_only=True leaves compacted messages as None placeholders instead of
+    reading the cold segments (marked with "hot_only": True in the result).
+    """
+    if os.path.exists(_log_path(thread_ts)):
+        data = _read_meta(thread_ts)
+        data["messages"] = [m for _, m in _iter_messages(thread_ts, cold=not hot_only, logger=logger)]
+        compaction = _read_compaction(thread_ts)
+        if compaction is not None:
+            data["compacted_upto"] = compaction["upto"]
+            if hot_only:
+                data["hot_only"] = True
+        return data
+    legacy_path = _get_file_path(thread_ts)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return None
+
+
+def _last_write(*paths):
+    """updated_at of a thread: the newest mtime of its files (every write touches the log or the header)."""
+    mtimes = []
+    for path in paths:
+        try:
+            mtimes.append(os.stat(path).st_mtime)
+        except FileNotFoundError:
+            pass
+    return datetime.fromtimestamp(max(mtimes), timezone.utc).isoformat() if mtimes else None
+
+
+def load_header(thread_ts):
+    """The thread's header fields plus message_count and updated_at, without its messages, or None."""
+    if os.path.exists(_log_path(thread_ts)):
+        header = _read_meta(thread_ts)
+        header["message_count"] = _count_log_messages(thread_ts)
+        header["updated_at"] = _last_write(_log_path(thread_ts), _meta_path(thread_ts)) or header.get("created_at")
+        return header
+    legacy_path = _get_file_path(thread_ts)
+    if os.path.exists(legacy_path):
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            header = json.load(f)
+        header["message_count"] = len(header.pop("messages", []))
+        header["updated_at"] = _last_write(legacy_path) or header.get("created_at")
+        return header
+    return None
+
+
+def iter_messages(thread_ts, after_seq=None, logger=None):
+    """Yield the messages with seq > after_seq (all when None), reading the log through once."""
+    if not os.path.exists(_log_path(thread_ts)):
+        yield from read_messages(thread_ts, after_seq, logger=logger)
+        return
+    for _, message in _iter_messages(thread_ts, after_seq, logger=logger):
+        yield message
+
+
+def read_messages(thread_ts, after_seq=None, limit=None, logger=None):
+    """Messages with seq > after_seq (all when None), at most limit of them; skipped lines are not parsed."""
+    if not os.path.exists(_log_path(thread_ts)):
+        messages = (load_thread(thread_ts, logger) or {}).get("messages", [])
+        start = 0 if after_seq is None else after_seq + 1
+        return messages[start:start + limit] if limit is not None else messages[start:]
+    return [m for _, m in itertools.islice(_iter_messages(thread_ts, after_seq, logger=logger), limit)]
+
+
+def compact_thread(thread_ts, logger=None, min_messages=None):
+    """
+    Move the messages between the system message and summary_index into a
+    new gzip cold segment. Returns how many messages were moved.
+    """
+    min_messages = FS_COMPACT_MIN_MESSAGES if min_messages is None else min_messages
+    if min_messages <= 0 or not os.path.exists(_log_path(thread_ts)):
+        return 0
+    with _thread_lock(thread_ts):
+        _prepare_write(thread_ts, logger)
+        return _compact_locked(thread_ts, min_messages, logger)
+
+
+def _compact_locked(thread_ts, min_messages, logger=None):
+    summary_index = _read_meta(thread_ts).get("summary_index")
+    if not isinstance(summary_index, int):
+        return 0
+
+    log_path = _log_path(thread_ts)
+    with open(log_path, "rb") as f:
+        data = f.read()
+    if not data.endswith(b"\n"):
+        # Let a torn last line be dealt with by the next append first
+        return 0
+    lines = [line for line in data.split(b"\n") if line.strip()]
+    compaction = _compaction_header(lines[0])
+    if compaction is None:
+        compaction = {"upto": 1, "segments": []}
+        system, tail = lines[:1], lines[1:]
+    else:
+        system, tail = lines[1:2], lines[2:]
+    start = compaction["upto"]
+    end = min(summary_index, start + len(tail))
+    if end - start < min_messages:
+        return 0
+
+    name = f"{thread_ts}.cold-{start:09d}-{end:09d}.jsonl.gz"
+    # The segment is in place before the log that points at it
+    _atomic_write(_segment_path(thread_ts, name), gzip.compress(b"\n".join(tail[:end - start]) + b"\n"))
+    header = {COMPACTION_KEY: {"upto": end, "segments": compaction["segments"] + [{"file": name, "start": start, "end": end}]}}
+    _atomic_write(log_path, json.dumps(header).encode("utf-8") + b"\n"
+                  + b"".join(line + b"\n" for line in system + tail[end - start:]))
+    if logger:
+        logger.info(f"Compacted {end - start} message(s) of thread {thread_ts} into {name}.")
+    return end - start
+
+
+def compact_all(logger=None, min_messages=None):
+    """Run compact_thread over every stored thread; returns the number of messages moved."""
+    return sum(compact_thread(thread_ts, logger, min_messages) for thread_ts in list_threads())
+
+
+def delete_thread(thread_ts, logger=None):
+    """
+    Remove every file of the thread (log, header, cold segments, legacy
+    document, lock), in whichever layout it is stored. The log goes first,
+    so readers stop seeing the thread at once. Returns whether it existed.
+    """
+    with _thread_lock(thread_ts):
+        removed = False
+        for directory in dict.fromkeys(_layout_dir(thread_ts, layout) for layout in LAYOUTS):
+            log_path = os.path.join(directory, f"{thread_ts}{LOG_SUFFIX}")
+            names = [f"{thread_ts}{LOG_SUFFIX}"]
+            try:
+                with open(log_path, "r", encoding="utf-8") as f:
+                    compaction = _compaction_header(f.readline())
+                names += [segment["file"] for segment in (compaction or {}).get("segments", [])]
+            except FileNotFoundError:
+                pass
+            names += [f"{thread_ts}{META_SUFFIX}", f"{thread_ts}{LEGACY_SUFFIX}"]
+            found = False
+            for name in names:
+                try:
+                    os.remove(os.path.join(directory, name))
+                    found = True
+                except FileNotFoundError:
+                    pass
+            if found:
+                _sync(directory)
+                removed = True
+        try:
+            # Still holding the flock; writers waiting on it see the file is gone and reopen
+            os.remove(_lock_path(thread_ts))
+        except FileNotFoundError:
+            pass
+    if logger and removed:
+        logger.info(f"Thread {thread_ts} deleted.")
+    return removed
+
+
+def set_summary_index(thread_ts, logger=None, summary_index=None):
+    """Set the summary_index field in the header (default: the last message)."""
+    with _thread_lock(thread_ts):
+        _prepare_write(thread_ts, logger)
+        if not os.path.exists(_log_path(thread_ts)):
             if logger:
-                logger.warning(f"No messages in thread {thread_ts}.")
+                logger.warning(f"Thread {thread_ts} not found.")
             return False
-        summary_index = len(messages) - 1
-        data["summary_index"] = summary_index
-        f.seek(0)
-        json.dump(data, f, indent=2)
-        f.truncate()
+
+        if summary_index is None:
+            count = _count_log_messages(thread_ts)
+            if not count:
+                if logger:
+                    logger.warning(f"No messages in thread {thread_ts}.")
+                return False
+            summary_index = count - 1
+        meta = _read_meta(thread_ts)
+        meta["summary_index"] = summary_index
+        _write_meta(thread_ts, meta)
     if logger:
         logger.info(f"summary_index set to {summary_index} for thread {thread_ts}.")
+    if FS_COMPACT_ON_SUMMARY:
+        try:
+            compact_thread(thread_ts, logger)
+        except Exception as e:
+            if logger:
+                logger.warning(f"Compaction of thread {thread_ts} failed: {e}")
     return True
 
 
 def get_thread_messages(thread_ts, logger=None):
     """Retrieve conversation messages for a given thread_ts."""
-    file_path = _get_file_path(thread_ts)
     save_token_use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
 
-    if not os.path.exists(file_path):
+    data = load_thread(thread_ts, logger, hot_only=save_token_use_summary)
+    if data is None:
         if logger:
             logger.info(f"Thread {thread_ts} not found.")
         return []
 
-    with open(file_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
     messages = data.get("messages", [])
     if not save_token_use_summary:
         return messages
+    context = _summary_context(thread_ts, messages, data.get("summary_index"), logger)
+    if data.get("hot_only") and None in context:
+        # summary_index was moved back into the compacted range
+        context = _summary_context(thread_ts, load_thread(thread_ts, logger)["messages"],
+                                   data.get("summary_index"), logger)
+    return context
 
-    summary_index = data.get("summary_index")
+
+def _summary_context(thread_ts, messages, summary_index, logger=None):
     if summary_index is None or summary_index >= len(messages):
         if logger:
             logger.warning(f"No valid summary_index for {thread_ts}.")
@@ -99,29 +821,49 @@ def get_thread_messages(thread_ts, logger=None):
 
 
 def update_reaction(thread_ts, reaction, logger=None):
-    """Update the reaction field in the file."""
-    file_path = _get_file_path(thread_ts)
-    if not os.path.exists(file_path):
-        if logger:
-            logger.warning(f"Thread {thread_ts} not found.")
-        return False
+    """Update the reaction field in the header."""
+    with _thread_lock(thread_ts):
+        _prepare_write(thread_ts, logger)
+        if not os.path.exists(_log_path(thread_ts)):
+            if logger:
+                logger.warning(f"Thread {thread_ts} not found.")
+            return False
 
-    with open(file_path, "r+", encoding="utf-8") as f:
-        data = json.load(f)
-        data["reaction"] = reaction
-        f.seek(0)
-        json.dump(data, f, indent=2)
-        f.truncate()
+        meta = _read_meta(thread_ts)
+        meta["reaction"] = reaction
+        _write_meta(thread_ts, meta)
     if logger:
         logger.info(f"Reaction updated for thread {thread_ts}.")
     return True
 
+def set_created_at(thread_ts, created_at, logger=None):
+    """Overwrite created_at in the header (used when threads are copied from another backend)."""
+    with _thread_lock(thread_ts):
+        _prepare_write(thread_ts, logger)
+        if not os.path.exists(_log_path(thread_ts)):
+            if logger:
+                logger.warning(f"Thread {thread_ts} not found.")
+            return False
+        meta = _read_meta(thread_ts)
+        meta["created_at"] = created_at
+        _write_meta(thread_ts, meta)
+    return True
+
 def main():
+    import sys
     import logging
 
     logging.basicConfig(level=logging.INFO)
     logger = logging.getLogger("FileStorageTest")
 
+    if sys.argv[1:] == ["compact"]:
+        # Compact every thread whose summary has left enough messages behind
+        logger.info(f"Moved {compact_all(logger)} message(s) to cold segments.")
+        return
+    if sys.argv[1:] == ["migrate-layout"]:
+        migrate_layout(logger)
+        return
+
     thread_ts = "1234567890.123456"
     role = "user"
     content = "Hello from file storage!"
@@ -143,9 +885,7 @@ def main():
     update_reaction(thread_ts, "👍", logger)
 
     # Verify full document content
-    file_path = os.path.join(FS_INDEX, f"{thread_ts}.json")
-    with open(file_path, "r", encoding="utf-8") as f:
-        logger.info(f"Final content of {file_path}:\n{f.read()}")
+    logger.info(f"Final content of thread {thread_ts}:\n{json.dumps(load_thread(thread_ts, logger), indent=2)}")
 
 if __name__ == "__main__":
     main()
@@ -5,11 +5,26 @@ import json
 import os
 import time
 import threading
+import hashlib
+import hmac
+import fcntl
+from datetime import datetime, timezone
 #from flask import Flask, request, jsonify  # Import again after installation
 from flask import Flask, request, Response, jsonify, abort
+from werkzeug.exceptions import HTTPException
 from argocd_auth import authenticate_with_argocd # to keep the argocd token fresh
 import git_config
 from new_webhook_handler import webhook_handler
+from job_queue import get_job, job_stats, get_job_queue
+from generic_storage import ensure_index_exists, invalidate_thread, thread_cache_stats
+import file_storage
+import generic_storage
+import thread_catalog
+import blob_store
+import retention
+from dedup import dedup_stats
+from admission import admission_stats
+import replication
 #from argocd_flow import process_prompt
 
 app = Flask(__name__)
@@ -40,15 +55,75 @@ def auth_loop():
         logging.info("Running Argo CD login...")
         authenticate_with_argocd()
         time.sleep(86400)
-        
-if os.getenv("GIT_USER_EMAIL"):
-    git_config.setup_git()
+
+_worker_ready = False
+# Pod-local lock file; the worker holding it runs the pod-wide background threads
+POD_TASKS_LOCK = os.getenv("POD_TASKS_LOCK", "/tmp/argonaut-pod-tasks.lock")
+_pod_tasks_fd = None
+
+def init_pod():
+    """One-time setup: git config and the file index.
+
+    Runs once per pod, in the dev server process or in the gunicorn master
+    before workers are forked (see gunicorn.conf.py). It starts no threads:
+    threads don't survive the fork.
+    """
+    if os.getenv("GIT_USER_EMAIL"):
+        git_config.setup_git()
+    os.makedirs(FS_INDEX, exist_ok=True)
+
+def start_pod_tasks():
+    """Pod-wide background threads: the Argo CD login loop, the thread catalog backfill, the file layout migration and the retention sweeper."""
+    auth_thread = threading.Thread(target=auth_loop, daemon=True)
+    auth_thread.start()
+    threading.Thread(target=thread_catalog.backfill_if_needed, args=(app.logger,), daemon=True).start()
+    if "file_storage" in generic_storage.STORAGE_BACKENDS and file_storage.FS_LAYOUT != "flat":
+        # Online move of threads left in another directory layout; writes move them on demand too
+        threading.Thread(target=file_storage.migrate_layout, args=(app.logger,), daemon=True).start()
+    # Deletes threads past their retention period (no-op unless RETENTION_DAYS / RETENTION_RULES set one)
+    retention.start(app.logger)
+
+def _claim_pod_tasks():
+    """
+    Wait for the flock on POD_TASKS_LOCK, then run start_pod_tasks(). Exactly
+    one worker holds it; when that worker exits the lock is released and a
+    waiting worker takes over.
+    """
+    global _pod_tasks_fd
+    # Held (never closed) for the life of the process
+    _pod_tasks_fd = os.open(POD_TASKS_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(_pod_tasks_fd, fcntl.LOCK_EX)
+    app.logger.info("Worker %s runs the pod-wide background tasks", os.getpid())
+    start_pod_tasks()
+
+def init_worker():
+    """Per-process startup: storage bootstrap, job workers and the pod task claim, then mark ready."""
+    global _worker_ready
+    ensure_index_exists(app.logger)
+    get_job_queue(app.logger)._ensure_started()
+    replication.start(app.logger)
+    threading.Thread(target=_claim_pod_tasks, name="pod-tasks", daemon=True).start()
+    _worker_ready = True
+    app.logger.info("Worker %s ready", os.getpid())
 
 # Return 400 for any other route
 @app.errorhandler(404)
 def page_not_found(e):
     return jsonify({"error": "Bad Request"}), 400
 
+@app.route('/healthz', methods=['GET'])
+def healthz():
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz():
+    """Report whether this worker finished its startup work."""
+    if not _worker_ready:
+        return jsonify({"status": "starting", "pid": os.getpid()}), 503
+    return jsonify({"status": "ready", "pid": os.getpid()})
+
+
 @app.route('/webhook', methods=['POST'])
 def webhook():
     data = request.get_json()
@@ -57,6 +132,23 @@ def webhook():
     return webhook_handler(request, app.logger)
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Return the status and timings of a queued webhook job."""
+    job = get_job(job_id)
+    if job is None:
+        abort(404, description=f"Job {job_id} not found")
+    return jsonify(job.to_dict())
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Return job queue, dedup, admission, thread cache, replication, blob store and retention statistics."""
+    return jsonify({"jobs": job_stats(), "dedup": dedup_stats(), "admission": admission_stats(),
+                    "thread_cache": thread_cache_stats(), "replication": replication.replication_stats(),
+                    "blobs": blob_store.blob_stats(), "retention": retention.retention_stats()})
+
+
 @app.route('/run-command', methods=['POST'])
 def run_command_endpoint():
     app.logger.info("🔔 /run-command endpoint hit")
@@ -109,36 +201,149 @@ def run_command_endpoint():
         app.logger.exception(f"🔥 Exception occurred: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
-FS_INDEX = os.getenv("FS_INDEX", "/argonaut/file_storage")
+FS_INDEX = file_storage.FS_INDEX
 
 
 @app.route("/threads", methods=["GET"])
 def list_threads():
-    """Return a list of available thread_ts documents (filenames without extension)."""
+    """
+    Page through the thread catalog, newest activity first.
+
+    Query parameters: limit, cursor (next_cursor of the previous page),
+    sort (last_activity, created_at, message_count, thread_ts), order
+    (asc, desc), channel, user, io_type, reaction, active_since, active_before.
+    """
+    args = request.args
     try:
-        threads = [f.removesuffix(".json") for f in os.listdir(FS_INDEX) if f.endswith(".json")]
-        return jsonify({"threads": threads})
+        threads, next_cursor = thread_catalog.list_threads(
+            sort=args.get("sort", "last_activity"),
+            order=args.get("order", "desc"),
+            limit=args.get("limit"),
+            cursor=args.get("cursor"),
+            active_since=args.get("active_since"),
+            active_before=args.get("active_before"),
+            **{field: args.get(field) for field in thread_catalog.FILTER_FIELDS},
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    return jsonify({"threads": threads, "next_cursor": next_cursor})
+
+
+def _thread_validators(thread_ts):
+    """ETag (from the primary backend's thread version) and Last-Modified (from the catalog)."""
+    version = generic_storage.thread_version(thread_ts)
+    etag = hashlib.sha1(f"{thread_ts}|{version!r}|{request.query_string.decode()}".encode()).hexdigest()
+    last_modified = None
+    row = thread_catalog.get_thread(thread_ts)
+    if row and row.get("last_activity"):
+        changed = datetime.fromisoformat(row["last_activity"])
+        # HTTP dates have one-second resolution; leave Last-Modified out until the
+        # second is over, or a later change in that second could be answered with 304
+        if (datetime.now(timezone.utc) - changed).total_seconds() >= 1:
+            last_modified = changed.replace(microsecond=0)
+    return etag, last_modified
+
+
+def _not_modified(etag, last_modified):
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return bool(last_modified and request.if_modified_since and last_modified <= request.if_modified_since)
 
 
 @app.route("/threads/<thread_ts>", methods=["GET"])
 def get_thread(thread_ts):
-    """Return the JSON content of a specific thread."""
-    file_path = os.path.join(FS_INDEX, f"{thread_ts}.json")
-    if not os.path.exists(file_path):
-        abort(404, description=f"Thread {thread_ts} not found")
+    """
+    Return the JSON content of a specific thread.
+
+    With ?since=N (N = number of messages the caller already has) and/or
+    ?limit=M only those messages are read and sent, as
+    {"thread_ts", "since", "messages", "next_since"}. Responses carry an
+    ETag and Last-Modified; a matching If-None-Match / If-Modified-Since
+    gets a 304 without reading the thread. Unknown threads are a 404.
+
+    Large command outputs are returned as [argonaut-blob ...] references,
+    fetchable from /blobs/<sha256>; ?resolve=true inlines them instead.
+    """
+    try:
+        since = int(request.args.get("since", 0))
+        limit = int(request.args["limit"]) if "limit" in request.args else None
+    except ValueError:
+        return jsonify({"error": "since and limit must be integers"}), 400
+    if since < 0 or (limit is not None and limit <= 0):
+        return jsonify({"error": "since must be >= 0 and limit > 0"}), 400
+    resolve = request.args.get("resolve", "false").lower() == "true"
 
     try:
-        with open(file_path, "r", encoding="utf-8") as f:
-            data = json.load(f)
-        return jsonify(data)
+        # Before the validators: an unknown thread's ETag would match a client's copy of the empty thread
+        if not generic_storage.thread_exists(thread_ts):
+            return jsonify({"error": f"Thread {thread_ts} not found"}), 404
+        etag, last_modified = _thread_validators(thread_ts)
+        if _not_modified(etag, last_modified):
+            response = Response(status=304)
+        else:
+            if since or limit is not None:
+                messages = generic_storage.read_messages(thread_ts, since, limit, app.logger)
+                response = jsonify({"thread_ts": thread_ts, "since": since,
+                                    "messages": blob_store.resolve_messages(messages, app.logger) if resolve else messages,
+                                    "next_since": since + len(messages)})
+            else:
+                doc = generic_storage.load_thread(thread_ts, app.logger)
+                if resolve:
+                    doc = {**doc, "messages": blob_store.resolve_messages(doc.get("messages", []), app.logger)}
+                response = jsonify(doc)
+    except HTTPException:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.route("/blobs/<digest>", methods=["GET"])
+def get_blob(digest):
+    """Return one stored command output. Blobs never change, so they may be cached for good."""
+    if not blob_store.DIGEST_RE.fullmatch(digest):
+        return jsonify({"error": "digest must be a sha256 hex string"}), 400
+    if request.if_none_match.contains(digest):
+        response = Response(status=304)
+    else:
+        text = blob_store.get(digest)
+        if text is None:
+            abort(404, description=f"Blob {digest} not found")
+        response = Response(text, mimetype="text/plain; charset=utf-8")
+    response.set_etag(digest)
+    response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+    return response
+
+# Shared secret for the internal endpoints, sent as "Authorization: Bearer <token>".
+# Unset: they only answer callers on this host.
+INTERNAL_API_TOKEN = os.getenv("INTERNAL_API_TOKEN")
+_LOOPBACK_ADDRS = ("127.0.0.1", "::1")
+
+
+def _internal_caller():
+    if INTERNAL_API_TOKEN:
+        scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+        return scheme.lower() == "bearer" and hmac.compare_digest(token.encode(), INTERNAL_API_TOKEN.encode())
+    return request.remote_addr in _LOOPBACK_ADDRS
+
+
+@app.route("/threads/<thread_ts>/invalidate", methods=["POST"])
+def invalidate_cached_thread(thread_ts):
+    """Drop a thread from this worker's thread cache ("*" drops all of them). Internal callers only."""
+    if not _internal_caller():
+        app.logger.warning("Refused cache invalidation for %s from %s", thread_ts, request.remote_addr)
+        return jsonify({"error": "Forbidden"}), 403
+    dropped = invalidate_thread(None if thread_ts == "*" else thread_ts, app.logger)
+    return jsonify({"invalidated": dropped, "pid": os.getpid()})
 
 if __name__ == '__main__':
-    os.makedirs(FS_INDEX, exist_ok=True)
-    auth_thread = threading.Thread(target=auth_loop, daemon=True)
-    auth_thread.start()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    # Development server. In production run: gunicorn -c gunicorn.conf.py flask_runner:app
+    init_pod()
+    init_worker()
+    app.run(host='0.0.0.0', port=int(os.getenv("PORT", 5000)), debug=True, use_reloader=False)
 
@@ -3,45 +3,375 @@ import os
 # Import both storage backends
 import file_storage
 import elastic  # Make sure this is your elastic.py module
+import elastic_messages
+import sqlite_storage
+import conversation_context
+import replication
+import thread_catalog
+import blob_store
+from thread_cache import get_thread_cache, THREAD_CACHE_VALIDATE
 
+# Every backend this module can dispatch to
+BACKENDS = ("file_storage", "elasticsearch", "elasticsearch_messages", "sqlite")
 STORAGE_BACKENDS = os.getenv("STORAGE_BACKENDS", "file_storage").split(",")
+# Reads and synchronous writes go to the primary; the other backends are
+# secondaries, fed asynchronously through the replication outbox unless
+# STORAGE_REPLICATION=sync (write every backend on the request path).
+STORAGE_PRIMARY = os.getenv("STORAGE_PRIMARY") or STORAGE_BACKENDS[0]
+STORAGE_REPLICATION = os.getenv("STORAGE_REPLICATION", "async").lower()
+SECONDARY_BACKENDS = [b for b in STORAGE_BACKENDS if b != STORAGE_PRIMARY]
+
+_cache = get_thread_cache()
 
 def ensure_index_exists(logger=None):
-    for backend in STORAGE_BACKENDS:
-        if backend == "file_storage":
-            file_storage.ensure_index_exists(logger)
-        elif backend == "elasticsearch":
-            elastic.ensure_index_exists(logger)
+    for backend in [STORAGE_PRIMARY] + SECONDARY_BACKENDS:
+        ensure_index_exists_on(backend, logger)
+
+def ensure_index_exists_on(backend, logger=None):
+    if backend == "file_storage":
+        file_storage.ensure_index_exists(logger)
+    elif backend == "elasticsearch":
+        elastic.ensure_index_exists(logger)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.ensure_index_exists(logger)
+    elif backend == "sqlite":
+        sqlite_storage.ensure_index_exists(logger)
+
+def _thread_version(thread_ts):
+    """Version of the thread in the primary backend, used to validate cache hits."""
+    backend = STORAGE_PRIMARY
+    if backend == "file_storage":
+        return file_storage.thread_version(thread_ts)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.thread_version_es(es, thread_ts)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.thread_version(thread_ts)
+    elif backend == "sqlite":
+        return sqlite_storage.thread_version(thread_ts)
+    return None
+
+def _write_through(thread_ts, version_before, mutate):
+    """
+    Apply a write we just made to the cached thread. If the backend had moved
+    on since the entry was cached (another worker or replica wrote), the entry
+    is dropped instead so the next read reloads it.
+    """
+    if not _cache.enabled:
+        return
+    if not THREAD_CACHE_VALIDATE:
+        _cache.update(thread_ts, mutate)
+    elif _cache.version(thread_ts) != version_before:
+        _cache.invalidate(thread_ts)
+    else:
+        _cache.update(thread_ts, mutate, _thread_version(thread_ts))
+
+def _version_before_write(thread_ts):
+    if _cache.enabled and THREAD_CACHE_VALIDATE and thread_ts in _cache:
+        return _thread_version(thread_ts)
+    return None
 
 def update_message(thread_ts, role, content, logger=None):
-    for backend in STORAGE_BACKENDS:
-        if backend == "file_storage":
-            file_storage.update_file_storage(thread_ts, role, content, logger)
-        elif backend == "elasticsearch":
-            es = elastic.get_es_client()
-            elastic.update_elasticsearch(es, thread_ts, role, content, logger)
-
-def set_summary_index(thread_ts, logger=None):
-    for backend in STORAGE_BACKENDS:
-        if backend == "file_storage":
-            file_storage.set_summary_index(thread_ts, logger)
-        elif backend == "elasticsearch":
-            es = elastic.get_es_client()
-            elastic.set_summary_index_es(es, thread_ts, logger)
+    ctx = conversation_context.current_context(thread_ts)
+    if ctx is not None:
+        ctx.append(role, content)
+        return
+    append_messages(thread_ts, [{"role": role, "content": content}], logger)
+
+def _append_to(backend, thread_ts, messages, logger=None):
+    if backend == "file_storage":
+        file_storage.append_messages(thread_ts, messages, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        elastic.append_messages_es(es, thread_ts, messages, logger)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.append_messages(thread_ts, messages, logger)
+    elif backend == "sqlite":
+        sqlite_storage.append_messages(thread_ts, messages, logger)
+
+def _set_summary_index_on(backend, thread_ts, logger=None, summary_index=None):
+    if backend == "file_storage":
+        file_storage.set_summary_index(thread_ts, logger, summary_index=summary_index)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        elastic.set_summary_index_es(es, thread_ts, logger, summary_index=summary_index)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.set_summary_index(thread_ts, logger, summary_index=summary_index)
+    elif backend == "sqlite":
+        sqlite_storage.set_summary_index(thread_ts, logger, summary_index=summary_index)
+
+def _update_reaction_on(backend, thread_ts, reaction, logger=None):
+    if backend == "file_storage":
+        file_storage.update_reaction(thread_ts, reaction, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        elastic.update_reaction(es, os.getenv("es_index"), thread_ts, reaction, logger)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.update_reaction(thread_ts, reaction, logger)
+    elif backend == "sqlite":
+        sqlite_storage.update_reaction(thread_ts, reaction, logger)
+
+def _set_created_at_on(backend, thread_ts, created_at, logger=None):
+    if backend == "file_storage":
+        file_storage.set_created_at(thread_ts, created_at, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        elastic.set_created_at_es(es, thread_ts, created_at, logger)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.set_created_at(thread_ts, created_at, logger)
+    elif backend == "sqlite":
+        sqlite_storage.set_created_at(thread_ts, created_at, logger)
+
+def delete_threads_on(backend, thread_ids, logger=None):
+    """Delete whole threads from one backend only (no catalog, cache or replication)."""
+    if backend == "file_storage":
+        for thread_ts in thread_ids:
+            file_storage.delete_thread(thread_ts, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        elastic.delete_threads_es(es, thread_ids, logger)
+    elif backend == "elasticsearch_messages":
+        elastic_messages.delete_threads(thread_ids, logger)
+    elif backend == "sqlite":
+        sqlite_storage.delete_threads(thread_ids, logger)
+
+def apply_write(backend, op, thread_ts, payload, logger=None):
+    """Apply one recorded change to one backend (used by the replication outbox)."""
+    if op == "append":
+        _append_to(backend, thread_ts, payload["messages"], logger)
+    elif op == "summary_index":
+        _set_summary_index_on(backend, thread_ts, logger, summary_index=payload.get("summary_index"))
+    elif op == "reaction":
+        _update_reaction_on(backend, thread_ts, payload["reaction"], logger)
+    elif op == "delete":
+        delete_threads_on(backend, [thread_ts], logger)
+    elif op == "created_at":
+        _set_created_at_on(backend, thread_ts, payload["created_at"], logger)
+    else:
+        raise ValueError(f"Unknown storage operation {op!r}")
+
+def _write(op, thread_ts, payload, logger=None):
+    """Write to the primary now; to the secondaries now or through the outbox."""
+    apply_write(STORAGE_PRIMARY, op, thread_ts, payload, logger)
+    _write_secondaries(op, thread_ts, payload, logger)
+
+def _write_secondaries(op, thread_ts, payload, logger=None):
+    if STORAGE_REPLICATION == "sync":
+        for backend in SECONDARY_BACKENDS:
+            apply_write(backend, op, thread_ts, payload, logger)
+    elif SECONDARY_BACKENDS:
+        replication.replicate(op, thread_ts, payload)
+
+def append_messages(thread_ts, messages, logger=None):
+    """Write a batch of messages to every backend, bypassing any open context."""
+    # Large command outputs go to the blob store; every backend keeps the reference
+    messages = blob_store.externalize_messages(messages)
+    version_before = _version_before_write(thread_ts)
+    _write("append", thread_ts, {"messages": list(messages)}, logger)
+    thread_catalog.record_messages(thread_ts, len(messages), logger)
+    _write_through(thread_ts, version_before, lambda doc: doc.setdefault("messages", []).extend(messages))
+
+def set_summary_index(thread_ts, logger=None, summary_index=None):
+    ctx = conversation_context.current_context(thread_ts)
+    if ctx is not None and summary_index is None:
+        ctx.set_summary_index()
+        return
+    version_before = _version_before_write(thread_ts)
+    apply_write(STORAGE_PRIMARY, "summary_index", thread_ts, {"summary_index": summary_index}, logger)
+    if summary_index is None and SECONDARY_BACKENDS:
+        # Replicate the index the primary chose: "the last message" of a secondary's copy
+        # is a different message when that copy is behind or has diverged
+        summary_index = (load_header_on(STORAGE_PRIMARY, thread_ts) or {}).get("summary_index")
+    _write_secondaries("summary_index", thread_ts, {"summary_index": summary_index}, logger)
+
+    def mutate(doc):
+        messages = doc.get("messages", [])
+        if summary_index is not None:
+            doc["summary_index"] = summary_index
+        elif messages:
+            doc["summary_index"] = len(messages) - 1
+    _write_through(thread_ts, version_before, mutate)
 
 def get_thread_messages(thread_ts, logger=None):
-    for backend in STORAGE_BACKENDS:
-        if backend == "file_storage":
-            return file_storage.get_thread_messages(thread_ts, logger)
-        elif backend == "elasticsearch":
-            es = elastic.get_es_client()
-            return elastic.get_thread_messages(es, thread_ts, logger)
+    """The LLM context for a thread, with blob references resolved."""
+    return blob_store.resolve_messages(_context_messages(thread_ts, logger), logger)
+
+def _context_messages(thread_ts, logger=None):
+    ctx = conversation_context.current_context(thread_ts)
+    if ctx is not None:
+        return ctx.context_messages()
+    if _cache.enabled:
+        use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
+        doc = load_thread(thread_ts, logger, hot_only=use_summary) or {}
+        view = conversation_context.summary_view(doc.get("messages", []), doc.get("summary_index"))
+        if None in view:
+            doc = load_thread(thread_ts, logger) or {}
+            view = conversation_context.summary_view(doc.get("messages", []), doc.get("summary_index"))
+        return view
+    backend = STORAGE_PRIMARY
+    if backend == "file_storage":
+        return file_storage.get_thread_messages(thread_ts, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.get_thread_messages(es, thread_ts, logger)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.get_thread_messages(thread_ts, logger)
+    elif backend == "sqlite":
+        return sqlite_storage.get_thread_messages(thread_ts, logger)
     return []
 
+def _load_thread_uncached(thread_ts, logger=None, hot_only=False):
+    backend = STORAGE_PRIMARY
+    if backend == "file_storage":
+        return file_storage.load_thread(thread_ts, logger, hot_only=hot_only)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.load_thread_es(es, thread_ts, logger)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.load_thread(thread_ts, logger)
+    elif backend == "sqlite":
+        return sqlite_storage.load_thread(thread_ts, logger)
+    return None
+
+def load_thread(thread_ts, logger=None, cached=True, hot_only=False):
+    """
+    Return the whole thread document from the primary backend (or the thread cache), or None.
+    hot_only=True lets file_storage leave compacted messages out (as None
+    placeholders); the document is then marked "hot_only".
+    """
+    if not (cached and _cache.enabled):
+        return _load_thread_uncached(thread_ts, logger, hot_only)
+    # Take the version before reading so a concurrent write can only make the entry look stale
+    version = _thread_version(thread_ts) if THREAD_CACHE_VALIDATE else None
+    doc = _cache.get(thread_ts, validate=THREAD_CACHE_VALIDATE, current_version=version)
+    if doc is not None and (hot_only or not doc.get("hot_only")):
+        return doc
+    doc = _load_thread_uncached(thread_ts, logger, hot_only)
+    if doc is not None:
+        _cache.put(thread_ts, doc, version)
+    return doc
+
+def thread_version(thread_ts):
+    """Opaque marker that changes whenever the thread changes in the primary backend."""
+    return _thread_version(thread_ts)
+
+def thread_exists(thread_ts):
+    backend = STORAGE_PRIMARY
+    if backend == "file_storage":
+        return file_storage.thread_exists(thread_ts)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.thread_exists_es(es, thread_ts)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.load_header(thread_ts) is not None
+    elif backend == "sqlite":
+        return sqlite_storage.load_header(thread_ts) is not None
+    return False
+
+def read_messages(thread_ts, since=0, limit=None, logger=None):
+    """
+    Messages from seq `since` on (since = number of messages the caller
+    already has), at most limit of them, read from the primary backend
+    without loading the rest of the thread where the backend allows it.
+    """
+    return read_messages_on(STORAGE_PRIMARY, thread_ts, since - 1 if since else None, limit, logger)
+
+def read_messages_on(backend, thread_ts, after_seq=None, limit=None, logger=None):
+    """Messages with seq > after_seq (all when None), at most limit of them, from one backend."""
+    if backend == "file_storage":
+        return file_storage.read_messages(thread_ts, after_seq, limit, logger)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.read_messages_es(es, thread_ts, after_seq, limit, logger)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.read_messages(thread_ts, after_seq, limit)
+    elif backend == "sqlite":
+        return sqlite_storage.read_messages(thread_ts, after_seq, limit)
+    return []
+
+def load_header_on(backend, thread_ts):
+    """A thread's header fields (summary_index, reaction, created_at, message_count) from one backend, or None."""
+    if backend == "file_storage":
+        return file_storage.load_header(thread_ts)
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.load_header_es(es, thread_ts)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.load_header(thread_ts)
+    elif backend == "sqlite":
+        return sqlite_storage.load_header(thread_ts)
+    return None
+
+def inactive_thread_ids_on(backend, before):
+    """
+    Ids of threads in one backend not written since `before` (an ISO
+    timestamp), read from the backend's own timestamps. Only the
+    Elasticsearch backends can answer this without a full scan; the
+    others return nothing.
+    """
+    if backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.inactive_thread_ids_es(es, before)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.inactive_thread_ids(before)
+    return iter(())
+
+def list_thread_ids(logger=None):
+    """Every thread id in the primary backend. A full scan; the catalog is the fast path."""
+    return list_thread_ids_on(STORAGE_PRIMARY)
+
+def list_thread_ids_on(backend):
+    if backend == "file_storage":
+        return file_storage.list_threads()
+    elif backend == "elasticsearch":
+        es = elastic.get_es_client()
+        return elastic.list_threads_es(es)
+    elif backend == "elasticsearch_messages":
+        return elastic_messages.list_threads()
+    elif backend == "sqlite":
+        return sqlite_storage.list_threads()
+    return []
+
+def record_thread_metadata(thread_ts, payload, logger=None):
+    """Store the event's channel, user and IO_type in the thread catalog."""
+    thread_catalog.record_metadata(thread_ts, channel=payload.get("channel"), user=payload.get("user"),
+                                   io_type=payload.get("IO_type"), logger=logger)
+
 def update_reaction(thread_ts, reaction, logger=None):
-    for backend in STORAGE_BACKENDS:
-        if backend == "file_storage":
-            file_storage.update_reaction(thread_ts, reaction, logger)
-        elif backend == "elasticsearch":
-            es = elastic.get_es_client()
-            elastic.update_reaction(es, os.getenv("es_index"), thread_ts, reaction, logger)
+    version_before = _version_before_write(thread_ts)
+    _write("reaction", thread_ts, {"reaction": reaction}, logger)
+    thread_catalog.record_reaction(thread_ts, reaction, logger)
+    _write_through(thread_ts, version_before, lambda doc: doc.__setitem__("reaction", reaction))
+
+def delete_threads(thread_ids, logger=None):
+    """
+    Delete whole threads from the primary (in one batch where the backend
+    allows it), then from the secondaries, the catalog and the thread cache.
+    """
+    thread_ids = list(thread_ids)
+    if not thread_ids:
+        return
+    delete_threads_on(STORAGE_PRIMARY, thread_ids, logger)
+    if STORAGE_REPLICATION == "sync":
+        for backend in SECONDARY_BACKENDS:
+            delete_threads_on(backend, thread_ids, logger)
+    elif SECONDARY_BACKENDS:
+        for thread_ts in thread_ids:
+            replication.replicate("delete", thread_ts, {})
+    thread_catalog.delete_threads(thread_ids, logger)
+    for thread_ts in thread_ids:
+        _cache.invalidate(thread_ts)
+
+def invalidate_thread(thread_ts=None, logger=None):
+    """
+    Drop a thread (or, with no thread_ts, every thread) from this process's
+    thread cache. Hook for deployments that write the same threads from
+    several replicas with cache validation turned off.
+    """
+    dropped = _cache.invalidate(thread_ts)
+    if logger:
+        logger.info("Invalidated %d cached thread(s)%s", dropped, f" for {thread_ts}" if thread_ts else "")
+    return dropped
+
+def thread_cache_stats():
+    return _cache.stats()
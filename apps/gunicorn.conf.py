@@ -0,0 +1,48 @@
+# gunicorn.conf.py
+"""
+Production serving for flask_runner:
+
+    gunicorn -c gunicorn.conf.py flask_runner:app
+
+The app is imported once in the master (preload_app) and forked into
+WEB_CONCURRENCY worker processes with GUNICORN_THREADS threads each.
+One-time setup (git config, the file index) runs in the master; every
+worker then runs its own startup and reports ready on /readyz. The pod-wide
+background threads (Argo CD login loop, catalog backfill, layout migration,
+retention) run in whichever single worker holds POD_TASKS_LOCK.
+
+WEB_CONCURRENCY defaults to 1. The job queue's per-thread ordering, the
+dedup cache, the admission gates and message coalescing all live in process
+memory, so with several workers each one enforces them only for the
+requests it happens to receive. Scale with GUNICORN_THREADS, or with more
+pods behind routing that is sticky on thread_ts.
+"""
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", 1))
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+worker_class = "gthread" if threads > 1 else "sync"
+preload_app = True
+# Synchronous webhook callers (naut) can wait for a whole LLM round trip
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 330))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 0))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 0))
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+loglevel = os.getenv("LOG_LEVEL", "info").lower()
+
+
+def when_ready(server):
+    import flask_runner
+    flask_runner.init_pod()
+    server.log.info("Pod startup done, serving with %d workers x %d threads", workers, threads)
+    if workers > 1:
+        server.log.warning("WEB_CONCURRENCY=%d: per-thread ordering, dedup, admission caps and coalescing "
+                           "are enforced per worker process, not per pod", workers)
+
+
+def post_worker_init(worker):
+    import flask_runner
+    flask_runner.init_worker()
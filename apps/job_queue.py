@@ -0,0 +1,374 @@
+# job_queue.py
+"""
+In-process job queue for webhook events.
+
+The webhook validates the payload, enqueues it and answers straight away; a
+bounded pool of worker threads runs the handler, one job per thread_ts at a
+time. Queue depth, wait time and run time are tracked so the pool can be
+sized from real numbers (see stats()).
+"""
+import os
+import queue
+import threading
+import time
+import uuid
+import logging
+from collections import deque
+
+# Above LLM_MAX_CONCURRENCY / COMMAND_MAX_CONCURRENCY, so the admission gates are what queues work
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 16))
+JOB_QUEUE_MAXSIZE = int(os.getenv("JOB_QUEUE_MAXSIZE", 100))
+JOB_RESULT_TTL = int(os.getenv("JOB_RESULT_TTL", 3600))  # seconds a finished job stays queryable
+JOB_STATS_WINDOW = int(os.getenv("JOB_STATS_WINDOW", 500))  # samples kept for wait/run time stats
+# Caps on how many threads one channel / user may have admitted at once (0 = no cap)
+JOB_MAX_THREADS_PER_CHANNEL = int(os.getenv("JOB_MAX_THREADS_PER_CHANNEL", 0))
+JOB_MAX_THREADS_PER_USER = int(os.getenv("JOB_MAX_THREADS_PER_USER", 0))
+# Coalescing window for rapid-fire messages in one thread (0 = off), and the
+# longest a coalesced job may be held back in total
+JOB_DEBOUNCE_MS = int(os.getenv("JOB_DEBOUNCE_MS", 0))
+JOB_DEBOUNCE_MAX_MS = int(os.getenv("JOB_DEBOUNCE_MAX_MS", 5000))
+
+
+class QueueFull(Exception):
+    """Raised when the job queue is at JOB_QUEUE_MAXSIZE."""
+
+    def __init__(self, message, depth=0):
+        super().__init__(message)
+        self.depth = depth
+
+
+class Job:
+    """A single queued call of fn(payload, logger)."""
+
+    def __init__(self, fn, payload, logger=None, coalesce=False):
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.payload = payload
+        self.logger = logger
+        self.coalesce = coalesce
+        self.merged = 0
+        self.not_before = 0.0
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return time.time() - self.enqueued_at
+        return self.started_at - self.enqueued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    def wait(self, timeout=None):
+        """Block until the job has finished. Returns False on timeout."""
+        return self._done.wait(timeout)
+
+    def done(self):
+        return self._done.is_set()
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "thread_ts": (self.payload or {}).get("thread_ts"),
+            "enqueued_at": self.enqueued_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+            "wait_time": round(self.wait_time, 3),
+            "run_time": round(self.run_time, 3),
+            "merged": self.merged,
+            "error": self.error,
+        }
+
+
+class Lane:
+    """Pending jobs of one conversation thread, run strictly in order."""
+
+    def __init__(self, key, channel=None, user=None):
+        self.key = key
+        self.channel = channel
+        self.user = user
+        self.jobs = deque()
+        self.state = "idle"  # idle -> blocked | debouncing | ready -> running -> ready | idle
+
+
+class JobQueue:
+    """
+    Lane scheduler over a fixed pool of daemon worker threads.
+
+    Jobs are grouped into lanes by thread_ts. A lane runs at most one job at a
+    time, so messages of one thread are handled in arrival order, while
+    different threads run in parallel. A lane holds a channel/user slot from
+    the moment it is admitted until it drains; lanes over the
+    JOB_MAX_THREADS_PER_CHANNEL / JOB_MAX_THREADS_PER_USER caps wait (in
+    arrival order) until a slot frees up.
+
+    With a debounce window, a coalescible job is held back until no further
+    message arrived for debounce_ms; coalescible messages arriving meanwhile
+    are merged into it (one user turn, one LLM call) instead of queued.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, maxsize=JOB_QUEUE_MAXSIZE, logger=None,
+                 max_threads_per_channel=JOB_MAX_THREADS_PER_CHANNEL,
+                 max_threads_per_user=JOB_MAX_THREADS_PER_USER,
+                 debounce_ms=JOB_DEBOUNCE_MS, debounce_max_ms=JOB_DEBOUNCE_MAX_MS):
+        self.workers = max(1, int(workers))
+        self.maxsize = int(maxsize)
+        self.debounce = max(0, int(debounce_ms)) / 1000.0
+        self.debounce_max = max(0, int(debounce_max_ms)) / 1000.0
+        self.max_threads_per_channel = int(max_threads_per_channel)
+        self.max_threads_per_user = int(max_threads_per_user)
+        self.logger = logger or logging.getLogger(__name__)
+        self._ready = queue.Queue()
+        self._lanes = {}
+        self._blocked = deque()
+        self._admitted = {"channel": {}, "user": {}}
+        self._depth = 0
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._running = 0
+        self._counters = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "coalesced": 0}
+        self._wait_times = deque(maxlen=JOB_STATS_WINDOW)
+        self._run_times = deque(maxlen=JOB_STATS_WINDOW)
+
+    def _ensure_started(self):
+        # Worker threads do not survive fork(); start them lazily in the
+        # process that actually serves requests.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+                t.start()
+                self._threads.append(t)
+            self._pid = os.getpid()
+            self.logger.info("Job queue started with %d workers (maxsize=%d)", self.workers, self.maxsize)
+
+    def submit(self, fn, payload, logger=None, coalesce=False):
+        """
+        Enqueue fn(payload, logger) on the lane of payload's thread_ts and
+        return its Job. A coalescible payload may instead be merged into the
+        lane's pending job, which is then returned. Raises QueueFull.
+        """
+        self._ensure_started()
+        payload = payload or {}
+        coalesce = coalesce and self.debounce > 0
+        job = Job(fn, payload, logger or self.logger, coalesce=coalesce)
+        key = payload.get("thread_ts") or job.id
+        with self._lock:
+            lane = self._lanes.get(key)
+            merged_into = self._merge(lane, job) if lane is not None else None
+            if merged_into is not None:
+                self._counters["coalesced"] += 1
+                self.logger.info("Message for thread %s merged into job %s (%d merged)", key, merged_into.id, merged_into.merged)
+                return merged_into
+            if self._depth >= self.maxsize:
+                self._counters["rejected"] += 1
+                raise QueueFull(f"Job queue is full ({self.maxsize} pending jobs)", self._depth)
+            if lane is None:
+                lane = self._lanes[key] = Lane(key, payload.get("channel"), payload.get("user"))
+            if coalesce:
+                job.not_before = job.enqueued_at + self.debounce
+            lane.jobs.append(job)
+            self._depth += 1
+            self._counters["submitted"] += 1
+            self._jobs[job.id] = job
+            if lane.state == "idle":
+                self._admit(lane)
+            self._prune()
+            state, depth = lane.state, self._depth
+        self.logger.info("Job %s queued for thread %s (lane=%s, depth=%d)", job.id, key, state, depth)
+        return job
+
+    def _merge(self, lane, job):
+        # Caller holds self._lock. Fold job's text into the lane's last pending
+        # job if both are coalescible and we are still inside its window.
+        if not job.coalesce or not lane.jobs:
+            return None
+        tail = lane.jobs[-1]
+        now = time.time()
+        if not tail.coalesce or now > tail.not_before or now - tail.enqueued_at > self.debounce_max:
+            return None
+        tail.payload["text"] = f"{tail.payload.get('text', '')}\n{job.payload.get('text', '')}"
+        tail.merged += 1
+        tail.not_before = min(now + self.debounce, tail.enqueued_at + self.debounce_max)
+        return tail
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def _has_slot(self, lane):
+        for kind, value, cap in (("channel", lane.channel, self.max_threads_per_channel),
+                                 ("user", lane.user, self.max_threads_per_user)):
+            if cap > 0 and value and self._admitted[kind].get(value, 0) >= cap:
+                return False
+        return True
+
+    def _admit(self, lane):
+        # Caller holds self._lock.
+        if not self._has_slot(lane):
+            lane.state = "blocked"
+            self._blocked.append(lane)
+            return
+        for kind, value in (("channel", lane.channel), ("user", lane.user)):
+            if value:
+                self._admitted[kind][value] = self._admitted[kind].get(value, 0) + 1
+        self._schedule(lane)
+
+    def _schedule(self, lane):
+        # Caller holds self._lock. Hand the lane to the workers, or hold it
+        # until its head job's debounce window has closed.
+        delay = lane.jobs[0].not_before - time.time()
+        if delay > 0:
+            lane.state = "debouncing"
+            timer = threading.Timer(delay, self._debounce_elapsed, args=(lane,))
+            timer.daemon = True
+            timer.start()
+            return
+        lane.state = "ready"
+        self._ready.put(lane)
+
+    def _debounce_elapsed(self, lane):
+        with self._lock:
+            if lane.state == "debouncing":
+                # The window may have been extended by a merge; _schedule re-arms
+                self._schedule(lane)
+
+    def _release(self, lane):
+        # Caller holds self._lock. The lane drained: free its slots, drop it
+        # and admit blocked lanes that now fit, oldest first.
+        for kind, value in (("channel", lane.channel), ("user", lane.user)):
+            if value:
+                left = self._admitted[kind].get(value, 0) - 1
+                if left > 0:
+                    self._admitted[kind][value] = left
+                else:
+                    self._admitted[kind].pop(value, None)
+        lane.state = "idle"
+        self._lanes.pop(lane.key, None)
+        still_blocked = deque()
+        while self._blocked:
+            waiting = self._blocked.popleft()
+            if self._has_slot(waiting):
+                self._admit(waiting)
+            else:
+                still_blocked.append(waiting)
+        self._blocked = still_blocked
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RESULT_TTL
+        expired = [jid for jid, j in self._jobs.items() if j.finished_at and j.finished_at < cutoff]
+        for jid in expired:
+            del self._jobs[jid]
+
+    def _worker(self):
+        while True:
+            lane = self._ready.get()
+            with self._lock:
+                job = lane.jobs.popleft()
+                lane.state = "running"
+                self._depth -= 1
+            try:
+                self._run(job)
+            finally:
+                with self._lock:
+                    if lane.jobs:
+                        # Back of the ready queue so busy threads do not starve others
+                        self._schedule(lane)
+                    else:
+                        self._release(lane)
+
+    def _run(self, job):
+        job.started_at = time.time()
+        job.status = "running"
+        with self._lock:
+            self._running += 1
+            self._wait_times.append(job.wait_time)
+        try:
+            job.result = job.fn(job.payload, job.logger)
+            job.status = "done"
+        except Exception as e:
+            job.error = str(e)
+            job.status = "failed"
+            job.logger.exception("Job %s failed", job.id)
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._running -= 1
+                self._run_times.append(job.run_time)
+                self._counters["completed" if job.status == "done" else "failed"] += 1
+                depth = self._depth
+            job._done.set()
+            job.logger.info("Job %s %s: waited %.3fs, ran %.3fs, depth=%d",
+                            job.id, job.status, job.wait_time, job.run_time, depth)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "maxsize": self.maxsize,
+                "depth": self._depth,
+                "running": self._running,
+                "lanes": len(self._lanes),
+                "lanes_blocked": len(self._blocked),
+                "max_threads_per_channel": self.max_threads_per_channel,
+                "max_threads_per_user": self.max_threads_per_user,
+                "debounce_ms": int(self.debounce * 1000),
+                **self._counters,
+                "wait_time": _summarize(self._wait_times),
+                "run_time": _summarize(self._run_times),
+            }
+
+
+def _summarize(samples):
+    if not samples:
+        return {"count": 0, "avg": 0.0, "p95": 0.0, "max": 0.0}
+    ordered = sorted(samples)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return {
+        "count": len(ordered),
+        "avg": round(sum(ordered) / len(ordered), 3),
+        "p95": round(p95, 3),
+        "max": round(ordered[-1], 3),
+    }
+
+
+_default_queue = None
+_default_lock = threading.Lock()
+
+
+def get_job_queue(logger=None):
+    """Return the process-wide JobQueue, creating it on first use."""
+    global _default_queue
+    if _default_queue is None:
+        with _default_lock:
+            if _default_queue is None:
+                _default_queue = JobQueue(logger=logger)
+    return _default_queue
+
+
+def submit_job(fn, payload, logger=None, coalesce=False):
+    return get_job_queue(logger).submit(fn, payload, logger, coalesce=coalesce)
+
+
+def get_job(job_id):
+    return get_job_queue().get(job_id)
+
+
+def job_stats():
+    return get_job_queue().stats()
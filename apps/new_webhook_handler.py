@@ -11,7 +11,7 @@ from threading import Thread
 import git_config
 #from slack import post_message_to_slack, get_bot_user_id, verify_slack_request, get_thread_ts_from_reaction
 #from elastic import ensure_index_exists, get_es_client, update_elasticsearch, set_summary_index_es, get_thread_messages, update_reaction
-from generic_storage import ensure_index_exists, update_message, set_summary_index, get_thread_messages, update_reaction
+from generic_storage import record_thread_metadata, update_message, set_summary_index, get_thread_messages, update_reaction
 #from chatgpt import get_chatgpt_response
 from call_llm import get_llm_response
 import html
@@ -27,6 +27,12 @@ from summarize_conversation import summarize_conversation
 from send_response import send_response
 from test_review_command import run_review
 from graphs.default_graph import run_default_graph_entry
+from job_queue import submit_job, QueueFull
+from dedup import dedup_submit
+from agent_loop import run_agent_loop, extract_command
+from admission import admission_notifier, AdmissionRejected
+from conversation_context import thread_context
+from stream_reply import llm_reply
 
 
 
@@ -72,6 +78,12 @@ system_text = create_system_text()
 
 es_index = os.getenv("es_index")
 ES_EXT_URL = os.getenv("ES_EXT_URL")
+# Run webhook events on the job queue and answer 202 with a job id right away
+WEBHOOK_ASYNC = os.getenv("WEBHOOK_ASYNC", "true").lower() == "true"
+# IO types whose callers read the reply from the HTTP response (naut CLI); these still
+# go through the queue but the request waits for the job to finish
+WEBHOOK_SYNC_IO_TYPES = [t.strip() for t in os.getenv("WEBHOOK_SYNC_IO_TYPES", "command_line").split(",") if t.strip()]
+WEBHOOK_SYNC_TIMEOUT = float(os.getenv("WEBHOOK_SYNC_TIMEOUT", 300))
 # Elasticsearch endpoint with authentication
 #s = get_es_client()
 #ensure_index_exists(logger)
@@ -126,12 +138,10 @@ def handle_event_text(payload, logger):
             command_output_handler_text = "Be brief. Less than 75 words. Analyze this command output, if there are errors, try to fix them. Use the command with --help to get more info to fix the errors, example: ```argocd app manifests --help```. Recommend a new command if you can fix the errors, otherwise ask user for help. Summarize with a focus on which Problem Resources are not in Synced or Healthy state. We will later investigate those manifests of Problem Resources."
             content = command_output_handler_text + "\n" + event_text
             update_message( thread_ts, role, content, logger=logger)
-            response = get_llm_response( thread_ts, max_response_tokens, temperature, logger=logger)
+            response = llm_reply(payload, thread_ts, logger, max_response_tokens, temperature)
             role = "assistant"
             content = response
             update_message( thread_ts, role, content, logger=logger)
-            response = "NAUT " + response
-            send_response(payload, thread_ts, response, logger)
             logger.info("Analyzed output from the command-runner")
             return {"response": "Analyzed output from the command-runner"} 
         
@@ -139,31 +149,8 @@ def handle_event_text(payload, logger):
             logger.info("Running the requested command...")
             messages = get_thread_messages( thread_ts, logger=logger)
             last_content = messages[-1]["content"]
-# Extract the command which is line after three backticks from slack
-            lines = last_content.splitlines()
-            command = None
-            for idx, line in enumerate(lines):
-                stripped = line.strip()
-
-                if stripped.startswith("```"):
-                    if stripped.startswith("```yaml"):
-                        continue
-                    # Case 1: backticks and command on the same line
-                    if stripped.startswith("```bash"):
-                        if len(stripped) > 7:
-                            command = stripped[7:].strip("` ").strip()
-                            break
-                    if len(stripped) > 3:
-                        command = stripped[3:].strip("` ").strip()
-                        break
-
-                    # Case 2: command is on the next line
-                    if idx + 1 < len(lines):
-                        command_candidate = lines[idx + 1].strip()
-                        # Optional: confirm next-next line is closing ```
-                        if idx + 2 < len(lines) and lines[idx + 2].strip().startswith("```"):
-                            command = command_candidate
-                            break
+            # Extract the command which is line after three backticks from slack
+            command = extract_command(last_content)
             if not command:
                 logger.info("No command found after code block — using fallback response")
                 role = "user"
@@ -219,12 +206,11 @@ def handle_event_text(payload, logger):
                     role = "user"
                     content = command_output_handler_text + "\n" + response
                     update_message( thread_ts, role, content, logger=logger)
-                    response = get_llm_response( thread_ts, max_response_tokens, temperature, logger=logger)
+                    response = llm_reply(payload, thread_ts, logger, max_response_tokens, temperature)
                     role = "assistant"
                     content = response
                     response = "NAUT " + response
                     update_message( thread_ts, role, content, logger=logger)
-                    send_response(payload, thread_ts, response, logger)
                     return response
 
         case "SUMMARIZE":
@@ -255,9 +241,7 @@ def handle_event_text(payload, logger):
             content = response
             update_message( thread_ts, role, content, logger=logger)           
             if AUTO_RUN:
-                newpayload = payload
-                newpayload["text"] = "RUN"
-                handle_event_text(newpayload, logger)
+                run_agent_loop(payload, thread_ts, logger, max_response_tokens, temperature)
             else:
                 #response = "``` " + response + " ```"
                 response = "NAUT type RUN all caps to run this command" + response
@@ -277,9 +261,7 @@ def handle_event_text(payload, logger):
             update_message( thread_ts, role, content, logger=logger)
             #post_message_to_slack(channel_id, response, thread_ts)
             if AUTO_RUN:
-                newpayload = payload
-                newpayload["text"] = "RUN"
-                handle_event_text(newpayload, logger)
+                run_agent_loop(payload, thread_ts, logger, max_response_tokens, temperature)
             else:
                 #response = "``` " + response + " ```"
                 response = "NAUT type RUN all caps to run this command" + response
@@ -297,9 +279,7 @@ def handle_event_text(payload, logger):
             update_message( thread_ts, role, content, logger=logger)
             #post_message_to_slack(channel_id, response, thread_ts)
             if AUTO_RUN:
-                    newpayload = payload
-                    newpayload["text"] = "RUN"
-                    handle_event_text(newpayload, logger)
+                run_agent_loop(payload, thread_ts, logger, max_response_tokens, temperature)
             else:
                 #response = "``` " + response + " ```"
                 #response = "NAUT type RUN all caps to run this command" + response
@@ -346,12 +326,11 @@ def handle_event_text(payload, logger):
             update_message( thread_ts, role, content, logger=logger)
             response = "NAUT " + response
             send_response(payload, thread_ts, response, logger)
-            response = get_llm_response( thread_ts, max_response_tokens, temperature, logger=logger)
+            response = llm_reply(payload, thread_ts, logger, max_response_tokens, temperature)
             role = "assistant"
             content = response
             update_message( thread_ts, role, content, logger=logger)
             response = "NAUT " + response
-            send_response(payload, thread_ts, response, logger)
             return response
 
         case _:
@@ -381,21 +360,51 @@ def handle_event_text(payload, logger):
                 role = "user"
                 content = event_text
                 update_message( thread_ts, role, content, logger=logger)            
-                response = get_llm_response( thread_ts, max_response_tokens, temperature, logger=logger)
+                # With AUTO_RUN the agent loop decides what the user sees
+                response = llm_reply(payload, thread_ts, logger, max_response_tokens, temperature,
+                                     suffix=" type RUN all caps to run the command supplied OR type RUN your-own-command here to run your own",
+                                     send=not AUTO_RUN)
                 role = "assistant"
                 content = response
                 update_message( thread_ts, role, content, logger=logger)
         
                 if AUTO_RUN:
                     logger.info("AUTO_RUN set to True so running using command-runner %s", response)
-                    newpayload = payload
-                    newpayload["text"] = "RUN"
-                    handle_event_text(newpayload, logger)
+                    run_agent_loop(payload, thread_ts, logger, max_response_tokens, temperature)
                 else:
-                    logger.info("AUTO_RUN set to to False so asking user to issue RUN Keyword %s", response)
-                    #response = "``` " + response + " ```"
-                    response = "NAUT " + response + " type RUN all caps to run the command supplied OR type RUN your-own-command here to run your own"  
-                    send_response(payload, thread_ts, response, logger)
+                    logger.info("AUTO_RUN set to to False so asked user to issue RUN Keyword %s", response)
+
+# First words that make a message a command for handle_event_text, which must see it exactly as typed
+_COMMANDS = frozenset(("NAUT", "TOOL", "RUN", "SUMMARIZE", "GIT-FIX", "GIT-PR", "GIT-MERGE"))
+
+def is_coalescible(payload):
+    """Plain chat text may be merged with the user's next quick messages into one turn."""
+    text = (payload.get("text") or "").strip()
+    if not text:
+        return False
+    # Parsed the way handle_event_text does: HELP alone in any case, the rest by their first word as typed
+    return text.upper() != "HELP" and text.split(maxsplit=1)[0] not in _COMMANDS
+
+def process_event(payload, logger):
+    """Job queue entry point: handle one event under admission control, with its
+    thread history loaded once and new messages flushed in one batch at the end."""
+    thread_ts = payload.get("thread_ts")
+    notified = []
+
+    def notify_queued(position):
+        # Tell the user once per event, not once per gate
+        if not notified:
+            notified.append(position)
+            send_response(payload, thread_ts, f"NAUT Argonaut is busy, your request is queued at position {position}", logger)
+
+    record_thread_metadata(thread_ts, payload, logger)
+    with admission_notifier(notify_queued), thread_context(thread_ts, logger):
+        try:
+            return handle_event_text(payload, logger)
+        except AdmissionRejected as e:
+            logger.warning("Rejected event for thread %s: %s", thread_ts, e)
+            send_response(payload, thread_ts, "NAUT Argonaut is at capacity right now, please try again in a minute", logger)
+            return {"busy": True, "error": str(e)}
 
 def route_source(request, logger):
     """
@@ -409,17 +418,38 @@ def route_source(request, logger):
 def webhook_handler(request, logger):
 
     logger.info("Webhook endpoint hit inside webhook_handler")
-    ensure_index_exists(logger)
     payload = request.get_json()
     logger.debug("webhook_handler, data: %s", payload)
     logger.info("inside webhook_handler")
-    if not payload:
+    if not payload or not isinstance(payload, dict):
         return {"error": "Invalid payload"}, 400
+    if not isinstance(payload.get("text"), str):
+        return {"error": "Missing 'text' in payload"}, 400
+    def enqueue():
+        return submit_job(process_event, dict(payload), logger, coalesce=is_coalescible(payload))
+
     try:
-        result = route_source(request, logger)
-        return {"status": "ok", "result": result}, 200
-    except Exception as e:
-        logger.exception("Error handling webhook")
-        return {"error": str(e)}, 500
+        job, duplicate = dedup_submit(payload, enqueue, headers=request.headers)
+    except QueueFull as e:
+        logger.warning("Rejecting webhook for thread %s: %s", payload.get("thread_ts"), e)
+        if payload.get("IO_type") not in WEBHOOK_SYNC_IO_TYPES:
+            # Sync callers read the 429 body; chat users only see a reply. Off the request
+            # thread, so the 429 goes back before Slack's 3s retry deadline.
+            Thread(target=send_response, daemon=True, args=(
+                payload, payload.get("thread_ts"),
+                f"NAUT Argonaut is busy: {e.depth} requests are already queued, please try again in a minute",
+                logger)).start()
+        return {"error": "Server busy, try again later"}, 429
+    if duplicate:
+        logger.info("Duplicate delivery for thread %s attached to job %s", payload.get("thread_ts"), job.id)
 
+    if WEBHOOK_ASYNC and payload.get("IO_type") not in WEBHOOK_SYNC_IO_TYPES:
+        return {"status": "queued", "job_id": job.id, "duplicate": duplicate}, 202
 
+    if not job.wait(WEBHOOK_SYNC_TIMEOUT):
+        return {"status": "queued", "job_id": job.id}, 202
+    if job.status == "failed":
+        return {"error": job.error, "job_id": job.id}, 500
+    if isinstance(job.result, dict) and job.result.get("busy"):
+        return {"error": job.result.get("error"), "job_id": job.id}, 429
+    return {"status": "ok", "result": job.result, "job_id": job.id}, 200
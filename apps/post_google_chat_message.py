@@ -56,6 +56,37 @@ def post_message(space: str, text: str, thread: str | None):
         print(resp.text)
     return 0
 
+def create_message(space: str, text: str, thread: str | None) -> str | None:
+    """Post a message and return its resource name (spaces/.../messages/...), or None."""
+    token = get_access_token()
+    params = {"messageReplyOption": "REPLY_MESSAGE_OR_FAIL"} if thread else {}
+    body = {"text": text or ""}
+    if thread:
+        body["thread"] = {"name": thread}
+    resp = requests.post(
+        f"https://chat.googleapis.com/v1/{space}/messages", params=params, json=body,
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=15
+    )
+    if not 200 <= resp.status_code < 300:
+        print(f"Chat API create status={resp.status_code} resp={resp.text}", file=sys.stderr)
+        return None
+    return resp.json().get("name")
+
+def update_message_text(name: str, text: str) -> bool:
+    """Replace the text of a message created by the bot."""
+    token = get_access_token()
+    resp = requests.patch(
+        f"https://chat.googleapis.com/v1/{name}", params={"updateMask": "text"},
+        json={"text": text or ""},
+        headers={"Authorization": f"Bearer {token}"},
+        timeout=15
+    )
+    if not 200 <= resp.status_code < 300:
+        print(f"Chat API patch status={resp.status_code} resp={resp.text}", file=sys.stderr)
+        return False
+    return True
+
 def main():
     ap = argparse.ArgumentParser()
     ap.add_argument("--space", required=True, help="spaces/<id>")
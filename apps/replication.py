@@ -0,0 +1,313 @@
+# replication.py
+"""
+Write-behind replication to secondary storage backends.
+
+generic_storage writes each change synchronously to the primary backend
+(STORAGE_PRIMARY) and records it here for every other backend in
+STORAGE_BACKENDS. The record goes into a SQLite outbox
+(REPLICATION_OUTBOX_PATH, by default on the persistent volume at DATA_DIR),
+so it survives restarts and a replacement pod picks it up. A background
+thread drains the outbox per backend, in order:
+  - consecutive appends to the same thread are sent as one batch;
+  - a failed write is retried with exponential backoff, and later writes
+    for that backend wait behind it so every secondary sees the primary's
+    order;
+  - a change that still fails after REPLICATION_MAX_ATTEMPTS tries is moved
+    to the dead_letters table so it stops blocking the backend (0 retries
+    forever); requeue_dead_letters() puts dead changes back at the end of
+    the outbox once the cause is fixed;
+  - one process at a time drains a given backend (a lease in the outbox,
+    renewed before every batch), so processes sharing the file never
+    replay a change twice; a drain that loses its lease stops.
+
+Replication lag (the age of the oldest pending change), queue depth and
+dead-lettered changes are reported by replication_stats().
+"""
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import logging
+
+import generic_storage
+from data_dir import DATA_DIR
+
+REPLICATION_OUTBOX_PATH = os.getenv("REPLICATION_OUTBOX_PATH", os.path.join(DATA_DIR, "replication_outbox.db"))
+REPLICATION_BATCH_SIZE = int(os.getenv("REPLICATION_BATCH_SIZE", 100))
+REPLICATION_POLL_INTERVAL = float(os.getenv("REPLICATION_POLL_INTERVAL", 1.0))
+REPLICATION_RETRY_BASE = float(os.getenv("REPLICATION_RETRY_BASE", 1.0))
+REPLICATION_RETRY_MAX = float(os.getenv("REPLICATION_RETRY_MAX", 300.0))
+REPLICATION_LEASE_SECONDS = float(os.getenv("REPLICATION_LEASE_SECONDS", 30.0))
+REPLICATION_MAX_ATTEMPTS = int(os.getenv("REPLICATION_MAX_ATTEMPTS", 20))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    backend TEXT NOT NULL,
+    op TEXT NOT NULL,
+    thread_ts TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_backend_id ON outbox (backend, id);
+CREATE TABLE IF NOT EXISTS dead_letters (
+    id INTEGER PRIMARY KEY,
+    backend TEXT NOT NULL,
+    op TEXT NOT NULL,
+    thread_ts TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT,
+    failed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS dead_letters_backend_id ON dead_letters (backend, id);
+CREATE TABLE IF NOT EXISTS leases (
+    backend TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    expires_at REAL NOT NULL
+);
+"""
+
+
+class Replicator:
+    """Outbox plus the drain thread for one process."""
+
+    def __init__(self, path=REPLICATION_OUTBOX_PATH, logger=None):
+        self.path = path
+        self.logger = logger or logging.getLogger(__name__)
+        self._local = threading.local()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._schema_ready = False
+        self._counters = {}
+
+    @property
+    def owner(self):
+        return f"{socket.gethostname()}:{os.getpid()}"
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        if not self._schema_ready:
+            conn.executescript(_SCHEMA)
+            self._schema_ready = True
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, backend, key, n=1):
+        counters = self._counters.setdefault(backend, {"replicated": 0, "batches": 0, "failures": 0, "dead_lettered": 0})
+        counters[key] += n
+
+    def ensure_started(self):
+        """Start the drain thread (again after a fork)."""
+        if self._thread is not None and self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._loop, name="replication", daemon=True)
+            self._thread.start()
+
+    def enqueue(self, backends, op, thread_ts, payload):
+        """Durably record one change for each of the given backends."""
+        if not backends:
+            return
+        now = time.time()
+        data = json.dumps(payload, ensure_ascii=False)
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(
+                "INSERT INTO outbox (backend, op, thread_ts, payload, created_at) VALUES (?, ?, ?, ?, ?)",
+                [(backend, op, thread_ts, data, now) for backend in backends])
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        self.ensure_started()
+        self._wake.set()
+
+    def _take_lease(self, backend):
+        """Take or renew the drain lease for a backend; False while another process holds it."""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT owner, expires_at FROM leases WHERE backend = ?", (backend,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] > now:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT INTO leases (backend, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (backend) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at",
+                (backend, self.owner, now + REPLICATION_LEASE_SECONDS))
+            conn.execute("COMMIT")
+            return True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _batches(self, rows):
+        """Group rows into calls: consecutive appends to one thread become one append."""
+        batch = []
+        for row in rows:
+            row_id, op, thread_ts, payload = row[0], row[1], row[2], json.loads(row[3])
+            if batch and op == "append" and batch[-1]["op"] == "append" and batch[-1]["thread_ts"] == thread_ts:
+                batch[-1]["ids"].append(row_id)
+                batch[-1]["payload"]["messages"].extend(payload["messages"])
+            else:
+                batch.append({"ids": [row_id], "op": op, "thread_ts": thread_ts, "payload": payload})
+        return batch
+
+    def _dead_letter(self, backend, ids, attempts, error):
+        conn = self._conn()
+        marks = ",".join("?" * len(ids))
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"INSERT INTO dead_letters (id, backend, op, thread_ts, payload, created_at, attempts, last_error, failed_at) "
+                f"SELECT id, backend, op, thread_ts, payload, created_at, ?, ?, ? FROM outbox WHERE id IN ({marks})",
+                (attempts, error, time.time(), *ids))
+            conn.execute(f"DELETE FROM outbox WHERE id IN ({marks})", ids)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def requeue_dead_letters(self, backend=None):
+        """Move dead-lettered changes (for one backend, or all) back to the end of the outbox. Returns how many."""
+        conn = self._conn()
+        where, params = ("WHERE backend = ?", (backend,)) if backend else ("", ())
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                f"INSERT INTO outbox (backend, op, thread_ts, payload, created_at) "
+                f"SELECT backend, op, thread_ts, payload, created_at FROM dead_letters {where} ORDER BY id", params)
+            moved = conn.execute(f"DELETE FROM dead_letters {where}", params).rowcount
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        if moved:
+            self.ensure_started()
+            self._wake.set()
+        return moved
+
+    def drain(self, backend):
+        """Replay pending changes for one backend. Returns how many outbox rows were applied."""
+        if not self._take_lease(backend):
+            return 0
+        conn = self._conn()
+        rows = conn.execute(
+            "SELECT id, op, thread_ts, payload, attempts, next_attempt_at FROM outbox "
+            "WHERE backend = ? ORDER BY id LIMIT ?", (backend, REPLICATION_BATCH_SIZE)).fetchall()
+        if not rows or rows[0][5] > time.time():
+            return 0
+        applied = 0
+        for i, batch in enumerate(self._batches(rows)):
+            # Renew before every batch so a long drain keeps its lease; stop if another process took it over
+            if i and not self._take_lease(backend):
+                break
+            try:
+                generic_storage.apply_write(backend, batch["op"], batch["thread_ts"], batch["payload"], self.logger)
+            except Exception as e:
+                attempts = rows[[r[0] for r in rows].index(batch["ids"][0])][4] + 1
+                if REPLICATION_MAX_ATTEMPTS and attempts >= REPLICATION_MAX_ATTEMPTS:
+                    self._dead_letter(backend, batch["ids"], attempts, str(e)[:500])
+                    self._count(backend, "failures")
+                    self._count(backend, "dead_lettered", len(batch["ids"]))
+                    self.logger.error("Replication to %s gave up on thread %s after %d attempts: %s",
+                                      backend, batch["thread_ts"], attempts, e)
+                    continue
+                delay = min(REPLICATION_RETRY_MAX, REPLICATION_RETRY_BASE * 2 ** (attempts - 1))
+                conn.execute(
+                    f"UPDATE outbox SET attempts = ?, next_attempt_at = ?, last_error = ? "
+                    f"WHERE id IN ({','.join('?' * len(batch['ids']))})",
+                    (attempts, time.time() + delay, str(e)[:500], *batch["ids"]))
+                self._count(backend, "failures")
+                self.logger.warning("Replication to %s failed for thread %s (attempt %d, retry in %.1fs): %s",
+                                    backend, batch["thread_ts"], attempts, delay, e)
+                break
+            conn.execute(f"DELETE FROM outbox WHERE id IN ({','.join('?' * len(batch['ids']))})", batch["ids"])
+            applied += len(batch["ids"])
+            self._count(backend, "batches")
+            self._count(backend, "replicated", len(batch["ids"]))
+        return applied
+
+    def _loop(self):
+        while True:
+            busy = False
+            for backend in generic_storage.SECONDARY_BACKENDS:
+                try:
+                    busy = self.drain(backend) >= REPLICATION_BATCH_SIZE or busy
+                except Exception:
+                    self.logger.exception("Replication drain for %s crashed", backend)
+            if not busy:
+                self._wake.wait(REPLICATION_POLL_INTERVAL)
+                self._wake.clear()
+
+    def stats(self):
+        conn = self._conn()
+        now = time.time()
+        result = {}
+        for backend in generic_storage.SECONDARY_BACKENDS:
+            pending, oldest = conn.execute(
+                "SELECT COUNT(*), MIN(created_at) FROM outbox WHERE backend = ?", (backend,)).fetchone()
+            head = conn.execute(
+                "SELECT attempts, last_error FROM outbox WHERE backend = ? ORDER BY id LIMIT 1", (backend,)).fetchone()
+            dead = conn.execute("SELECT COUNT(*) FROM dead_letters WHERE backend = ?", (backend,)).fetchone()[0]
+            result[backend] = {
+                "pending": pending,
+                "dead_letters": dead,
+                "lag_seconds": round(now - oldest, 3) if oldest else 0.0,
+                "head_attempts": head[0] if head else 0,
+                "last_error": head[1] if head else None,
+                **self._counters.get(backend, {"replicated": 0, "batches": 0, "failures": 0, "dead_lettered": 0}),
+            }
+        return result
+
+
+_replicator = None
+_replicator_lock = threading.Lock()
+
+
+def get_replicator(logger=None):
+    global _replicator
+    with _replicator_lock:
+        if _replicator is None:
+            _replicator = Replicator(logger=logger)
+        return _replicator
+
+
+def replicate(op, thread_ts, payload):
+    """Queue a change for every secondary backend."""
+    get_replicator().enqueue(generic_storage.SECONDARY_BACKENDS, op, thread_ts, payload)
+
+
+def start(logger=None):
+    """Start draining the outbox in this process (no-op without secondary backends)."""
+    if generic_storage.SECONDARY_BACKENDS:
+        get_replicator(logger).ensure_started()
+
+
+def replication_stats():
+    if not generic_storage.SECONDARY_BACKENDS:
+        return {}
+    return get_replicator().stats()
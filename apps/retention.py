@@ -0,0 +1,289 @@
+# retention.py
+"""
+Retention: delete threads that have been idle for longer than their
+retention period, from every storage backend.
+
+Retention is measured from a thread's last activity in the thread catalog
+(last message or reaction), so a thread that is still in use is never
+removed. The period comes from the first matching rule in RETENTION_RULES,
+a JSON list such as
+
+    [{"channel": "C0123456", "days": 7},
+     {"io_type": "google_chat", "days": 30, "reacted_days": 365}]
+
+A rule matches when every channel / user / io_type it names equals the
+thread's; threads matching no rule get RETENTION_DAYS. Threads with a
+reaction are labelled data: they get the rule's reacted_days, else
+RETENTION_REACTED_DAYS, else the ordinary period. 0 (the default) keeps
+threads forever.
+
+The sweeper pages through the catalog oldest activity first, so it only
+reads catalog rows that are past the shortest period, and deletes expired
+threads in batches of RETENTION_BATCH_SIZE through
+generic_storage.delete_threads (secondaries follow through the replication
+outbox). Threads in an Elasticsearch backend that the catalog does not know
+(written before it existed, or by a deployment with another catalog) are
+found by their own updated_at instead, and deleted once past the longest
+period any rule could give them.
+
+After a sweep that deleted threads, the blob store is garbage-collected:
+every message in the primary backend is scanned for blob references, and
+unreferenced blobs past BLOB_GC_GRACE_SECONDS are removed
+(RETENTION_BLOB_GC=false turns this off).
+
+start_pod_tasks runs the sweep every RETENTION_SWEEP_INTERVAL seconds when any
+period is set; `python retention.py sweep [--dry-run]` runs it once and
+`python retention.py gc-blobs [--dry-run]` collects blobs on its own.
+"""
+import os
+import json
+import time
+import threading
+import logging
+from datetime import datetime, timedelta, timezone
+
+import generic_storage
+import thread_catalog
+import blob_store
+
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS", 0))
+# Unset: reacted threads get the ordinary period
+RETENTION_REACTED_DAYS = float(os.environ["RETENTION_REACTED_DAYS"]) if os.getenv("RETENTION_REACTED_DAYS") else None
+RETENTION_SWEEP_INTERVAL = float(os.getenv("RETENTION_SWEEP_INTERVAL", 3600))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", 100))
+RETENTION_DRY_RUN = os.getenv("RETENTION_DRY_RUN", "false").lower() == "true"
+RETENTION_BLOB_GC = os.getenv("RETENTION_BLOB_GC", "true").lower() == "true"
+
+# Backends that can list inactive threads from their own timestamps
+TIMESTAMPED_BACKENDS = ("elasticsearch", "elasticsearch_messages")
+
+MATCH_FIELDS = ("channel", "user", "io_type")
+RULE_FIELDS = MATCH_FIELDS + ("days", "reacted_days")
+
+
+def _parse_rules(text):
+    rules = json.loads(text) if text else []
+    if not isinstance(rules, list) or not all(isinstance(rule, dict) for rule in rules):
+        raise ValueError("RETENTION_RULES must be a JSON list of objects")
+    for rule in rules:
+        unknown = set(rule) - set(RULE_FIELDS)
+        if unknown:
+            raise ValueError(f"Unknown field(s) in retention rule {rule}: {', '.join(sorted(unknown))}")
+    return rules
+
+
+RETENTION_RULES = _parse_rules(os.getenv("RETENTION_RULES", ""))
+
+_stats = {"sweeps": 0, "checked": 0, "deleted": 0, "deleted_untracked": 0, "blobs_collected": 0,
+          "last_sweep_at": None, "last_error": None}
+_stats_lock = threading.Lock()
+
+
+def _rule_for(row):
+    for rule in RETENTION_RULES:
+        if all(rule[field] == row.get(field) for field in MATCH_FIELDS if field in rule):
+            return rule
+    return {}
+
+
+def retention_days(row):
+    """The retention period in days for a catalog row, or None to keep it forever."""
+    rule = _rule_for(row)
+    days = rule.get("days", RETENTION_DAYS)
+    if row.get("reaction"):
+        if rule.get("reacted_days") is not None:
+            days = rule["reacted_days"]
+        elif RETENTION_REACTED_DAYS is not None:
+            days = RETENTION_REACTED_DAYS
+    return days if days and days > 0 else None
+
+
+def _shortest_period():
+    periods = [RETENTION_DAYS, RETENTION_REACTED_DAYS or 0]
+    for rule in RETENTION_RULES:
+        periods += [rule.get("days") or 0, rule.get("reacted_days") or 0]
+    periods = [days for days in periods if days > 0]
+    return min(periods) if periods else None
+
+
+def _longest_period():
+    """The longest period any thread can get, or None when some threads are kept forever."""
+    periods = []
+    # Every rule, plus {} for the threads that match none, as retention_days() resolves them
+    for rule in RETENTION_RULES + [{}]:
+        days = rule.get("days", RETENTION_DAYS)
+        if rule.get("reacted_days") is not None:
+            reacted = rule["reacted_days"]
+        elif RETENTION_REACTED_DAYS is not None:
+            reacted = RETENTION_REACTED_DAYS
+        else:
+            reacted = days
+        periods += [days, reacted]
+    if any(not days or days <= 0 for days in periods):
+        return None
+    return max(periods)
+
+
+def enabled():
+    return _shortest_period() is not None
+
+
+def is_expired(row, now):
+    days = retention_days(row)
+    if days is None:
+        return False
+    return datetime.fromisoformat(row["last_activity"]) < now - timedelta(days=days)
+
+
+def _delete_batch(thread_ids, now, dry_run, logger=None):
+    # Look again just before deleting: a thread may have had activity since its page was read
+    rows = [thread_catalog.get_thread(thread_ts) for thread_ts in thread_ids]
+    expired = [row["thread_ts"] for row in rows if row and is_expired(row, now)]
+    if expired and not dry_run:
+        generic_storage.delete_threads(expired, logger)
+    if logger and expired:
+        logger.info(f"{'Would delete' if dry_run else 'Deleted'} {len(expired)} expired thread(s).")
+    return expired
+
+
+def _sweep_untracked(now, dry_run, logger=None):
+    """Delete threads the catalog doesn't know from the timestamped backends, past the longest period."""
+    longest = _longest_period()
+    if longest is None:
+        return 0
+    before = (now - timedelta(days=longest)).isoformat()
+    deleted = 0
+    for backend in generic_storage.STORAGE_BACKENDS:
+        if backend not in TIMESTAMPED_BACKENDS:
+            continue
+        batch = []
+        for thread_ts in generic_storage.inactive_thread_ids_on(backend, before):
+            if thread_catalog.get_thread(thread_ts) is None:
+                batch.append(thread_ts)
+            if len(batch) >= RETENTION_BATCH_SIZE:
+                deleted += _delete_untracked(backend, batch, dry_run, logger)
+                batch = []
+        if batch:
+            deleted += _delete_untracked(backend, batch, dry_run, logger)
+    return deleted
+
+
+def _delete_untracked(backend, thread_ids, dry_run, logger=None):
+    if not dry_run:
+        if backend == generic_storage.STORAGE_PRIMARY:
+            generic_storage.delete_threads(thread_ids, logger)
+        else:
+            generic_storage.delete_threads_on(backend, thread_ids, logger)
+    if logger:
+        logger.info(f"{'Would delete' if dry_run else 'Deleted'} {len(thread_ids)} expired thread(s) "
+                    f"unknown to the catalog from {backend}.")
+    return len(thread_ids)
+
+
+def collect_blobs(dry_run=False, logger=None):
+    """Mark every blob referenced from the primary backend, then sweep the rest from the blob store."""
+    referenced = set()
+    backend = generic_storage.STORAGE_PRIMARY
+    for thread_ts in generic_storage.list_thread_ids_on(backend):
+        for message in generic_storage.read_messages_on(backend, thread_ts, logger=logger):
+            if message:
+                referenced |= blob_store.references(message.get("content"))
+    return blob_store.collect_garbage(referenced, dry_run=dry_run, logger=logger)
+
+
+def sweep(now=None, dry_run=RETENTION_DRY_RUN, logger=None):
+    """
+    Delete every thread past its retention period, then collect the blobs
+    no thread references any more. Returns {"checked", "deleted",
+    "deleted_untracked", "blobs_collected"}.
+    """
+    shortest = _shortest_period()
+    if shortest is None:
+        return {"checked": 0, "deleted": 0, "deleted_untracked": 0, "blobs_collected": 0}
+    now = now or datetime.now(timezone.utc)
+    checked = deleted = 0
+    batch, cursor = [], None
+    while True:
+        # Keyset paging is not disturbed by the rows deleted behind it
+        rows, cursor = thread_catalog.list_threads(
+            sort="last_activity", order="asc", limit=thread_catalog.THREAD_CATALOG_MAX_PAGE_SIZE,
+            cursor=cursor, active_before=(now - timedelta(days=shortest)).isoformat())
+        for row in rows:
+            checked += 1
+            if is_expired(row, now):
+                batch.append(row["thread_ts"])
+            if len(batch) >= RETENTION_BATCH_SIZE:
+                deleted += len(_delete_batch(batch, now, dry_run, logger))
+                batch = []
+        if cursor is None:
+            break
+    if batch:
+        deleted += len(_delete_batch(batch, now, dry_run, logger))
+    untracked = _sweep_untracked(now, dry_run, logger)
+    # Blobs only become garbage when threads go
+    blobs = 0
+    if RETENTION_BLOB_GC and (deleted or untracked):
+        blobs = collect_blobs(dry_run, logger)["collected"]
+    with _stats_lock:
+        _stats["sweeps"] += 1
+        _stats["checked"] += checked
+        if not dry_run:
+            _stats["deleted"] += deleted
+            _stats["deleted_untracked"] += untracked
+            _stats["blobs_collected"] += blobs
+        _stats["last_sweep_at"] = now.isoformat()
+        _stats["last_error"] = None
+    if logger:
+        logger.info(f"Retention sweep checked {checked} thread(s), {'would delete' if dry_run else 'deleted'} "
+                    f"{deleted} (+{untracked} unknown to the catalog), {blobs} blob(s).")
+    return {"checked": checked, "deleted": deleted, "deleted_untracked": untracked, "blobs_collected": blobs}
+
+
+def sweep_loop(logger=None):
+    """Run sweep() every RETENTION_SWEEP_INTERVAL seconds; errors are logged and retried next round."""
+    while True:
+        try:
+            sweep(logger=logger)
+        except Exception as e:
+            with _stats_lock:
+                _stats["last_error"] = str(e)
+            if logger:
+                logger.exception(f"Retention sweep failed: {e}")
+        time.sleep(RETENTION_SWEEP_INTERVAL)
+
+
+def start(logger=None):
+    """Start the background sweeper (no-op when every retention period is 0)."""
+    if not enabled():
+        return None
+    thread = threading.Thread(target=sweep_loop, args=(logger,), name="retention", daemon=True)
+    thread.start()
+    return thread
+
+
+def retention_stats():
+    with _stats_lock:
+        return dict(_stats, enabled=enabled())
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Thread retention tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sweep_parser = sub.add_parser("sweep", help="delete threads past their retention period")
+    sweep_parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+    gc_parser = sub.add_parser("gc-blobs", help="delete blobs no stored message references")
+    gc_parser.add_argument("--dry-run", action="store_true", help="only report what would be deleted")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("Retention")
+    if args.command == "sweep":
+        print(json.dumps(sweep(dry_run=args.dry_run or RETENTION_DRY_RUN, logger=logger)))
+    elif args.command == "gc-blobs":
+        print(json.dumps(collect_blobs(dry_run=args.dry_run, logger=logger)))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,7 @@ from flask import jsonify
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
 SLACK_POST_URL = os.getenv("slack_post_url")
 SLACK_AUTH_URL = os.getenv("slack_auth_url")
+SLACK_UPDATE_URL = os.getenv("slack_update_url", "https://slack.com/api/chat.update")
 SLACK_SIGNING_SECRET = os.getenv("SLACK_SIGNING_SECRET")
 
 def _slack_headers():
@@ -20,7 +21,7 @@ def _slack_headers():
     }
 
 def post_message_to_slack(channel, text, thread_ts=None):
-    """Posts a message to a Slack channel (optionally in a thread)."""
+    """Posts a message to a Slack channel (optionally in a thread). Returns the message ts or None."""
     payload = {
         "channel": channel,
         "text": text,
@@ -31,8 +32,24 @@ def post_message_to_slack(channel, text, thread_ts=None):
     
     if response.status_code != 200 or not response.json().get("ok"):
         logging.error("Failed to send message to Slack: %s", response.text)
-    else:
-        logging.info("Message sent to Slack channel %s", channel)
+        return None
+    logging.info("Message sent to Slack channel %s", channel)
+    return response.json().get("ts")
+
+def update_slack_message(channel, ts, text):
+    """Replaces the text of a message previously posted by the bot (chat.update)."""
+    payload = {
+        "channel": channel,
+        "ts": ts,
+        "text": text
+    }
+
+    response = requests.post(SLACK_UPDATE_URL, headers=_slack_headers(), json=payload)
+
+    if response.status_code != 200 or not response.json().get("ok"):
+        logging.error("Failed to update Slack message %s: %s", ts, response.text)
+        return False
+    return True
 
 def get_bot_user_id():
     """Fetches and returns the bot's user ID from Slack."""
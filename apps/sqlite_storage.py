@@ -0,0 +1,283 @@
+# sqlite_storage.py
+"""
+SQLite storage backend (STORAGE_BACKENDS=sqlite).
+
+One database file (SQLITE_PATH) in WAL mode, shared by every worker process
+on the node: readers never block the writer, and writers queue on the
+database lock for up to SQLITE_BUSY_TIMEOUT_MS instead of failing.
+
+  threads   one row per thread: message_count, summary_index, reaction,
+            created_at, updated_at, version (bumped on every write)
+  messages  one row per message, primary key (thread_ts, seq)
+
+Appends insert only the new rows. Full, tail and summary-aware context
+reads are each one query on the (thread_ts, seq) key. Statements are fixed,
+parameterised strings, so sqlite3's statement cache reuses them prepared.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+SQLITE_PATH = os.getenv("SQLITE_PATH", "argonaut.db")
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 5000))
+# NORMAL is durable across application crashes in WAL mode; FULL also survives power loss
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_ts TEXT PRIMARY KEY,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    summary_index INTEGER,
+    reaction TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS messages (
+    thread_ts TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT,
+    content TEXT,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (thread_ts, seq)
+) WITHOUT ROWID;
+"""
+
+_RESERVE_SQL = """
+INSERT INTO threads (thread_ts, message_count, created_at, updated_at, version)
+VALUES (?, ?, ?, ?, 1)
+ON CONFLICT (thread_ts) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    updated_at = excluded.updated_at,
+    version = version + 1
+"""
+_COUNT_SQL = "SELECT message_count FROM threads WHERE thread_ts = ?"
+_INSERT_MESSAGE_SQL = "INSERT INTO messages (thread_ts, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)"
+_HEADER_SQL = "SELECT message_count, summary_index, reaction, created_at, updated_at FROM threads WHERE thread_ts = ?"
+_VERSION_SQL = "SELECT version FROM threads WHERE thread_ts = ?"
+_ALL_MESSAGES_SQL = "SELECT role, content FROM messages WHERE thread_ts = ? ORDER BY seq"
+_AFTER_SQL = "SELECT role, content FROM messages WHERE thread_ts = ? AND seq > ? ORDER BY seq LIMIT ?"
+_TAIL_SQL = """
+SELECT role, content FROM messages
+WHERE thread_ts = ? AND seq >= (SELECT message_count - ? FROM threads WHERE thread_ts = ?)
+ORDER BY seq
+"""
+# messages[0], messages[summary_index] and everything after it; the full
+# thread when there is no valid summary_index
+_CONTEXT_SQL = """
+SELECT role, content FROM messages
+WHERE thread_ts = ? AND (seq = 0 OR seq >= COALESCE(
+    (SELECT CASE WHEN summary_index < message_count THEN summary_index END FROM threads WHERE thread_ts = ?), 0))
+ORDER BY seq
+"""
+_SUMMARY_INDEX_SQL = """
+UPDATE threads SET summary_index = COALESCE(?, message_count - 1), updated_at = ?, version = version + 1
+WHERE thread_ts = ? AND message_count > 0
+"""
+_REACTION_SQL = "UPDATE threads SET reaction = ?, updated_at = ?, version = version + 1 WHERE thread_ts = ?"
+_CREATED_AT_SQL = "UPDATE threads SET created_at = ?, version = version + 1 WHERE thread_ts = ?"
+_DELETE_MESSAGES_SQL = "DELETE FROM messages WHERE thread_ts = ?"
+_DELETE_THREAD_SQL = "DELETE FROM threads WHERE thread_ts = ?"
+
+_local = threading.local()
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def get_connection():
+    """Per-thread connection, reopened after a fork (SQLite handles must not cross processes)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    conn = sqlite3.connect(SQLITE_PATH, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                           isolation_level=None, cached_statements=64)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+@contextmanager
+def _write_transaction(conn):
+    # IMMEDIATE takes the write lock up front, so two appends can't both read the same message_count
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+
+def ensure_index_exists(logger=None):
+    """Create the database schema if needed (once per process)."""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        directory = os.path.dirname(SQLITE_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        get_connection().executescript(_SCHEMA)
+        _schema_ready = True
+        if logger:
+            logger.info(f"SQLite storage ready at '{SQLITE_PATH}'.")
+
+
+def append_messages(thread_ts, messages, logger=None):
+    """Append a batch of messages in one transaction, creating the thread if needed."""
+    if not messages:
+        return
+    ensure_index_exists(logger)
+    now = _now()
+    roles = ", ".join(m.get("role", "") for m in messages)
+    with _write_transaction(get_connection()) as conn:
+        conn.execute(_RESERVE_SQL, (thread_ts, len(messages), now, now))
+        count = conn.execute(_COUNT_SQL, (thread_ts,)).fetchone()[0]
+        first_seq = count - len(messages)
+        conn.executemany(_INSERT_MESSAGE_SQL, [
+            (thread_ts, first_seq + i, m.get("role"), m.get("content"), now) for i, m in enumerate(messages)
+        ])
+    if logger:
+        if first_seq == 0:
+            logger.info(f"New thread {thread_ts} created with {len(messages)} message(s) from {roles}.")
+        else:
+            logger.info(f"Thread {thread_ts} updated with {len(messages)} message(s) from {roles}.")
+
+
+def update_message(thread_ts, role, content, logger=None):
+    append_messages(thread_ts, [{"role": role, "content": content}], logger)
+
+
+def _rows_to_messages(rows):
+    return [{"role": role, "content": content} for role, content in rows]
+
+
+def load_header(thread_ts):
+    ensure_index_exists()
+    row = get_connection().execute(_HEADER_SQL, (thread_ts,)).fetchone()
+    if row is None:
+        return None
+    header = {"message_count": row[0], "created_at": row[3], "updated_at": row[4]}
+    if row[1] is not None:
+        header["summary_index"] = row[1]
+    if row[2] is not None:
+        header["reaction"] = row[2]
+    return header
+
+
+def load_thread(thread_ts, logger=None):
+    """Return the whole thread document (header fields plus messages) or None."""
+    conn = get_connection()
+    ensure_index_exists(logger)
+    # One read transaction so header and messages come from the same snapshot
+    conn.execute("BEGIN")
+    try:
+        header = load_header(thread_ts)
+        if header is not None:
+            header["messages"] = _rows_to_messages(conn.execute(_ALL_MESSAGES_SQL, (thread_ts,)))
+    finally:
+        conn.execute("COMMIT")
+    return header
+
+
+def list_threads():
+    """All thread ids, in id order."""
+    ensure_index_exists()
+    return [row[0] for row in get_connection().execute("SELECT thread_ts FROM threads ORDER BY thread_ts")]
+
+
+def thread_version(thread_ts):
+    """Cheap change marker for caches: the row's write counter."""
+    ensure_index_exists()
+    row = get_connection().execute(_VERSION_SQL, (thread_ts,)).fetchone()
+    return row[0] if row else None
+
+
+def read_messages(thread_ts, after_seq=None, limit=None):
+    """Messages with seq > after_seq (all when None), at most limit of them."""
+    ensure_index_exists()
+    rows = get_connection().execute(_AFTER_SQL, (thread_ts, -1 if after_seq is None else after_seq,
+                                                 -1 if limit is None else limit))
+    return _rows_to_messages(rows)
+
+
+def tail_messages(thread_ts, count):
+    """The last count messages of a thread."""
+    ensure_index_exists()
+    return _rows_to_messages(get_connection().execute(_TAIL_SQL, (thread_ts, count, thread_ts)))
+
+
+def get_thread_messages(thread_ts, logger=None):
+    """Retrieve conversation messages for a given thread_ts, summary-aware, in one query."""
+    ensure_index_exists(logger)
+    save_token_use_summary = os.getenv("SAVE_TOKEN_USE_SUMMARY", "false").lower() == "true"
+    conn = get_connection()
+    if save_token_use_summary:
+        rows = conn.execute(_CONTEXT_SQL, (thread_ts, thread_ts))
+    else:
+        rows = conn.execute(_ALL_MESSAGES_SQL, (thread_ts,))
+    messages = _rows_to_messages(rows)
+    if not messages and logger:
+        logger.info(f"Thread {thread_ts} not found.")
+    return messages
+
+
+def set_summary_index(thread_ts, logger=None, summary_index=None):
+    """Set summary_index on the thread (default: the last message)."""
+    ensure_index_exists(logger)
+    with _write_transaction(get_connection()) as conn:
+        updated = conn.execute(_SUMMARY_INDEX_SQL, (summary_index, _now(), thread_ts)).rowcount
+    if not updated:
+        if logger:
+            logger.warning(f"Thread {thread_ts} not found or has no messages.")
+        return False
+    if logger:
+        logger.info(f"summary_index set for thread {thread_ts}.")
+    return True
+
+
+def update_reaction(thread_ts, reaction, logger=None):
+    """Update the reaction field of the thread."""
+    ensure_index_exists(logger)
+    with _write_transaction(get_connection()) as conn:
+        updated = conn.execute(_REACTION_SQL, (reaction, _now(), thread_ts)).rowcount
+    if not updated:
+        if logger:
+            logger.warning(f"Thread {thread_ts} not found.")
+        return False
+    if logger:
+        logger.info(f"Reaction updated for thread {thread_ts}.")
+    return True
+
+
+def set_created_at(thread_ts, created_at, logger=None):
+    """Overwrite created_at (used when threads are copied from another backend)."""
+    ensure_index_exists(logger)
+    with _write_transaction(get_connection()) as conn:
+        updated = conn.execute(_CREATED_AT_SQL, (created_at, thread_ts)).rowcount
+    if not updated and logger:
+        logger.warning(f"Thread {thread_ts} not found.")
+    return bool(updated)
+
+
+def delete_threads(thread_ids, logger=None):
+    """Delete whole threads, messages and header rows, in one transaction. Returns how many existed."""
+    ensure_index_exists(logger)
+    rows = [(thread_ts,) for thread_ts in thread_ids]
+    with _write_transaction(get_connection()) as conn:
+        conn.executemany(_DELETE_MESSAGES_SQL, rows)
+        deleted = conn.executemany(_DELETE_THREAD_SQL, rows).rowcount
+    if logger:
+        logger.info(f"Deleted {deleted} thread(s).")
+    return deleted
@@ -0,0 +1,558 @@
+# storage_migrate.py
+"""
+Bulk copy of conversation history between storage backends.
+
+Reads every thread from one backend (file_storage, elasticsearch,
+elasticsearch_messages, sqlite) or from an export file (jsonl:<path>, gzip
+when the path ends in .gz) and writes it to another backend or export file.
+
+  - Messages are streamed in pages of --batch-size, so memory does not grow
+    with thread length (a file_storage log is read through once). The one
+    exception is an elasticsearch source, which keeps each thread in a
+    single document that has to be read whole.
+  - Elasticsearch targets are written with _bulk requests of up to
+    --batch-size actions / MIGRATE_BULK_MAX_BYTES, spanning threads. A
+    request that fails is kept and sent again with the next one; threads
+    with rejected documents are reported as failed and not checkpointed.
+    Other backends get one append per page.
+  - The header (created_at, updated_at, summary_index, reaction) is copied
+    with the messages, and every thread copied to a backend is merged into
+    the thread catalog with the source's updated_at as its last activity.
+    A source thread without updated_at is logged and counted as active at
+    the time of the copy, so retention never takes it for an idle one.
+  - --workers threads copy different threads in parallel (export files are
+    read and written by one worker, as they are a single stream).
+  - Finished threads are recorded in a checkpoint file. A re-run skips
+    them, and resumes a half-copied thread after the messages the target
+    already has, so an interrupted copy can be restarted as often as needed.
+  - Progress and throughput (threads/s, messages/s, MB/s) are logged every
+    MIGRATE_REPORT_INTERVAL seconds and printed as JSON at the end.
+
+Examples:
+    python storage_migrate.py --source file_storage --target elasticsearch_messages --workers 8
+    python storage_migrate.py --source elasticsearch --target jsonl:threads.jsonl.gz
+    python storage_migrate.py --source jsonl:threads.jsonl.gz --target sqlite
+
+Moving file_storage threads to another FS_LAYOUT is done in place by
+`python file_storage.py migrate-layout`.
+"""
+import os
+import gzip
+import json
+import time
+import queue
+import logging
+import argparse
+import threading
+import itertools
+
+from elasticsearch import helpers
+
+import generic_storage
+import file_storage
+import elastic
+import elastic_messages
+import thread_catalog
+
+MIGRATE_BATCH_SIZE = int(os.getenv("MIGRATE_BATCH_SIZE", 500))
+MIGRATE_BULK_MAX_BYTES = int(os.getenv("MIGRATE_BULK_MAX_BYTES", 10 * 1024 * 1024))
+MIGRATE_WORKERS = int(os.getenv("MIGRATE_WORKERS", 4))
+MIGRATE_REPORT_INTERVAL = float(os.getenv("MIGRATE_REPORT_INTERVAL", 10))
+
+BACKENDS = generic_storage.BACKENDS
+# Header fields carried over besides the messages
+HEADER_FIELDS = ("created_at", "updated_at", "summary_index", "reaction")
+
+# elasticsearch target: append a page only if the document holds exactly the messages before it
+_APPEND_AT_SCRIPT = """
+if (ctx._source.messages == null) { ctx._source.messages = []; }
+if (ctx._source.messages.size() == params.start) { ctx._source.messages.addAll(params.messages); }
+else { ctx.op = 'noop'; }
+"""
+
+
+def _export_path(name):
+    return name[len("jsonl:"):] if name.startswith("jsonl:") else None
+
+
+def _open_export(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def _size(messages):
+    return sum(len(m.get("content") or "") for m in messages)
+
+
+# ---------------------------------------------------------------- sources
+
+def _backend_pages(backend, thread_ts, start, batch_size):
+    """Pages of a thread's messages from seq start on."""
+    if backend == "elasticsearch":
+        # One document per thread: read it once and slice it
+        messages = generic_storage.read_messages_on(backend, thread_ts, start - 1 if start else None)
+        for i in range(0, len(messages), batch_size):
+            yield messages[i:i + batch_size]
+        return
+    if backend == "file_storage":
+        # One pass over the log; paging through read_messages would rescan it for every page
+        messages = file_storage.iter_messages(thread_ts, start - 1 if start else None)
+        while True:
+            page = list(itertools.islice(messages, batch_size))
+            if not page:
+                return
+            yield page
+    seq = start
+    while True:
+        page = generic_storage.read_messages_on(backend, thread_ts, seq - 1 if seq else None, batch_size)
+        if page:
+            yield page
+        if len(page) < batch_size:
+            return
+        seq += len(page)
+
+
+def _backend_threads(backend, batch_size):
+    """Yield (thread_ts, header, pages) where pages(start) streams the messages from seq start."""
+    for thread_ts in generic_storage.list_thread_ids_on(backend):
+        header = generic_storage.load_header_on(backend, thread_ts)
+        if header is None:
+            continue
+        yield thread_ts, header, lambda start, ts=thread_ts: _backend_pages(backend, ts, start, batch_size)
+
+
+def _export_threads(path, batch_size):
+    """
+    Read an export file: a {"thread_ts", "header"} line per thread followed
+    by {"thread_ts", "seq", "message"} lines. Duplicate lines from an
+    interrupted export are dropped by seq.
+    """
+    with _open_export(path, "r") as f:
+        lines = (json.loads(line) for line in f if line.strip())
+        pending = None
+        for record in lines:
+            if "header" in record:
+                pending = record
+                break
+        while pending is not None:
+            thread_ts, header = pending["thread_ts"], pending["header"]
+            pending = None
+
+            def pages(start):
+                nonlocal pending
+                page, expected = [], 0
+                for record in lines:
+                    if "header" in record:
+                        pending = record
+                        break
+                    if record["seq"] != expected:
+                        # A repeat of messages already read
+                        continue
+                    expected += 1
+                    if record["seq"] >= start:
+                        page.append(record["message"])
+                    if len(page) >= batch_size:
+                        yield page
+                        page = []
+                if page:
+                    yield page
+
+            yield thread_ts, header, pages
+            if pending is None:
+                # The consumer skipped this thread; move on to the next header
+                for _ in pages(float("inf")):
+                    pass
+
+
+# ---------------------------------------------------------------- targets
+
+class _BackendWriter:
+    """One append per page through generic_storage.apply_write."""
+
+    def __init__(self, backend, logger=None):
+        self.backend = backend
+        self.logger = logger
+        self._finished = []
+
+    def message_count(self, thread_ts):
+        header = generic_storage.load_header_on(self.backend, thread_ts)
+        return header.get("message_count", 0) if header else 0
+
+    def begin(self, thread_ts, header):
+        pass
+
+    def write(self, thread_ts, start_seq, messages):
+        generic_storage.apply_write(self.backend, "append", thread_ts, {"messages": messages})
+
+    def finish(self, thread_ts, header):
+        if header.get("created_at") is not None:
+            generic_storage.apply_write(self.backend, "created_at", thread_ts, {"created_at": header["created_at"]})
+        if header.get("summary_index") is not None:
+            generic_storage.apply_write(self.backend, "summary_index", thread_ts,
+                                        {"summary_index": header["summary_index"]})
+        if header.get("reaction") is not None:
+            generic_storage.apply_write(self.backend, "reaction", thread_ts, {"reaction": header["reaction"]})
+        self._finished.append(thread_ts)
+
+    def completed(self):
+        """Threads completely stored since the last call."""
+        finished, self._finished = self._finished, []
+        return finished
+
+    def failed(self):
+        """Threads found to be incompletely stored since the last call."""
+        return []
+
+    def flush(self):
+        """Write anything buffered; return the threads that are now completely stored."""
+        return self.completed()
+
+    def close(self):
+        pass
+
+
+class _BulkWriter(_BackendWriter):
+    """Buffers Elasticsearch bulk actions across threads; one _bulk request per batch."""
+
+    def __init__(self, backend, logger=None, batch_size=MIGRATE_BATCH_SIZE):
+        super().__init__(backend, logger)
+        self.batch_size = batch_size
+        self._actions = []
+        self._bytes = 0
+        self._done_in_batch = []
+        self._counts = {}
+        # Document id -> thread, to map per-item bulk errors back to threads
+        self._action_threads = {}
+        self._failed = set()
+        self._failed_since = []
+        self.errors = 0
+
+    def _add(self, thread_ts, action, size):
+        self._actions.append(action)
+        self._action_threads[action["_id"]] = thread_ts
+        self._bytes += size
+        if len(self._actions) >= self.batch_size or self._bytes >= MIGRATE_BULK_MAX_BYTES:
+            self._send()
+
+    def _send(self):
+        if self._actions:
+            # A transport error raises here and leaves the request buffered, to be sent again with the next one
+            _, errors = helpers.bulk(elastic.get_es_client(), self._actions, chunk_size=len(self._actions),
+                                     max_chunk_bytes=MIGRATE_BULK_MAX_BYTES * 2, refresh=False,
+                                     raise_on_error=False)
+            failed = {self._action_threads.get(next(iter(item.values())).get("_id")) for item in errors} - {None}
+            if errors:
+                self.errors += len(errors)
+                if self.logger:
+                    self.logger.error("%d document(s) rejected for %d thread(s): %s", len(errors), len(failed),
+                                      next(iter(errors[0].values())).get("error"))
+                self._mark_failed(failed - self._failed)
+        done = [thread_ts for thread_ts in self._done_in_batch if thread_ts not in self._failed]
+        self._actions, self._bytes, self._done_in_batch, self._action_threads = [], 0, [], {}
+        self._finished.extend(done)
+
+    def _mark_failed(self, thread_ids):
+        """Keep these threads out of the checkpoint; their remaining writes are wasted but harmless."""
+        self._failed.update(thread_ids)
+        self._failed_since.extend(thread_ids)
+
+    def finish(self, thread_ts, header):
+        self._done_in_batch.append(thread_ts)
+
+    def failed(self):
+        failed, self._failed_since = self._failed_since, []
+        return failed
+
+    def flush(self):
+        self._send()
+        return self.completed()
+
+
+class _MessagesIndexWriter(_BulkWriter):
+    """elasticsearch_messages: message documents with explicit ids, so replays overwrite instead of duplicating."""
+
+    def __init__(self, logger=None, batch_size=MIGRATE_BATCH_SIZE):
+        super().__init__("elasticsearch_messages", logger, batch_size)
+        elastic_messages.ensure_index_exists(logger)
+
+    def write(self, thread_ts, start_seq, messages):
+        now = elastic_messages._now()
+        for i, message in enumerate(messages):
+            self._add(thread_ts, elastic_messages._message_doc(thread_ts, start_seq + i, message, now),
+                      _size([message]))
+        self._counts[thread_ts] = start_seq + len(messages)
+
+    def _mark_failed(self, thread_ids):
+        super()._mark_failed(thread_ids)
+        # A resume starts after the header's message_count, so a header over missing messages has to go
+        es = elastic.get_es_client()
+        for thread_ts in thread_ids:
+            es.delete(index=elastic_messages.ES_THREADS_INDEX, id=thread_ts, ignore=404)
+
+    def finish(self, thread_ts, header):
+        # The header goes last: until it is written, a resume starts the thread over
+        count = self._counts.pop(thread_ts, header.get("message_count", 0))
+        if thread_ts in self._failed:
+            return
+        updated_at = header.get("updated_at") or elastic_messages._now()
+        created_at = header.get("created_at") or updated_at
+        source = {"thread_ts": thread_ts, "message_count": count, "created_at": created_at, "updated_at": updated_at}
+        source.update({f: header[f] for f in ("summary_index", "reaction") if header.get(f) is not None})
+        self._add(thread_ts, {"_index": elastic_messages.ES_THREADS_INDEX, "_id": thread_ts, "_source": source}, 0)
+        super().finish(thread_ts, header)
+
+    def close(self):
+        self.flush()
+        elastic.get_es_client().indices.refresh(index=[elastic_messages.ES_THREADS_INDEX,
+                                                      elastic_messages.ES_MESSAGES_INDEX])
+
+
+class _DocumentIndexWriter(_BulkWriter):
+    """elasticsearch: scripted appends to the thread document, in order within one _bulk request."""
+
+    def __init__(self, logger=None, batch_size=MIGRATE_BATCH_SIZE):
+        super().__init__("elasticsearch", logger, batch_size)
+        elastic.ensure_index_exists(logger)
+
+    def write(self, thread_ts, start_seq, messages):
+        # Append only where the page belongs, so a request sent again after an error does not duplicate it
+        self._add(thread_ts, {
+            "_op_type": "update", "_index": elastic.ES_INDEX, "_id": thread_ts,
+            "retry_on_conflict": elastic.ES_RETRY_ON_CONFLICT,
+            "script": {"source": _APPEND_AT_SCRIPT, "lang": "painless",
+                       "params": {"messages": messages, "start": start_seq}},
+            "upsert": {"messages": messages}
+        }, _size(messages))
+
+    def finish(self, thread_ts, header):
+        fields = {f: header[f] for f in HEADER_FIELDS if header.get(f) is not None}
+        if fields:
+            self._add(thread_ts, {"_op_type": "update", "_index": elastic.ES_INDEX, "_id": thread_ts,
+                                  "retry_on_conflict": elastic.ES_RETRY_ON_CONFLICT, "doc": fields, "doc_as_upsert": True}, 0)
+        super().finish(thread_ts, header)
+
+    def close(self):
+        self.flush()
+        elastic.get_es_client().indices.refresh(index=elastic.ES_INDEX)
+
+
+class _ExportWriter(_BackendWriter):
+    def __init__(self, path, logger=None):
+        super().__init__(None, logger)
+        self._file = _open_export(path, "a")
+
+    def message_count(self, thread_ts):
+        return 0
+
+    def write(self, thread_ts, start_seq, messages):
+        self._file.writelines(json.dumps({"thread_ts": thread_ts, "seq": start_seq + i, "message": m},
+                                         ensure_ascii=False) + "\n" for i, m in enumerate(messages))
+
+    def begin(self, thread_ts, header):
+        self._file.write(json.dumps({"thread_ts": thread_ts, "header": header}, ensure_ascii=False) + "\n")
+
+    def finish(self, thread_ts, header):
+        self._finished.append(thread_ts)
+
+    def flush(self):
+        self._file.flush()
+        return self.completed()
+
+    def close(self):
+        self._file.close()
+
+
+def _make_writer(target, logger=None, batch_size=MIGRATE_BATCH_SIZE):
+    if _export_path(target):
+        return _ExportWriter(_export_path(target), logger)
+    if target == "elasticsearch_messages":
+        return _MessagesIndexWriter(logger, batch_size)
+    if target == "elasticsearch":
+        return _DocumentIndexWriter(logger, batch_size)
+    if target in BACKENDS:
+        return _BackendWriter(target, logger)
+    raise ValueError(f"Unknown target {target!r}")
+
+
+# ---------------------------------------------------------------- copy
+
+class Checkpoint:
+    """Append-only file of finished thread ids."""
+
+    def __init__(self, path):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.done = {line.strip() for line in f if line.strip()}
+        self._file = open(path, "a", encoding="utf-8") if path else None
+
+    def mark(self, thread_ids):
+        if not thread_ids:
+            return
+        with self._lock:
+            self.done.update(thread_ids)
+            if self._file:
+                self._file.writelines(f"{thread_ts}\n" for thread_ts in thread_ids)
+                self._file.flush()
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+
+class Progress:
+    def __init__(self, logger=None):
+        self.logger = logger
+        self.started = time.monotonic()
+        self.threads = self.skipped = self.messages = self.bytes = self.failed = 0
+        self._lock = threading.Lock()
+
+    def add(self, **counts):
+        with self._lock:
+            for key, n in counts.items():
+                setattr(self, key, getattr(self, key) + n)
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "threads": self.threads, "skipped": self.skipped, "failed": self.failed,
+            "messages": self.messages, "megabytes": round(self.bytes / 1e6, 3),
+            "elapsed_seconds": round(elapsed, 3),
+            "threads_per_second": round(self.threads / elapsed, 2),
+            "messages_per_second": round(self.messages / elapsed, 2),
+            "megabytes_per_second": round(self.bytes / 1e6 / elapsed, 3),
+        }
+
+    def report(self):
+        if self.logger:
+            s = self.summary()
+            self.logger.info("Copied %d thread(s), %d message(s) (%.1f msg/s, %.2f MB/s), %d skipped, %d failed",
+                             s["threads"], s["messages"], s["messages_per_second"], s["megabytes_per_second"],
+                             s["skipped"], s["failed"])
+
+
+def _updated_at(thread_ts, header, logger=None):
+    """The source's last write time; without one the thread counts as written now, never as idle since created_at."""
+    if header.get("updated_at"):
+        return header["updated_at"]
+    if logger:
+        logger.warning(f"Thread {thread_ts} has no updated_at in the source; using the time of the copy.")
+    return thread_catalog._now()
+
+
+def _copy_thread(thread_ts, header, pages, writer, progress, logger=None):
+    header = dict(header, updated_at=_updated_at(thread_ts, header, logger))
+    start = writer.message_count(thread_ts)
+    writer.begin(thread_ts, {f: header[f] for f in HEADER_FIELDS if header.get(f) is not None})
+    seq = start
+    for page in pages(start):
+        writer.write(thread_ts, seq, page)
+        seq += len(page)
+        progress.add(messages=len(page), bytes=_size(page))
+    writer.finish(thread_ts, header)
+    if writer.backend is not None:
+        thread_catalog.record_thread(thread_ts, header.get("created_at") or header["updated_at"], header["updated_at"],
+                                     seq, header.get("reaction"), logger)
+    progress.add(threads=1)
+
+
+def _copy_all(tasks, target, checkpoint, progress, logger=None, batch_size=MIGRATE_BATCH_SIZE):
+    """Copy each (thread_ts, header, pages) task with one writer; used by every worker."""
+    writer = _make_writer(target, logger, batch_size)
+    try:
+        for thread_ts, header, pages in tasks:
+            try:
+                _copy_thread(thread_ts, header, pages, writer, progress, logger)
+            except Exception as e:
+                progress.add(failed=1)
+                if logger:
+                    logger.error("Copying thread %s failed: %s", thread_ts, e)
+            checkpoint.mark(writer.completed())
+            progress.add(failed=len(writer.failed()))
+        try:
+            checkpoint.mark(writer.flush())
+        except Exception as e:
+            # The buffered threads stay out of the checkpoint, so the next run copies them again
+            if logger:
+                logger.error("Final bulk request failed: %s", e)
+        progress.add(failed=len(writer.failed()))
+    finally:
+        writer.close()
+
+
+def migrate(source, target, workers=MIGRATE_WORKERS, batch_size=MIGRATE_BATCH_SIZE, checkpoint_path=None,
+            thread_ids=None, logger=None):
+    """Copy every thread (or just thread_ids) from source to target. Returns the throughput summary."""
+    if source == target:
+        raise ValueError("source and target must differ")
+    if _export_path(source):
+        threads = _export_threads(_export_path(source), batch_size)
+    elif source in BACKENDS:
+        threads = _backend_threads(source, batch_size)
+    else:
+        raise ValueError(f"Unknown source {source!r}")
+    checkpoint = Checkpoint(checkpoint_path)
+    progress = Progress(logger)
+    stop = threading.Event()
+
+    def reporter():
+        while not stop.wait(MIGRATE_REPORT_INTERVAL):
+            progress.report()
+    threading.Thread(target=reporter, name="migrate-progress", daemon=True).start()
+
+    wanted = set(thread_ids) if thread_ids else None
+
+    def pending():
+        for thread_ts, header, pages in threads:
+            if (wanted is not None and thread_ts not in wanted) or thread_ts in checkpoint.done:
+                progress.add(skipped=1)
+                continue
+            yield thread_ts, header, pages
+
+    try:
+        if workers <= 1 or _export_path(source) or _export_path(target):
+            # An export file is one stream: read and write it in order, in this thread
+            _copy_all(pending(), target, checkpoint, progress, logger, batch_size)
+        else:
+            tasks = queue.Queue(maxsize=workers * 2)
+            pool = [threading.Thread(target=_copy_all, name=f"migrate-{i}",
+                                     args=(iter(tasks.get, None), target, checkpoint, progress, logger, batch_size))
+                    for i in range(workers)]
+            for thread in pool:
+                thread.start()
+            for task in pending():
+                tasks.put(task)
+            for _ in pool:
+                tasks.put(None)
+            for thread in pool:
+                thread.join()
+    finally:
+        stop.set()
+        checkpoint.close()
+    progress.report()
+    return progress.summary()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy conversation history between storage backends")
+    parser.add_argument("--source", required=True, help=f"one of {', '.join(BACKENDS)} or jsonl:<path>")
+    parser.add_argument("--target", required=True, help=f"one of {', '.join(BACKENDS)} or jsonl:<path>")
+    parser.add_argument("--workers", type=int, default=MIGRATE_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH_SIZE)
+    parser.add_argument("--checkpoint", help="file of finished thread ids (default: derived from source and target)")
+    parser.add_argument("--thread", action="append", dest="threads", help="copy only this thread (repeatable)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("StorageMigrate")
+    checkpoint = args.checkpoint or "storage_migrate.{}-{}.checkpoint".format(
+        *(os.path.basename(name).replace(":", "_") for name in (args.source, args.target)))
+    summary = migrate(args.source, args.target, args.workers, args.batch_size, checkpoint, args.threads, logger)
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# stream_reply.py
+"""
+Streaming replies to Slack and Google Chat.
+
+With STREAM_RESPONSES=true, llm_reply() posts a placeholder message, then
+edits it in place (Slack chat.update, Google Chat message patch) as the LLM
+streams tokens, at most once every STREAM_UPDATE_INTERVAL seconds to stay
+inside the APIs' rate limits. Other IO types, and any failure to post the
+placeholder, fall back to one send_response() with the full text.
+"""
+import os
+import time
+
+from call_llm import get_llm_response
+from send_response import send_response
+
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "false").lower() == "true"
+STREAM_UPDATE_INTERVAL = float(os.getenv("STREAM_UPDATE_INTERVAL", 1.5))
+STREAM_PLACEHOLDER = os.getenv("STREAM_PLACEHOLDER", "NAUT _thinking..._")
+STREAM_IO_TYPES = ("slack", "google_chat")
+
+
+class StreamingReply:
+    """One bot message that is posted once and then edited in place."""
+
+    def __init__(self, payload, thread_ts, logger, prefix="NAUT ", suffix=""):
+        self.payload = payload
+        self.thread_ts = thread_ts
+        self.logger = logger
+        self.prefix = prefix
+        self.suffix = suffix
+        self.io_type = payload.get("IO_type")
+        self.channel = payload.get("channel")
+        self.message_id = None
+        self._last_push = 0.0
+        self._last_text = None
+
+    def start(self):
+        """Post the placeholder. Returns False when this reply cannot be streamed."""
+        if self.io_type not in STREAM_IO_TYPES or not self.channel:
+            return False
+        try:
+            if self.io_type == "slack":
+                from slack import post_message_to_slack
+                self.message_id = post_message_to_slack(self.channel, STREAM_PLACEHOLDER, self.thread_ts)
+            else:
+                from post_google_chat_message import create_message
+                self.message_id = create_message(self.channel, STREAM_PLACEHOLDER, f"{self.channel}/threads/{self.thread_ts}")
+        except Exception as e:
+            self.logger.warning("Could not post streaming placeholder for thread %s: %s", self.thread_ts, e)
+            self.message_id = None
+        self._last_push = time.monotonic()
+        return self.message_id is not None
+
+    def _push(self, text):
+        if text == self._last_text:
+            return
+        try:
+            if self.io_type == "slack":
+                from slack import update_slack_message
+                update_slack_message(self.channel, self.message_id, text)
+            else:
+                from post_google_chat_message import update_message_text
+                update_message_text(self.message_id, text)
+            self._last_text = text
+        except Exception as e:
+            self.logger.warning("Streaming update failed for thread %s: %s", self.thread_ts, e)
+        self._last_push = time.monotonic()
+
+    def update(self, text_so_far):
+        """Throttled in-place update with the partial completion."""
+        if time.monotonic() - self._last_push >= STREAM_UPDATE_INTERVAL:
+            self._push(self.prefix + text_so_far + " …")
+
+    def finish(self, text):
+        self._push(self.prefix + text + self.suffix)
+
+
+def llm_reply(payload, thread_ts, logger, max_response_tokens, temperature,
+              prefix="NAUT ", suffix="", messages=None, send=True):
+    """
+    Get the LLM reply for the thread and deliver prefix + reply + suffix to the
+    user, streaming it when enabled. Returns the bare reply text; persisting
+    it with update_message stays with the caller. send=False only fetches it.
+    """
+    if send and STREAM_RESPONSES:
+        reply = StreamingReply(payload, thread_ts, logger, prefix=prefix, suffix=suffix)
+        if reply.start():
+            response = get_llm_response(thread_ts, max_response_tokens, temperature,
+                                        logger=logger, messages=messages, on_delta=reply.update)
+            reply.finish(response)
+            return response
+    response = get_llm_response(thread_ts, max_response_tokens, temperature, logger=logger, messages=messages)
+    if send:
+        send_response(payload, thread_ts, prefix + response + suffix, logger)
+    return response
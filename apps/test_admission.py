@@ -0,0 +1,105 @@
+# test_admission.py
+"""
+Behaviour checks for admission control: a gate admits up to its limit,
+queues the rest in FIFO order, rejects callers when its line is full or
+their wait times out, and LLM calls pass both the global and the provider
+gate.
+"""
+import time
+import threading
+
+import pytest
+
+import admission
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.001)
+
+
+def test_waiters_are_admitted_in_arrival_order():
+    gate = admission.Gate("test", 1)
+    gate.acquire()
+    order, positions, threads = [], [], []
+
+    def waiter(n):
+        gate.acquire(timeout=5, on_queued=positions.append)
+        order.append(n)
+        gate.release()
+
+    for n in range(3):
+        threads.append(threading.Thread(target=waiter, args=(n,)))
+        threads[-1].start()
+        _wait_for(lambda: gate.stats()["waiting"] == n + 1)
+    assert positions == [1, 2, 3] and order == []
+    gate.release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2]
+    stats = gate.stats()
+    assert stats["admitted"] == 4 and stats["queued"] == 3 and stats["in_use"] == 0
+
+
+def test_full_line_is_rejected_straight_away():
+    gate = admission.Gate("test", 1, max_waiters=1)
+    gate.acquire()
+    waiter = threading.Thread(target=lambda: (gate.acquire(timeout=5), gate.release()))
+    waiter.start()
+    _wait_for(lambda: gate.stats()["waiting"] == 1)
+    started = time.monotonic()
+    with pytest.raises(admission.AdmissionRejected) as e:
+        gate.acquire(timeout=5)
+    assert time.monotonic() - started < 1 and e.value.resource == "test"
+    gate.release()
+    waiter.join(5)
+    assert gate.stats()["rejected"] == 1
+
+
+def test_wait_times_out():
+    gate = admission.Gate("test", 1)
+    gate.acquire()
+    with pytest.raises(admission.AdmissionRejected):
+        gate.acquire(timeout=0.05)
+    stats = gate.stats()
+    assert stats["timed_out"] == 1 and stats["waiting"] == 0
+    # The slot is still usable once released
+    gate.release()
+    gate.acquire(timeout=0.05)
+
+
+def test_zero_limit_admits_everyone():
+    gate = admission.Gate("test", 0)
+    for _ in range(100):
+        gate.acquire(timeout=0)
+    assert gate.stats()["in_use"] == 0
+
+
+def test_llm_slot_queues_on_the_provider_gate(monkeypatch):
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY_TESTPROVIDER", "1")
+    held, release, told = threading.Event(), threading.Event(), []
+
+    def first():
+        with admission.llm_slot("testprovider"):
+            held.set()
+            release.wait(5)
+
+    def second():
+        with admission.admission_notifier(told.append):
+            with admission.llm_slot("testprovider"):
+                pass
+
+    threads = [threading.Thread(target=first), threading.Thread(target=second)]
+    threads[0].start()
+    held.wait(5)
+    threads[1].start()
+    _wait_for(lambda: admission.admission_stats()["llm:testprovider"]["waiting"] == 1)
+    # The global gate let both in; the provider gate holds the second back
+    assert admission.admission_stats()["llm"]["in_use"] == 2
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert told == [1]
+    assert admission.admission_stats()["llm:testprovider"]["in_use"] == 0
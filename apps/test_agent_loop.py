@@ -0,0 +1,80 @@
+# test_agent_loop.py
+"""
+Behaviour checks for the bounded AUTO_RUN loop: it stops at the step
+limit, the token budget and the deadline, and tells the user why. Commands
+and LLM calls are stubbed; the thread lives in the session's temporary
+FS_INDEX.
+"""
+import pytest
+
+import agent_loop
+import generic_storage
+
+
+class _Log:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+@pytest.fixture
+def loop(monkeypatch):
+    """Stub out commands, the LLM and Slack; the LLM always recommends another command."""
+    calls = {"commands": [], "sent": []}
+
+    def run_command(command, logger=None):
+        calls["commands"].append(command)
+        return {"stdout": "ok", "stderr": "", "returncode": 0}
+
+    monkeypatch.setattr(agent_loop, "execute_run_command", run_command)
+    monkeypatch.setattr(agent_loop, "llm_reply",
+                        lambda *args, **kwargs: f"```argocd app get app-{len(calls['commands'])}```")
+    monkeypatch.setattr(agent_loop, "send_response", lambda payload, ts, text, logger: calls["sent"].append(text))
+    return calls
+
+
+def _start(thread_ts):
+    generic_storage.update_message(thread_ts, "user", "why is my app degraded?")
+    generic_storage.update_message(thread_ts, "assistant", "```argocd app get app-0```")
+
+
+def test_stops_at_max_steps(loop):
+    _start("loop.1")
+    result = agent_loop.run_agent_loop({}, "loop.1", _Log(), 100, 0.0, max_steps=3, token_budget=10**9)
+    assert result["steps"] == 3 and result["stop_reason"] == "max_steps"
+    assert loop["commands"] == ["argocd app get app-0", "argocd app get app-1", "argocd app get app-2"]
+    assert loop["sent"][-1].startswith("NAUT Auto-run stopped after 3 step(s) (max steps)")
+    # Every step is stored: the opening exchange plus a command output and a reply per step
+    assert len(generic_storage.read_messages_on("file_storage", "loop.1")) == 2 + 2 * 3
+
+
+def test_stops_at_token_budget(loop):
+    _start("loop.2")
+    result = agent_loop.run_agent_loop({}, "loop.2", _Log(), 100, 0.0, max_steps=10, token_budget=1)
+    # The budget is checked before each step, so the first step always runs
+    assert result["steps"] == 1 and result["stop_reason"] == "token_budget"
+    assert result["tokens_used"] >= 1
+    assert "(token budget)" in loop["sent"][-1]
+
+
+def test_deadline_sends_the_pending_reply(loop):
+    _start("loop.3")
+    result = agent_loop.run_agent_loop({}, "loop.3", _Log(), 100, 0.0, max_steps=10, deadline_seconds=0)
+    assert result["steps"] == 0 and result["stop_reason"] == "deadline"
+    assert loop["commands"] == []
+    # The recommendation that started the loop had not been sent yet
+    assert loop["sent"][0] == "NAUT ```argocd app get app-0```"
+
+
+def test_no_command_ends_the_loop(loop, monkeypatch):
+    monkeypatch.setattr(agent_loop, "llm_reply", lambda *args, **kwargs: "All resources are Synced and Healthy.")
+    _start("loop.4")
+    result = agent_loop.run_agent_loop({}, "loop.4", _Log(), 100, 0.0, max_steps=10)
+    assert result["steps"] == 1 and result["stop_reason"] == "no_command"
+    assert loop["sent"][-1].startswith("NAUT AI resolved the issue")
+
+
+def test_extract_command():
+    assert agent_loop.extract_command("Try:\n```\nkubectl get pods\n```") == "kubectl get pods"
+    assert agent_loop.extract_command("```argocd app list```") == "argocd app list"
+    assert agent_loop.extract_command("```yaml\nkind: Pod\n```") is None
+    assert agent_loop.extract_command("no command here") is None
@@ -0,0 +1,39 @@
+# test_blob_store.py
+"""
+Behaviour checks for the blob store; blobs go to the session's temporary
+BLOB_STORE_PATH (see conftest.py).
+"""
+import blob_store
+
+
+def test_externalize_and_resolve_round_trip():
+    output = "kind: Deployment\n" * 1000
+    content = f"RUN argocd app manifests demo\nCommand Output:\n{output}\nReturn Code:\n0"
+    stored = blob_store.externalize(content)
+    assert len(stored) < 200 and blob_store.REFERENCE_RE.search(stored)
+    assert blob_store.externalize(content) == stored
+    assert blob_store.resolve(stored) == content
+
+
+def test_cache_is_bounded_by_bytes():
+    limit = blob_store.BLOB_CACHE_BYTES
+    blob_store.BLOB_CACHE_BYTES = 10000
+    try:
+        digests = [blob_store.REFERENCE_RE.search(blob_store.put(f"{i}" * 4000)).group(1) for i in range(5)]
+        for digest in digests:
+            blob_store.get(digest)
+        stats = blob_store.blob_stats()
+        assert stats["cache_bytes"] <= 10000 and stats["cache_size"] == 2
+        # The most recent blobs are the ones kept
+        hits = stats["cache_hits"]
+        blob_store.get(digests[-1])
+        assert blob_store.blob_stats()["cache_hits"] == hits + 1
+        # Evicted blobs are still read from disk
+        assert blob_store.get(digests[0]) == "0" * 4000
+    finally:
+        blob_store.BLOB_CACHE_BYTES = limit
+
+
+def test_missing_blob():
+    assert blob_store.get("0" * 64) is None
+    assert blob_store.resolve(blob_store.reference("0" * 64, 10)) == blob_store.reference("0" * 64, 10)
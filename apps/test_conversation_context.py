@@ -0,0 +1,63 @@
+# test_conversation_context.py
+"""
+Behaviour checks for the per-event conversation context and the agent
+loop's step flushes; storage goes to the session's temporary FS_INDEX.
+"""
+import pytest
+
+import file_storage
+import agent_loop
+from conversation_context import thread_context
+
+
+def _stored(thread_ts):
+    return [m["content"] for m in (file_storage.load_thread(thread_ts) or {}).get("messages", [])]
+
+
+def test_writes_are_batched_until_exit():
+    with thread_context("ctx.1") as ctx:
+        ctx.append("user", "one")
+        ctx.append("assistant", "two")
+        assert _stored("ctx.1") == []
+        assert [m["content"] for m in ctx.context_messages()] == ["one", "two"]
+    assert _stored("ctx.1") == ["one", "two"]
+
+
+def test_flush_on_error():
+    with pytest.raises(RuntimeError):
+        with thread_context("ctx.2") as ctx:
+            ctx.append("user", "kept")
+            raise RuntimeError("boom")
+    assert _stored("ctx.2") == ["kept"]
+
+
+def test_agent_loop_flushes_every_step():
+    thread_ts = "ctx.3"
+    seen, sent = [], []
+    replies = iter(["```argocd app list```", "done"])
+    real = (agent_loop.execute_run_command, agent_loop.llm_reply, agent_loop.send_response)
+
+    def run_command(command, logger=None):
+        seen.append(_stored(thread_ts))
+        return {"stdout": "ok", "stderr": "", "returncode": 0}
+
+    agent_loop.execute_run_command = run_command
+    agent_loop.llm_reply = lambda *args, **kwargs: next(replies)
+    agent_loop.send_response = lambda payload, ts, text, logger: sent.append(text)
+    try:
+        with thread_context(thread_ts) as ctx:
+            ctx.append("user", "why is my app degraded?")
+            ctx.append("assistant", "```argocd app get myapp```")
+            result = agent_loop.run_agent_loop({}, thread_ts, _Log(), 100, 0.0, max_steps=5)
+            # Steps are in storage while the context is still open
+            assert len(_stored(thread_ts)) == 6
+    finally:
+        agent_loop.execute_run_command, agent_loop.llm_reply, agent_loop.send_response = real
+    assert result["steps"] == 2 and result["stop_reason"] == "no_command"
+    # The first command ran after the opening exchange was flushed, the second after step 1
+    assert len(seen[0]) == 2 and len(seen[1]) == 4
+
+
+class _Log:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
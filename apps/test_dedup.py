@@ -0,0 +1,63 @@
+# test_dedup.py
+"""
+Behaviour checks for webhook de-duplication.
+"""
+import time
+
+import dedup
+from dedup import DedupCache, event_key
+
+
+class _Job:
+    def __init__(self, finished=True):
+        self.finished = finished
+
+    def done(self):
+        return self.finished
+
+
+def test_event_id_beats_payload_hash():
+    first = {"thread_ts": "1.1", "event": {"event_id": "Ev1", "text": "hi"}}
+    retry = {"thread_ts": "1.1", "event": {"event_id": "Ev1", "text": "hi"}, "retry_attempt": 1}
+    assert event_key(first)[0] == event_key(retry)[0] == "event_id:1.1:Ev1"
+
+
+def test_payload_hash_is_short_lived():
+    key, ttl = event_key({"thread_ts": "1.1", "text": "RUN"})
+    assert key.startswith("sha256:") and ttl == dedup.DEDUP_PAYLOAD_HASH_TTL
+
+
+def test_request_id_header_is_ignored():
+    payload = {"thread_ts": "1.1", "text": "hello"}
+    assert event_key(payload, {"X-Request-Id": "a"}) == event_key(payload, {"X-Request-Id": "b"})
+    assert event_key(payload, {"Idempotency-Key": "k"})[0] == "header:k"
+
+
+def test_retry_attaches_to_first_job():
+    cache = DedupCache()
+    created = []
+    factory = lambda: created.append(_Job()) or created[-1]
+    job, new = cache.get_or_create("k", factory, ttl=60)
+    again, new_again = cache.get_or_create("k", factory, ttl=60)
+    assert new and not new_again and again is job and len(created) == 1
+
+
+def test_in_flight_job_outlives_ttl():
+    cache = DedupCache()
+    running = _Job(finished=False)
+    cache.get_or_create("k", lambda: running, ttl=0)
+    time.sleep(0.01)
+    assert cache.get_or_create("k", _Job, ttl=0) == (running, False)
+    running.finished = True
+    time.sleep(0.01)
+    assert cache.get_or_create("k", _Job, ttl=0)[1]
+
+
+def test_eviction_keeps_in_flight_jobs():
+    cache = DedupCache(max_entries=2)
+    running = _Job(finished=False)
+    cache.get_or_create("running", lambda: running, ttl=60)
+    for n in range(5):
+        cache.get_or_create(f"done-{n}", _Job, ttl=60)
+    assert cache.get_or_create("running", _Job, ttl=60) == (running, False)
+    assert cache.stats()["entries"] <= 3
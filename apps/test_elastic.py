@@ -0,0 +1,166 @@
+# test_elastic.py
+"""
+Behaviour checks for the single-document Elasticsearch backend and the
+shared client. No cluster is needed: _FakeES keeps documents in memory and
+runs the update scripts the way Elasticsearch does, under optimistic
+concurrency, so a write that lands between a script's read and its write
+is a version conflict, retried up to retry_on_conflict times.
+"""
+import copy
+
+import pytest
+from elastic_transport import ApiResponseMeta, HttpHeaders
+from elasticsearch import BadRequestError, ConflictError
+
+import elastic
+
+
+def _meta(status):
+    return ApiResponseMeta(status=status, http_version="1.1", headers=HttpHeaders(), duration=0.0, node=None)
+
+
+class _FakeES:
+    def __init__(self):
+        self.docs = {}
+        self.updates = []
+        # Writes by "other clients" that land while the next update is running, one per attempt
+        self.concurrent_writes = []
+
+    def get(self, *args, **kwargs):
+        raise AssertionError("appends must not read the thread")
+
+    def update(self, index, id, body, retry_on_conflict=0, **kwargs):
+        self.updates.append({"id": id, "body": body, "retry_on_conflict": retry_on_conflict})
+        for _ in range(retry_on_conflict + 1):
+            before = copy.deepcopy(self.docs.get(id))
+            if self.concurrent_writes:
+                self.concurrent_writes.pop(0)(self.docs[id])
+            if self.docs.get(id) != before:
+                continue
+            return self._apply(id, before, body)
+        raise ConflictError("version_conflict_engine_exception", _meta(409), {})
+
+    def _apply(self, id, doc, body):
+        if doc is None:
+            self.docs[id] = copy.deepcopy(body["upsert"])
+            return {"result": "created"}
+        script = body["script"]
+        params = copy.deepcopy(script["params"])
+        if script["source"] == elastic._APPEND_SCRIPT:
+            doc["messages"] = doc.get("messages", []) + params["messages"]
+            doc["updated_at"] = params["now"]
+        elif script["source"] == elastic._SUMMARY_INDEX_SCRIPT:
+            if not doc.get("messages"):
+                return {"result": "noop"}
+            doc["summary_index"] = len(doc["messages"]) - 1 if params["summary_index"] is None else params["summary_index"]
+        self.docs[id] = doc
+        return {"result": "updated"}
+
+
+def _other_writer(content):
+    return lambda doc: doc["messages"].append({"role": "user", "content": content})
+
+
+def _contents(es, thread_ts):
+    return [m["content"] for m in es.docs[thread_ts]["messages"]]
+
+
+def test_append_is_a_scripted_upsert():
+    es = _FakeES()
+    elastic.append_messages_es(es, "es.1", [{"role": "user", "content": "a"}])
+    created = es.docs["es.1"]
+    assert created["created_at"] == created["updated_at"]
+    elastic.append_messages_es(es, "es.1", [{"role": "assistant", "content": "b"}, {"role": "user", "content": "c"}])
+    assert _contents(es, "es.1") == ["a", "b", "c"]
+    assert es.docs["es.1"]["updated_at"] >= created["created_at"]
+    # One request per append, never a read-modify-write of the whole thread
+    assert len(es.updates) == 2
+    assert all(u["retry_on_conflict"] == elastic.ES_RETRY_ON_CONFLICT for u in es.updates)
+
+
+def test_concurrent_appends_are_retried_not_lost():
+    es = _FakeES()
+    elastic.append_messages_es(es, "es.2", [{"role": "user", "content": "first"}])
+    es.concurrent_writes = [_other_writer("other-1"), _other_writer("other-2")]
+    elastic.append_messages_es(es, "es.2", [{"role": "user", "content": "ours"}])
+    assert _contents(es, "es.2") == ["first", "other-1", "other-2", "ours"]
+
+
+def test_conflicts_beyond_the_retry_limit_raise(monkeypatch):
+    monkeypatch.setattr(elastic, "ES_RETRY_ON_CONFLICT", 1)
+    es = _FakeES()
+    elastic.append_messages_es(es, "es.3", [{"role": "user", "content": "first"}])
+    es.concurrent_writes = [_other_writer(f"other-{n}") for n in range(3)]
+    with pytest.raises(ConflictError):
+        elastic.append_messages_es(es, "es.3", [{"role": "user", "content": "ours"}])
+    # The failure is reported instead of overwriting the other writers' messages
+    assert "ours" not in _contents(es, "es.3") and "other-0" in _contents(es, "es.3")
+
+
+def test_summary_index_is_set_on_the_server():
+    es = _FakeES()
+    elastic.append_messages_es(es, "es.4", [{"role": "user", "content": str(n)} for n in range(4)])
+    es.concurrent_writes = [_other_writer("late")]
+    assert elastic.set_summary_index_es(es, "es.4")
+    # Computed from the document as it is when the script finally runs
+    assert es.docs["es.4"]["summary_index"] == 4
+    es.docs["es.5"] = {"messages": []}
+    assert elastic.set_summary_index_es(es, "es.5") is False
+
+
+class _FakeClient:
+    """Stands in for the Elasticsearch class: counts clients and index bootstrap calls."""
+    created = []
+
+    def __init__(self, *args, **kwargs):
+        self.kwargs = kwargs
+        self.exists_calls = self.create_calls = 0
+        self.create_error = None
+        self.indices = self
+        _FakeClient.created.append(self)
+
+    def exists(self, index):
+        self.exists_calls += 1
+        return False
+
+    def create(self, index, body):
+        self.create_calls += 1
+        if self.create_error:
+            raise self.create_error
+
+
+@pytest.fixture
+def client(monkeypatch):
+    _FakeClient.created = []
+    monkeypatch.setattr(elastic, "Elasticsearch", _FakeClient)
+    monkeypatch.setattr(elastic, "_es_client", None)
+    monkeypatch.setattr(elastic, "_index_ready", False)
+    return _FakeClient
+
+
+def test_client_is_shared_and_rebuilt_after_fork(client, monkeypatch):
+    es = elastic.get_es_client()
+    assert elastic.get_es_client() is es and len(client.created) == 1
+    assert es.kwargs["connections_per_node"] == elastic.ES_MAX_CONNECTIONS
+    # In a forked worker the pooled sockets belong to the parent
+    monkeypatch.setattr(elastic, "_es_client_pid", -1)
+    assert elastic.get_es_client() is not es and len(client.created) == 2
+
+
+def test_index_is_bootstrapped_once(client):
+    elastic.ensure_index_exists()
+    elastic.ensure_index_exists()
+    es = elastic.get_es_client()
+    assert es.exists_calls == 1 and es.create_calls == 1
+
+
+def test_index_created_by_another_worker(client):
+    es = elastic.get_es_client()
+    es.create_error = BadRequestError("resource_already_exists_exception", _meta(400), {})
+    elastic.ensure_index_exists()
+    assert elastic._index_ready
+    elastic._index_ready = False
+    es.create_error = BadRequestError("mapper_parsing_exception", _meta(400), {})
+    with pytest.raises(BadRequestError):
+        elastic.ensure_index_exists()
+    assert not elastic._index_ready
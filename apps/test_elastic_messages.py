@@ -0,0 +1,157 @@
+# test_elastic_messages.py
+"""
+Behaviour checks for the message-per-document Elasticsearch backend: seq
+reservation on the header, releasing a failed reservation, and realtime
+multi-get reads that skip seqs which were never written. _FakeES keeps
+both indices in memory and runs the header scripts the way the painless
+versions do; helpers.bulk is replaced to index into it.
+"""
+import pytest
+
+import elastic_messages
+
+
+class _FakeES:
+    def __init__(self):
+        self.headers = {}
+        self.messages = {}
+        self.log = []
+        self.mget_ids = []
+        # Stands in for the _bulk call when set: fn(actions) -> (successes, errors)
+        self.bulk_hook = None
+
+    def get(self, index, id, ignore=None, _source=True):
+        header = self.headers.get(id)
+        if header is None:
+            return {"found": False}
+        return {"found": True, "_source": dict(header), "_seq_no": header["_version"], "_primary_term": 1}
+
+    def mget(self, index, body, _source=None):
+        self.log.append("mget")
+        self.mget_ids.append(body["ids"])
+        return {"docs": [{"found": True, "_source": self.messages[i]} if i in self.messages else {"found": False}
+                         for i in body["ids"]]}
+
+    def update(self, index, id, body, retry_on_conflict=0, **kwargs):
+        header = self.headers.get(id)
+        if header is None and "upsert" in body:
+            self.headers[id] = header = dict(body["upsert"], _version=0)
+            self.log.append("reserve")
+            return {"result": "created", "get": {"_source": {"message_count": header["message_count"]}}}
+        header["_version"] += 1
+        if "doc" in body:
+            header.update(body["doc"])
+            self.log.append("touch")
+            return {"result": "updated"}
+        source, params = body["script"]["source"], body["script"]["params"]
+        if source == elastic_messages._RESERVE_SCRIPT:
+            header["message_count"] += params["n"]
+            self.log.append("reserve")
+        elif source == elastic_messages._RELEASE_SCRIPT:
+            if header["message_count"] == params["end"]:
+                header["message_count"] = params["start"]
+            else:
+                header.setdefault("missing_seqs", []).extend(params["seqs"])
+            self.log.append("release")
+        return {"result": "updated", "get": {"_source": {"message_count": header["message_count"]}}}
+
+
+@pytest.fixture
+def es(monkeypatch):
+    fake = _FakeES()
+
+    def bulk(client, actions, refresh=None, raise_on_error=True):
+        actions = list(actions)
+        fake.log.append("bulk")
+        if fake.bulk_hook:
+            return fake.bulk_hook(actions)
+        for action in actions:
+            fake.messages[action["_id"]] = action["_source"]
+        return len(actions), []
+
+    monkeypatch.setattr(elastic_messages, "get_es_client", lambda: fake)
+    monkeypatch.setattr(elastic_messages.helpers, "bulk", bulk)
+    return fake
+
+
+def _append(thread_ts, *contents):
+    elastic_messages.append_messages(thread_ts, [{"role": "user", "content": c} for c in contents])
+
+
+def _contents(messages):
+    return [m["content"] for m in messages]
+
+
+def test_appends_reserve_consecutive_seqs(es):
+    _append("em.1", "a", "b")
+    _append("em.1", "c")
+    _append("em.1", "d", "e", "f")
+    assert es.headers["em.1"]["message_count"] == 6
+    assert sorted(es.messages) == [f"em.1:{seq}" for seq in range(6)]
+    assert _contents(elastic_messages.read_messages("em.1")) == ["a", "b", "c", "d", "e", "f"]
+    assert _contents(elastic_messages.read_messages("em.1", after_seq=2, limit=2)) == ["d", "e"]
+    assert _contents(elastic_messages.tail_messages("em.1", 2)) == ["e", "f"]
+
+
+def test_header_moves_again_once_the_messages_are_in(es):
+    _append("em.2", "a")
+    es.log.clear()
+    _append("em.2", "b")
+    # A cache validating against the header's version sees the change after the messages are readable
+    assert es.log == ["reserve", "bulk", "touch"]
+
+
+def test_reads_are_paged_realtime_gets(es):
+    _append("em.3", *"abcde")
+    es.mget_ids.clear()
+    pages = elastic_messages.iter_messages("em.3", range(5), page_size=2)
+    assert [(seq, m["content"]) for seq, m in pages] == list(enumerate("abcde"))
+    assert es.mget_ids == [["em.3:0", "em.3:1"], ["em.3:2", "em.3:3"], ["em.3:4"]]
+    # A limited read fetches no more than it returns
+    es.mget_ids.clear()
+    assert _contents(elastic_messages.read_messages("em.3", after_seq=0, limit=2)) == ["b", "c"]
+    assert es.mget_ids == [["em.3:1", "em.3:2"]]
+
+
+def test_summary_view_fetches_only_what_the_llm_sees(es, monkeypatch):
+    _append("em.4", *"abcdef")
+    es.headers["em.4"]["summary_index"] = 4
+    monkeypatch.setenv("SAVE_TOKEN_USE_SUMMARY", "true")
+    es.mget_ids.clear()
+    assert _contents(elastic_messages.get_thread_messages("em.4")) == ["a", "e", "f"]
+    assert es.mget_ids == [["em.4:0", "em.4:4", "em.4:5"]]
+
+
+def test_failed_bulk_gives_the_seqs_back(es):
+    _append("em.5", "a")
+
+    def unavailable(actions):
+        raise ConnectionError("cluster unavailable")
+
+    es.bulk_hook = unavailable
+    with pytest.raises(ConnectionError):
+        _append("em.5", "b", "c")
+    assert es.headers["em.5"]["message_count"] == 1
+    es.bulk_hook = None
+    _append("em.5", "d")
+    assert _contents(elastic_messages.read_messages("em.5")) == ["a", "d"]
+
+
+def test_rejected_message_after_a_later_append_is_skipped(es):
+    _append("em.6", "a")
+
+    def partly_rejected(actions):
+        # Another writer reserved seq 3 and wrote it while this bulk was running
+        es.headers["em.6"]["message_count"] += 1
+        es.messages["em.6:3"] = {"role": "user", "content": "later"}
+        for action in actions:
+            if action["_id"] != "em.6:2":
+                es.messages[action["_id"]] = action["_source"]
+        return len(actions) - 1, [{"index": {"_id": "em.6:2", "status": 400, "error": "mapper_parsing_exception"}}]
+
+    es.bulk_hook = partly_rejected
+    with pytest.raises(RuntimeError):
+        _append("em.6", "b", "c")
+    header = es.headers["em.6"]
+    assert header["message_count"] == 4 and header["missing_seqs"] == [2]
+    assert _contents(elastic_messages.read_messages("em.6")) == ["a", "b", "later"]
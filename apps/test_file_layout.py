@@ -0,0 +1,93 @@
+# test_file_layout.py
+"""
+Behaviour checks for the sharded FS_LAYOUT directories: where the hashed
+and date layouts put a thread, finding threads an older layout left
+behind, moving them on their next write or with migrate_layout, and
+skipping whole date shards in list_threads. Each test gets its own
+FS_INDEX, so moving every thread doesn't disturb the other tests.
+"""
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+import file_storage
+
+# 2023-11-14 and 2024-03-01, UTC
+NOVEMBER = "1700000000.000100"
+MARCH = "1709290000.000200"
+
+
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    monkeypatch.setattr(file_storage, "FS_INDEX", str(tmp_path))
+    monkeypatch.setattr(file_storage, "_settled", {})
+    return tmp_path
+
+
+def _use(monkeypatch, layout):
+    monkeypatch.setattr(file_storage, "FS_LAYOUT", layout)
+    # What a restarted worker knows about where threads live
+    monkeypatch.setattr(file_storage, "_settled", {})
+
+
+def _append(thread_ts, *contents):
+    file_storage.append_messages(thread_ts, [{"role": "user", "content": c} for c in contents])
+
+
+def _contents(thread_ts):
+    return [m["content"] for m in file_storage.load_thread(thread_ts)["messages"]]
+
+
+def _log_dir(index, thread_ts):
+    return os.path.relpath(os.path.dirname(file_storage._log_path(thread_ts)), index)
+
+
+def test_layout_directories(index, monkeypatch):
+    _use(monkeypatch, "hashed")
+    _append(NOVEMBER, "a")
+    shard = _log_dir(index, NOVEMBER).split(os.sep)
+    assert len(shard) == 2 and all(len(part) == 2 for part in shard)
+    _use(monkeypatch, "date")
+    _append(MARCH, "a")
+    _append("not-a-timestamp", "a")
+    assert _log_dir(index, MARCH) == os.path.join("2024", "03", "01")
+    assert _log_dir(index, "not-a-timestamp").split(os.sep)[0] == "undated"
+
+
+def test_thread_moves_on_its_next_write(index, monkeypatch):
+    _use(monkeypatch, "flat")
+    _append(NOVEMBER, "a", "b")
+    _use(monkeypatch, "date")
+    # Still readable where the flat layout left it
+    assert _contents(NOVEMBER) == ["a", "b"] and _log_dir(index, NOVEMBER) == "."
+    _append(NOVEMBER, "c")
+    assert _log_dir(index, NOVEMBER) == os.path.join("2023", "11", "14")
+    assert not os.path.exists(os.path.join(index, f"{NOVEMBER}{file_storage.LOG_SUFFIX}"))
+    assert _contents(NOVEMBER) == ["a", "b", "c"]
+
+
+def test_migrate_layout_moves_every_thread(index, monkeypatch):
+    _use(monkeypatch, "flat")
+    _append(NOVEMBER, "a")
+    _append(MARCH, "b")
+    file_storage.set_summary_index(MARCH)
+    _use(monkeypatch, "hashed")
+    assert file_storage.migrate_layout() == 2
+    assert file_storage.migrate_layout() == 0
+    assert not any(name.endswith(file_storage.LOG_SUFFIX) for name in os.listdir(index))
+    assert _contents(NOVEMBER) == ["a"] and _contents(MARCH) == ["b"]
+    # The header moved with the log
+    assert file_storage.load_header(MARCH)["summary_index"] == 0
+    assert file_storage.list_threads() == sorted([NOVEMBER, MARCH])
+
+
+def test_list_threads_by_creation_date(index, monkeypatch):
+    _use(monkeypatch, "date")
+    _append(NOVEMBER, "a")
+    _append(MARCH, "b")
+    _append("not-a-timestamp", "c")
+    since_2024 = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert file_storage.list_threads(created_after=since_2024) == [MARCH]
+    assert file_storage.list_threads(created_before=since_2024) == [NOVEMBER]
+    assert file_storage.list_threads() == sorted([NOVEMBER, MARCH, "not-a-timestamp"])
@@ -0,0 +1,95 @@
+# test_file_storage.py
+"""
+Behaviour checks for the append-only file storage: torn writes from a
+crash, and compaction into cold segments. Threads go to the session's
+temporary FS_INDEX.
+"""
+import gzip
+
+import file_storage
+
+
+def _append(thread_ts, *contents):
+    file_storage.append_messages(thread_ts, [{"role": "user", "content": c} for c in contents])
+
+
+def _contents(thread_ts):
+    return [m["content"] for m in file_storage.load_thread(thread_ts)["messages"]]
+
+
+def _compacted(thread_ts, count):
+    """A thread of count messages with the summary on the last one, compacted."""
+    _append(thread_ts, *[f"m{i}" for i in range(count)])
+    file_storage.set_summary_index(thread_ts, summary_index=count - 1)
+    file_storage.compact_thread(thread_ts, min_messages=1)
+    return file_storage._read_compaction(thread_ts)
+
+
+def test_torn_last_line_is_skipped_and_repaired():
+    _append("fs.1", "a", "b")
+    with open(file_storage._log_path("fs.1"), "a", encoding="utf-8") as f:
+        f.write('{"role": "user", "cont')
+    assert _contents("fs.1") == ["a", "b"]
+    assert file_storage.load_header("fs.1")["message_count"] == 2
+    # The next append cuts the torn line off instead of leaving it to take up a seq
+    _append("fs.1", "c")
+    assert _contents("fs.1") == ["a", "b", "c"]
+    assert file_storage.load_header("fs.1")["message_count"] == 3
+    assert [m["content"] for m in file_storage.read_messages("fs.1", after_seq=1)] == ["c"]
+
+
+def test_last_line_without_its_newline_is_not_counted():
+    _append("fs.7", "a")
+    # Cut short just before the newline: readable, but its append never finished
+    with open(file_storage._log_path("fs.7"), "a", encoding="utf-8") as f:
+        f.write('{"role": "user", "content": "b"}')
+    assert _contents("fs.7") == ["a"] and file_storage.load_header("fs.7")["message_count"] == 1
+    _append("fs.7", "c")
+    assert _contents("fs.7") == ["a", "c"] and file_storage.load_header("fs.7")["message_count"] == 2
+
+
+def test_compaction_keeps_every_message():
+    compaction = _compacted("fs.2", 30)
+    assert compaction["upto"] == 29 and len(compaction["segments"]) == 1
+    assert _contents("fs.2") == [f"m{i}" for i in range(30)]
+    assert file_storage.read_messages("fs.2", after_seq=27) == [{"role": "user", "content": "m28"},
+                                                                 {"role": "user", "content": "m29"}]
+    hot = file_storage.load_thread("fs.2", hot_only=True)["messages"]
+    assert hot[0]["content"] == "m0" and hot[29]["content"] == "m29" and hot[1:29] == [None] * 28
+    # Appends after compaction land in the hot log
+    _append("fs.2", "m30")
+    assert _contents("fs.2")[-2:] == ["m29", "m30"]
+    assert file_storage.load_header("fs.2")["message_count"] == 31
+
+
+def test_compaction_is_incremental():
+    _compacted("fs.3", 10)
+    _append("fs.3", *[f"m{i}" for i in range(10, 20)])
+    file_storage.set_summary_index("fs.3", summary_index=19)
+    file_storage.compact_thread("fs.3", min_messages=1)
+    compaction = file_storage._read_compaction("fs.3")
+    assert [(s["start"], s["end"]) for s in compaction["segments"]] == [(1, 9), (9, 19)]
+    assert _contents("fs.3") == [f"m{i}" for i in range(20)]
+
+
+def test_truncated_cold_segment_is_read_up_to_the_damage():
+    compaction = _compacted("fs.4", 200)
+    path = file_storage._segment_path("fs.4", compaction["segments"][0]["file"])
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data[:len(data) // 2])
+    contents = _contents("fs.4")
+    assert contents[0] == "m0" and contents[-1] == "m199"
+    assert len(contents) < 200
+
+
+def test_torn_line_in_cold_segment_is_skipped():
+    compaction = _compacted("fs.5", 5)
+    path = file_storage._segment_path("fs.5", compaction["segments"][0]["file"])
+    with gzip.open(path, "rb") as f:
+        lines = f.read().split(b"\n")
+    lines[1] = lines[1][:5]
+    with open(path, "wb") as f:
+        f.write(gzip.compress(b"\n".join(lines)))
+    assert _contents("fs.5") == ["m0", "m1", "m3", "m4"]
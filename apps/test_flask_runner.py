@@ -0,0 +1,77 @@
+# test_flask_runner.py
+"""
+Behaviour checks for the thread endpoints: ETag revalidation answers
+304 until the thread changes, ?since / ?limit page through the messages,
+unknown threads are a 404 whatever validators the client sends, and the
+cache invalidation hook only answers internal callers. Requests go through
+Flask's test client; threads live in the session's temporary FS_INDEX.
+"""
+import hashlib
+
+import pytest
+
+import flask_runner
+import generic_storage
+
+
+@pytest.fixture
+def client():
+    return flask_runner.app.test_client()
+
+
+def _append(thread_ts, *contents):
+    for content in contents:
+        generic_storage.update_message(thread_ts, "user", content)
+
+
+def _contents(messages):
+    return [m["content"] for m in messages]
+
+
+def test_etag_revalidation(client):
+    _append("web.1", "a", "b")
+    first = client.get("/threads/web.1")
+    assert first.status_code == 200 and _contents(first.get_json()["messages"]) == ["a", "b"]
+    etag = first.headers["ETag"]
+    assert client.get("/threads/web.1", headers={"If-None-Match": etag}).status_code == 304
+    _append("web.1", "c")
+    changed = client.get("/threads/web.1", headers={"If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+    assert _contents(changed.get_json()["messages"]) == ["a", "b", "c"]
+
+
+def test_since_pages_through_the_messages(client):
+    _append("web.2", *"abcde")
+    page = client.get("/threads/web.2?since=1&limit=2").get_json()
+    assert page["since"] == 1 and _contents(page["messages"]) == ["b", "c"] and page["next_since"] == 3
+    page = client.get(f"/threads/web.2?since={page['next_since']}").get_json()
+    assert _contents(page["messages"]) == ["d", "e"] and page["next_since"] == 5
+    # Each page has its own validator
+    etags = {client.get(f"/threads/web.2?since={n}").headers["ETag"] for n in range(3)}
+    assert len(etags) == 3
+    assert client.get("/threads/web.2?since=-1").status_code == 400
+    assert client.get("/threads/web.2?limit=x").status_code == 400
+
+
+def test_unknown_thread_is_not_found(client):
+    assert client.get("/threads/web.missing").status_code == 404
+    # The ETag the validators give a thread that doesn't exist must not earn a 304
+    version = generic_storage.thread_version("web.missing")
+    etag = hashlib.sha1(f"web.missing|{version!r}|".encode()).hexdigest()
+    response = client.get("/threads/web.missing", headers={"If-None-Match": f'"{etag}"'})
+    assert response.status_code == 404
+    assert client.get("/threads/web.missing", headers={"If-None-Match": "*"}).status_code == 404
+
+
+def test_invalidate_is_for_internal_callers(client, monkeypatch):
+    monkeypatch.setattr(flask_runner, "INTERNAL_API_TOKEN", None)
+    assert client.post("/threads/*/invalidate").status_code == 200
+    remote = {"REMOTE_ADDR": "10.0.0.7"}
+    assert client.post("/threads/*/invalidate", environ_base=remote).status_code == 403
+    # With a token set, it is the token that counts, wherever the caller is
+    monkeypatch.setattr(flask_runner, "INTERNAL_API_TOKEN", "s3cret")
+    assert client.post("/threads/*/invalidate").status_code == 403
+    assert client.post("/threads/*/invalidate", environ_base=remote,
+                       headers={"Authorization": "Bearer wrong"}).status_code == 403
+    response = client.post("/threads/*/invalidate", environ_base=remote, headers={"Authorization": "Bearer s3cret"})
+    assert response.status_code == 200 and "invalidated" in response.get_json()
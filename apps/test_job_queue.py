@@ -0,0 +1,114 @@
+# test_job_queue.py
+"""
+Behaviour checks for the job queue: per-thread ordering, parallelism
+across threads, channel caps, failures and debouncing. Every test uses its
+own JobQueue.
+"""
+import time
+import threading
+
+import pytest
+
+import job_queue
+
+
+def _recorder():
+    """A job fn recording the order jobs ran in and the most running at once, per thread_ts."""
+    lock = threading.Lock()
+    order, running, most = [], {}, {}
+
+    def fn(payload, logger):
+        key = payload["thread_ts"]
+        with lock:
+            running[key] = running.get(key, 0) + 1
+            most[key] = max(most.get(key, 0), running[key])
+        time.sleep(payload.get("sleep", 0.005))
+        with lock:
+            running[key] -= 1
+            order.append((key, payload["n"]))
+        return payload["n"]
+
+    return fn, order, most
+
+
+def _wait_all(jobs):
+    for job in jobs:
+        assert job.wait(5), f"job {job.id} did not finish"
+
+
+def test_jobs_of_one_thread_run_in_order():
+    q = job_queue.JobQueue(workers=8)
+    fn, order, most = _recorder()
+    jobs = [q.submit(fn, {"thread_ts": ts, "n": n}) for n in range(20) for ts in ("t1", "t2", "t3")]
+    _wait_all(jobs)
+    for ts in ("t1", "t2", "t3"):
+        assert [n for key, n in order if key == ts] == list(range(20))
+        assert most[ts] == 1
+    assert [job.result for job in jobs[:3]] == [0, 0, 0]
+    stats = q.stats()
+    assert stats["completed"] == 60 and stats["depth"] == 0 and stats["lanes"] == 0
+
+
+def test_threads_run_in_parallel():
+    q = job_queue.JobQueue(workers=2)
+    both = threading.Barrier(2, timeout=5)
+    jobs = [q.submit(lambda payload, logger: both.wait(), {"thread_ts": ts}) for ts in ("p1", "p2")]
+    _wait_all(jobs)
+    # Each job only got past the barrier because the other was running too
+    assert [job.status for job in jobs] == ["done", "done"]
+
+
+def test_channel_cap_holds_later_threads_back():
+    q = job_queue.JobQueue(workers=4, max_threads_per_channel=1)
+    fn, order, _ = _recorder()
+    first = [q.submit(fn, {"thread_ts": "c1", "channel": "C", "n": n, "sleep": 0.02}) for n in range(3)]
+    second = q.submit(fn, {"thread_ts": "c2", "channel": "C", "n": 0})
+    other = q.submit(fn, {"thread_ts": "c3", "channel": "D", "n": 0})
+    assert q.stats()["lanes_blocked"] == 1
+    _wait_all(first + [second, other])
+    # c2 only started once c1 had drained; c3 is in another channel
+    assert order.index(("c2", 0)) > order.index(("c1", 2))
+    assert order.index(("c3", 0)) < order.index(("c1", 2))
+
+
+def test_failed_job_does_not_block_its_thread():
+    q = job_queue.JobQueue(workers=2)
+
+    def fn(payload, logger):
+        if payload["n"] == 0:
+            raise RuntimeError("boom")
+        return payload["n"]
+
+    jobs = [q.submit(fn, {"thread_ts": "f1", "n": n}) for n in range(3)]
+    _wait_all(jobs)
+    assert [job.status for job in jobs] == ["failed", "done", "done"]
+    assert jobs[0].error == "boom"
+    assert q.stats()["failed"] == 1
+
+
+def test_queue_full():
+    q = job_queue.JobQueue(workers=1, maxsize=2)
+    release = threading.Event()
+    blocker = q.submit(lambda payload, logger: release.wait(5), {"thread_ts": "q1"})
+    while blocker.status == "queued":
+        time.sleep(0.001)
+    jobs = [q.submit(lambda payload, logger: None, {"thread_ts": "q2"}) for _ in range(2)]
+    try:
+        with pytest.raises(job_queue.QueueFull) as e:
+            q.submit(lambda payload, logger: None, {"thread_ts": "q3"})
+        assert e.value.depth == 2
+    finally:
+        release.set()
+    _wait_all([blocker] + jobs)
+    assert q.stats()["rejected"] == 1
+
+
+def test_debounce_merges_rapid_messages():
+    q = job_queue.JobQueue(workers=1, debounce_ms=100)
+    texts = []
+    fn = lambda payload, logger: texts.append(payload["text"])
+    jobs = [q.submit(fn, {"thread_ts": "d1", "text": text}, coalesce=True) for text in ("a", "b", "c")]
+    assert jobs[0] is jobs[1] is jobs[2] and jobs[0].merged == 2
+    _wait_all(jobs[:1])
+    assert texts == ["a\nb\nc"]
+    assert q.stats()["coalesced"] == 2
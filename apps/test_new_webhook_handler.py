@@ -0,0 +1,30 @@
+# test_new_webhook_handler.py
+"""
+Behaviour checks for which webhook messages may be coalesced with the
+user's next quick messages: only plain chat, never a command, with
+commands recognised the way handle_event_text recognises them.
+"""
+import pytest
+
+from new_webhook_handler import is_coalescible
+
+
+@pytest.mark.parametrize("text", [
+    "HELP", "help", "RUN", "RUN argocd app list", "SUMMARIZE", "GIT-FIX values.yaml", "GIT-PR", "GIT-MERGE",
+    "TOOL Command: argocd app list\nCommand Output:\n", "NAUT Synced and Healthy", "  RUN\n",
+])
+def test_commands_are_not_coalesced(text):
+    assert not is_coalescible({"text": text})
+
+
+@pytest.mark.parametrize("text", [
+    "running late?", "help me understand the sync error", "git-ops question", "Run it again please",
+    "RUNNING", "summarize this", "the NAUT reply was wrong", "GIT-", "tooling is broken",
+])
+def test_chat_is_coalesced(text):
+    assert is_coalescible({"text": text})
+
+
+def test_empty_text_is_not_coalesced():
+    assert not is_coalescible({"text": "   "})
+    assert not is_coalescible({})
@@ -0,0 +1,156 @@
+# test_replication.py
+"""
+Behaviour checks for the replication outbox: replay order, retries,
+dead-lettering, the drain lease, and replicated summary indexes.
+file_storage is the primary and sqlite the secondary, both in the
+session's temporary directory. The outbox is drained by hand, not by the
+background thread.
+"""
+import time
+
+import file_storage
+import generic_storage
+import replication
+import sqlite_storage
+
+_replicator = replication.get_replicator()
+_replicator.ensure_started = lambda: None
+
+
+def _configure():
+    # Set on the modules, not the environment: other tests in the same run configure them too
+    generic_storage.STORAGE_BACKENDS = ["file_storage", "sqlite"]
+    generic_storage.STORAGE_PRIMARY = "file_storage"
+    generic_storage.SECONDARY_BACKENDS = ["sqlite"]
+    generic_storage.STORAGE_REPLICATION = "async"
+    replication.REPLICATION_RETRY_BASE = 0
+    replication.REPLICATION_MAX_ATTEMPTS = 3
+
+
+def _drain_all():
+    while _replicator.drain("sqlite"):
+        pass
+
+
+def _messages(thread_ts):
+    return [m["content"] for m in (sqlite_storage.load_thread(thread_ts) or {}).get("messages", [])]
+
+
+def test_replays_in_order():
+    _configure()
+    generic_storage.update_message("rep.1", "system", "s")
+    generic_storage.update_message("rep.1", "user", "a")
+    generic_storage.update_message("rep.1", "assistant", "b")
+    generic_storage.set_summary_index("rep.1")
+    generic_storage.update_reaction("rep.1", "thumbsup")
+    assert sqlite_storage.load_thread("rep.1") is None
+    _drain_all()
+    doc = sqlite_storage.load_thread("rep.1")
+    assert _messages("rep.1") == ["s", "a", "b"]
+    assert doc["summary_index"] == 2
+    assert doc["reaction"] == "thumbsup"
+    assert _replicator.stats()["sqlite"]["pending"] == 0
+
+
+def test_failed_write_blocks_later_writes():
+    _configure()
+    apply_write = generic_storage.apply_write
+    calls = []
+
+    def flaky(backend, op, thread_ts, payload, logger=None):
+        if backend == "sqlite":
+            calls.append(op)
+        if backend == "sqlite" and len(calls) == 1:
+            raise RuntimeError("secondary down")
+        return apply_write(backend, op, thread_ts, payload, logger)
+
+    generic_storage.apply_write = flaky
+    try:
+        generic_storage.update_message("rep.2", "user", "first")
+        generic_storage.update_reaction("rep.2", "ok")
+        assert _replicator.drain("sqlite") == 0
+        stats = _replicator.stats()["sqlite"]
+        assert stats["pending"] == 2 and stats["head_attempts"] == 1
+        assert sqlite_storage.load_thread("rep.2") is None
+        _drain_all()
+    finally:
+        generic_storage.apply_write = apply_write
+    assert _messages("rep.2") == ["first"]
+    assert sqlite_storage.load_thread("rep.2")["reaction"] == "ok"
+
+
+def test_dead_letter_after_max_attempts():
+    _configure()
+    apply_write = generic_storage.apply_write
+
+    def broken(backend, op, thread_ts, payload, logger=None):
+        if backend == "sqlite" and thread_ts == "rep.3":
+            raise RuntimeError("rejected")
+        return apply_write(backend, op, thread_ts, payload, logger)
+
+    generic_storage.apply_write = broken
+    try:
+        generic_storage.update_message("rep.3", "user", "poison")
+        generic_storage.update_message("rep.4", "user", "fine")
+        for _ in range(replication.REPLICATION_MAX_ATTEMPTS):
+            _replicator.drain("sqlite")
+    finally:
+        generic_storage.apply_write = apply_write
+    stats = _replicator.stats()["sqlite"]
+    assert stats["dead_letters"] == 1 and stats["pending"] == 0
+    assert _messages("rep.4") == ["fine"]
+    assert sqlite_storage.load_thread("rep.3") is None
+
+    assert _replicator.requeue_dead_letters("sqlite") == 1
+    _drain_all()
+    assert _messages("rep.3") == ["poison"]
+    assert _replicator.stats()["sqlite"]["dead_letters"] == 0
+
+
+def test_lease_held_elsewhere():
+    _configure()
+    conn = _replicator._conn()
+    conn.execute("INSERT OR REPLACE INTO leases (backend, owner, expires_at) VALUES ('sqlite', 'other:1', ?)",
+                 (time.time() + 60,))
+    generic_storage.update_message("rep.5", "user", "waits")
+    assert _replicator.drain("sqlite") == 0
+    conn.execute("UPDATE leases SET expires_at = ? WHERE backend = 'sqlite'", (time.time() - 1,))
+    _drain_all()
+    assert _messages("rep.5") == ["waits"]
+    assert conn.execute("SELECT owner FROM leases WHERE backend = 'sqlite'").fetchone()[0] == _replicator.owner
+
+
+def test_drain_stops_when_lease_is_lost():
+    _configure()
+    apply_write = generic_storage.apply_write
+    conn = _replicator._conn()
+
+    def taken_over(backend, op, thread_ts, payload, logger=None):
+        result = apply_write(backend, op, thread_ts, payload, logger)
+        if backend == "sqlite":
+            conn.execute("UPDATE leases SET owner = 'other:1', expires_at = ? WHERE backend = 'sqlite'",
+                         (time.time() + 60,))
+        return result
+
+    generic_storage.update_message("rep.6", "user", "one")
+    generic_storage.update_message("rep.7", "user", "two")
+    generic_storage.apply_write = taken_over
+    try:
+        assert _replicator.drain("sqlite") == 1
+    finally:
+        generic_storage.apply_write = apply_write
+    assert _messages("rep.6") == ["one"]
+    assert sqlite_storage.load_thread("rep.7") is None
+    conn.execute("DELETE FROM leases WHERE backend = 'sqlite'")
+    _drain_all()
+    assert _messages("rep.7") == ["two"]
+
+
+def test_summary_index_replicates_what_the_primary_chose():
+    _configure()
+    # The secondary's copy is behind: it was added after the thread started
+    file_storage.append_messages("rep.8", [{"role": "user", "content": c} for c in "abc"])
+    sqlite_storage.append_messages("rep.8", [{"role": "user", "content": "a"}])
+    generic_storage.set_summary_index("rep.8")
+    _drain_all()
+    assert sqlite_storage.load_header("rep.8")["summary_index"] == 2
@@ -0,0 +1,131 @@
+# test_retention.py
+"""
+Behaviour checks for the retention sweeper: catalog-driven deletes,
+threads unknown to the catalog, and blob garbage collection. file_storage
+is the primary, in the session's temporary directory.
+"""
+import os
+from datetime import datetime, timedelta, timezone
+
+import blob_store
+import file_storage
+import generic_storage
+import retention
+import thread_catalog
+
+CHANNEL = "C-retention-test"
+LATER = datetime.now(timezone.utc) + timedelta(days=31)
+
+
+def _configure():
+    # Set on the modules, not the environment: other tests in the same run configure them too.
+    # Only this test's channel expires, so threads written by other tests are left alone.
+    generic_storage.STORAGE_BACKENDS = ["file_storage"]
+    generic_storage.STORAGE_PRIMARY = "file_storage"
+    generic_storage.SECONDARY_BACKENDS = []
+    retention.RETENTION_DAYS = 0
+    retention.RETENTION_REACTED_DAYS = None
+    retention.RETENTION_RULES = [{"channel": CHANNEL, "days": 30}]
+    blob_store.BLOB_GC_GRACE_SECONDS = 0
+
+
+def _output(text):
+    return f"RUN kubectl get pods\nCommand Output:\n{text * blob_store.BLOB_MIN_BYTES}\nReturn Code:\n0"
+
+
+def _digest(thread_ts):
+    content = generic_storage.read_messages_on("file_storage", thread_ts)[0]["content"]
+    return next(iter(blob_store.references(content)))
+
+
+def test_sweep_deletes_idle_threads_and_their_blobs():
+    _configure()
+    for thread_ts, text in (("ret.1", "a"), ("ret.2", "b"), ("ret.3", "b")):
+        generic_storage.update_message(thread_ts, "user", _output(text))
+        thread_catalog.record_metadata(thread_ts, channel=CHANNEL)
+    only_1, shared = _digest("ret.1"), _digest("ret.2")
+    # ret.3 is still in use a month later; ret.1 and ret.2 are not
+    thread_catalog._conn().execute("UPDATE threads SET last_activity = ? WHERE thread_ts = 'ret.3'",
+                                   ((LATER - timedelta(days=1)).isoformat(),))
+
+    assert retention.sweep(now=LATER, dry_run=True)["deleted"] == 2
+    assert generic_storage.thread_exists("ret.1")
+
+    result = retention.sweep(now=LATER)
+    assert result["deleted"] == 2 and result["blobs_collected"] >= 1
+    assert not generic_storage.thread_exists("ret.1") and not generic_storage.thread_exists("ret.2")
+    assert thread_catalog.get_thread("ret.1") is None
+    assert generic_storage.thread_exists("ret.3")
+    assert not blob_store.exists(only_1)
+    # Still referenced by ret.3
+    assert blob_store.exists(shared)
+
+
+def test_backfilled_thread_with_recent_activity_survives():
+    _configure()
+    now = datetime.now(timezone.utc)
+    # Started 60 days ago, before the catalog existed, and written to just now
+    created = now - timedelta(days=60)
+    file_storage.append_messages("ret.4", [{"role": "user", "content": "then"}])
+    file_storage.set_created_at("ret.4", created.isoformat())
+    for path in (file_storage._log_path("ret.4"), file_storage._meta_path("ret.4")):
+        os.utime(path, (created.timestamp(), created.timestamp()))
+    file_storage.append_messages("ret.4", [{"role": "user", "content": "now"}])
+    thread_catalog.backfill()
+    thread_catalog.record_metadata("ret.4", channel=CHANNEL)
+    row = thread_catalog.get_thread("ret.4")
+    assert row["created_at"] == created.isoformat() and row["last_activity"] >= (now - timedelta(minutes=1)).isoformat()
+    assert retention.sweep(now=now)["deleted"] == 0
+    assert generic_storage.thread_exists("ret.4")
+
+
+def test_blob_gc_spares_recent_blobs():
+    _configure()
+    reference = blob_store.put("x" * blob_store.BLOB_MIN_BYTES)
+    digest = next(iter(blob_store.references(reference)))
+    assert blob_store.collect_garbage(set(), grace_seconds=3600)["collected"] == 0
+    assert blob_store.exists(digest)
+    assert blob_store.collect_garbage(set(), grace_seconds=0, dry_run=True)["collected"] >= 1
+    assert blob_store.exists(digest)
+    blob_store.collect_garbage(set(), grace_seconds=0)
+    assert not blob_store.exists(digest)
+
+
+def test_untracked_threads_in_timestamped_backends():
+    _configure()
+    seen = {}
+
+    def inactive_thread_ids_on(backend, before):
+        seen[backend] = before
+        return iter(["known.1", "orphan.1", "orphan.2"])
+
+    deleted = []
+    thread_catalog.record_messages("known.1", 1)
+    backends = generic_storage.STORAGE_BACKENDS
+    inactive, delete_on = generic_storage.inactive_thread_ids_on, generic_storage.delete_threads_on
+    generic_storage.STORAGE_BACKENDS = ["file_storage", "elasticsearch_messages"]
+    generic_storage.inactive_thread_ids_on = inactive_thread_ids_on
+    generic_storage.delete_threads_on = lambda backend, ids, logger=None: deleted.append((backend, list(ids)))
+    retention.RETENTION_DAYS = 30
+    retention.RETENTION_RULES = [{"channel": "C1", "days": 90}]
+    try:
+        assert retention._sweep_untracked(LATER, dry_run=False) == 2
+    finally:
+        generic_storage.STORAGE_BACKENDS = backends
+        generic_storage.inactive_thread_ids_on, generic_storage.delete_threads_on = inactive, delete_on
+    # Only the secondary is asked, with the longest period any rule gives
+    assert list(seen) == ["elasticsearch_messages"]
+    assert seen["elasticsearch_messages"] == (LATER - timedelta(days=90)).isoformat()
+    assert deleted == [("elasticsearch_messages", ["orphan.1", "orphan.2"])]
+
+
+def test_longest_period():
+    _configure()
+    # Some threads (other channels) are kept forever
+    assert retention._longest_period() is None
+    retention.RETENTION_DAYS = 30
+    assert retention._longest_period() == 30
+    retention.RETENTION_RULES = [{"io_type": "slack", "reacted_days": 365}]
+    assert retention._longest_period() == 365
+    retention.RETENTION_RULES = [{"channel": "C1", "days": 0}]
+    assert retention._longest_period() is None
@@ -0,0 +1,91 @@
+# test_sqlite_storage.py
+"""
+Behaviour checks for the SQLite backend: the database runs in WAL mode,
+appends number messages consecutively, paged, tail and summary-aware reads
+return the right rows, every write bumps the thread's version, and appends
+from several threads at once neither lose nor renumber messages. The
+database is the session's temporary SQLITE_PATH.
+"""
+import threading
+
+import sqlite_storage
+
+
+def _append(thread_ts, *contents):
+    sqlite_storage.append_messages(thread_ts, [{"role": "user", "content": c} for c in contents])
+
+
+def _contents(messages):
+    return [m["content"] for m in messages]
+
+
+def test_database_is_in_wal_mode():
+    sqlite_storage.ensure_index_exists()
+    conn = sqlite_storage.get_connection()
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    assert conn.execute("PRAGMA busy_timeout").fetchone()[0] == sqlite_storage.SQLITE_BUSY_TIMEOUT_MS
+
+
+def test_appends_and_reads():
+    _append("sq.1", "a", "b")
+    _append("sq.1", "c")
+    _append("sq.1", "d", "e")
+    assert sqlite_storage.load_header("sq.1")["message_count"] == 5
+    assert _contents(sqlite_storage.read_messages("sq.1")) == ["a", "b", "c", "d", "e"]
+    assert _contents(sqlite_storage.read_messages("sq.1", after_seq=1, limit=2)) == ["c", "d"]
+    assert _contents(sqlite_storage.tail_messages("sq.1", 2)) == ["d", "e"]
+    assert _contents(sqlite_storage.load_thread("sq.1")["messages"]) == ["a", "b", "c", "d", "e"]
+    assert sqlite_storage.load_header("sq.missing") is None
+
+
+def test_summary_view(monkeypatch):
+    _append("sq.2", *"abcdef")
+    assert sqlite_storage.set_summary_index("sq.2", summary_index=4)
+    monkeypatch.setenv("SAVE_TOKEN_USE_SUMMARY", "true")
+    assert _contents(sqlite_storage.get_thread_messages("sq.2")) == ["a", "e", "f"]
+    # Without an index the whole thread is the context
+    assert sqlite_storage.set_summary_index("sq.2")
+    assert sqlite_storage.load_header("sq.2")["summary_index"] == 5
+    monkeypatch.setenv("SAVE_TOKEN_USE_SUMMARY", "false")
+    assert _contents(sqlite_storage.get_thread_messages("sq.2")) == list("abcdef")
+    assert sqlite_storage.set_summary_index("sq.missing") is False
+
+
+def test_every_write_bumps_the_version():
+    _append("sq.3", "a")
+    versions = [sqlite_storage.thread_version("sq.3")]
+    _append("sq.3", "b")
+    versions.append(sqlite_storage.thread_version("sq.3"))
+    sqlite_storage.set_summary_index("sq.3")
+    versions.append(sqlite_storage.thread_version("sq.3"))
+    sqlite_storage.update_reaction("sq.3", "+1")
+    versions.append(sqlite_storage.thread_version("sq.3"))
+    assert versions == sorted(set(versions))
+    assert sqlite_storage.thread_version("sq.missing") is None
+
+
+def test_concurrent_appends_keep_every_message():
+    writers, batches = 8, 20
+
+    def writer(n):
+        for b in range(batches):
+            _append("sq.4", f"{n}-{b}-x", f"{n}-{b}-y")
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(30)
+    contents = _contents(sqlite_storage.read_messages("sq.4"))
+    assert sqlite_storage.load_header("sq.4")["message_count"] == len(contents) == writers * batches * 2
+    assert len(set(contents)) == len(contents)
+    # A batch is written in one transaction, so its messages stay next to each other
+    for i in range(0, len(contents), 2):
+        assert contents[i].endswith("-x") and contents[i + 1] == contents[i][:-1] + "y"
+
+
+def test_delete_threads():
+    _append("sq.5", "a")
+    _append("sq.6", "b")
+    assert sqlite_storage.delete_threads(["sq.5", "sq.6", "sq.missing"]) == 2
+    assert sqlite_storage.read_messages("sq.5") == [] and sqlite_storage.load_header("sq.6") is None
@@ -0,0 +1,98 @@
+# test_storage_migrate.py
+"""
+Behaviour checks for storage_migrate: round trips between file_storage,
+an export file and sqlite, resuming a half-copied thread, and bulk
+request failures. Everything goes to temporary directories and no
+Elasticsearch is needed.
+"""
+import pytest
+
+import file_storage
+import sqlite_storage
+import storage_migrate
+import thread_catalog
+
+CREATED_AT = "2024-01-02T03:04:05+00:00"
+
+
+def _make_thread(thread_ts, count, compact=False):
+    file_storage.append_messages(thread_ts, [{"role": "user", "content": f"{thread_ts} m{i}"} for i in range(count)])
+    file_storage.set_created_at(thread_ts, CREATED_AT)
+    file_storage.set_summary_index(thread_ts, summary_index=count - 2)
+    file_storage.update_reaction(thread_ts, "thumbsup")
+    if compact:
+        file_storage.compact_thread(thread_ts, min_messages=1)
+
+
+def _snapshot(load, thread_ts):
+    doc = load(thread_ts)
+    return {field: doc.get(field) for field in ("created_at", "summary_index", "reaction", "messages")}
+
+
+def _migrate(source, target, checkpoint, **kwargs):
+    return storage_migrate.migrate(source, target, workers=1, batch_size=7, checkpoint_path=str(checkpoint), **kwargs)
+
+
+def test_file_storage_to_sqlite(tmp_path):
+    _make_thread("mig.1", 30, compact=True)
+    _make_thread("mig.2", 3)
+    summary = _migrate("file_storage", "sqlite", tmp_path / "checkpoint", thread_ids=["mig.1", "mig.2"])
+    assert summary["threads"] == 2 and summary["failed"] == 0 and summary["messages"] == 33
+    for thread_ts in ("mig.1", "mig.2"):
+        assert _snapshot(sqlite_storage.load_thread, thread_ts) == _snapshot(file_storage.load_thread, thread_ts)
+    assert sqlite_storage.load_header("mig.1")["created_at"] == CREATED_AT
+    row = thread_catalog.get_thread("mig.1")
+    assert row["message_count"] == 30 and row["created_at"] == CREATED_AT and row["reaction"] == "thumbsup"
+    # Last activity is the source's last write, not its creation
+    assert row["last_activity"] == file_storage.load_header("mig.1")["updated_at"] > CREATED_AT
+    # A second run skips the checkpointed threads
+    assert _migrate("file_storage", "sqlite", tmp_path / "checkpoint", thread_ids=["mig.1", "mig.2"])["threads"] == 0
+
+
+def test_export_round_trip(tmp_path):
+    _make_thread("mig.3", 12)
+    before = _snapshot(file_storage.load_thread, "mig.3")
+    export = f"jsonl:{tmp_path / 'threads.jsonl.gz'}"
+    _migrate("file_storage", export, tmp_path / "export.checkpoint", thread_ids=["mig.3"])
+    file_storage.delete_thread("mig.3")
+    assert file_storage.load_thread("mig.3") is None
+    _migrate(export, "file_storage", tmp_path / "import.checkpoint", thread_ids=["mig.3"])
+    assert _snapshot(file_storage.load_thread, "mig.3") == before
+
+
+def test_resume_after_partial_copy(tmp_path):
+    _make_thread("mig.4", 10)
+    # An earlier run stopped after the first page
+    sqlite_storage.append_messages("mig.4", file_storage.read_messages("mig.4", limit=4))
+    summary = _migrate("file_storage", "sqlite", tmp_path / "checkpoint", thread_ids=["mig.4"])
+    assert summary["messages"] == 6
+    assert _snapshot(sqlite_storage.load_thread, "mig.4") == _snapshot(file_storage.load_thread, "mig.4")
+
+
+def test_bulk_errors_keep_threads_out_of_the_checkpoint():
+    calls = []
+
+    def bulk(es, actions, **kwargs):
+        calls.append(list(actions))
+        if len(calls) == 1:
+            raise ConnectionError("cluster unavailable")
+        errors = [{"index": {"_id": a["_id"], "status": 400, "error": "mapper_parsing_exception"}}
+                  for a in actions if a["_id"] == "bad"]
+        return len(actions) - len(errors), errors
+
+    bulk_before, client_before = storage_migrate.helpers.bulk, storage_migrate.elastic.get_es_client
+    storage_migrate.helpers.bulk = bulk
+    storage_migrate.elastic.get_es_client = lambda: None
+    try:
+        writer = storage_migrate._BulkWriter("elasticsearch", batch_size=2)
+        writer._add("good", {"_id": "good"}, 0)
+        writer.finish("good", {})
+        with pytest.raises(ConnectionError):
+            writer._add("bad", {"_id": "bad"}, 0)
+        writer.finish("bad", {})
+        # Nothing was lost: the failed request is sent again with the next one
+        assert writer.flush() == ["good"]
+        assert [a["_id"] for a in calls[1]] == ["good", "bad"]
+        assert writer.failed() == ["bad"] and writer.errors == 1
+    finally:
+        storage_migrate.helpers.bulk, storage_migrate.elastic.get_es_client = bulk_before, client_before
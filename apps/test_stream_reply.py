@@ -0,0 +1,90 @@
+# test_stream_reply.py
+"""
+Behaviour checks for streamed replies: edits of the placeholder are
+throttled to one per STREAM_UPDATE_INTERVAL, the final text always lands,
+and replies that can't be streamed fall back to a single send_response.
+Slack and the LLM are stubbed, and time runs on a fake clock.
+"""
+import types
+
+import pytest
+
+import slack
+import stream_reply
+
+
+class _Log:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """Stubbed Slack: records the placeholder post and every edit, on a fake clock."""
+    calls = {"posted": [], "updates": [], "sent": [], "clock": _Clock()}
+
+    def post(channel, text, thread_ts=None):
+        calls["posted"].append(text)
+        return "msg.1"
+
+    monkeypatch.setattr(slack, "post_message_to_slack", post)
+    monkeypatch.setattr(slack, "update_slack_message", lambda channel, ts, text: calls["updates"].append(text))
+    monkeypatch.setattr(stream_reply, "send_response",
+                        lambda payload, ts, text, logger: calls["sent"].append(text))
+    monkeypatch.setattr(stream_reply, "time", types.SimpleNamespace(monotonic=calls["clock"].monotonic))
+    monkeypatch.setattr(stream_reply, "STREAM_RESPONSES", True)
+    monkeypatch.setattr(stream_reply, "STREAM_UPDATE_INTERVAL", 1.5)
+    return calls
+
+
+PAYLOAD = {"IO_type": "slack", "channel": "C1"}
+
+
+def test_updates_are_throttled(chat):
+    clock = chat["clock"]
+    reply = stream_reply.StreamingReply(PAYLOAD, "s.1", _Log())
+    assert reply.start()
+    for offset, text in ((0.5, "a"), (1.6, "ab"), (2.0, "abc"), (3.0, "abcd"), (3.2, "abcde")):
+        clock.now = 100.0 + offset
+        reply.update(text)
+    # One edit per interval, measured from the last one
+    assert chat["updates"] == ["NAUT ab …", "NAUT abcde …"]
+    reply.finish("abcdef")
+    assert chat["updates"][-1] == "NAUT abcdef"
+
+
+def test_llm_reply_streams_into_one_message(chat, monkeypatch):
+    def llm(thread_ts, max_tokens, temperature, logger=None, messages=None, on_delta=None):
+        for text in ("Sync", "Synced and", "Synced and Healthy"):
+            chat["clock"].now += 2
+            on_delta(text)
+        return "Synced and Healthy"
+
+    monkeypatch.setattr(stream_reply, "get_llm_response", llm)
+    response = stream_reply.llm_reply(PAYLOAD, "s.2", _Log(), 100, 0.0, suffix=" (auto)")
+    assert response == "Synced and Healthy"
+    assert chat["posted"] == [stream_reply.STREAM_PLACEHOLDER] and chat["sent"] == []
+    assert chat["updates"] == ["NAUT Sync …", "NAUT Synced and …", "NAUT Synced and Healthy …",
+                               "NAUT Synced and Healthy (auto)"]
+
+
+@pytest.mark.parametrize("payload", [{"IO_type": "n8n", "channel": "C1"}, {"IO_type": "slack"}])
+def test_falls_back_to_one_message(chat, monkeypatch, payload):
+    monkeypatch.setattr(stream_reply, "get_llm_response", lambda *args, **kwargs: "done")
+    assert stream_reply.llm_reply(payload, "s.3", _Log(), 100, 0.0) == "done"
+    assert chat["sent"] == ["NAUT done"] and chat["updates"] == []
+
+
+def test_falls_back_when_the_placeholder_fails(chat, monkeypatch):
+    monkeypatch.setattr(slack, "post_message_to_slack", lambda channel, text, thread_ts=None: None)
+    monkeypatch.setattr(stream_reply, "get_llm_response", lambda *args, **kwargs: "done")
+    stream_reply.llm_reply(PAYLOAD, "s.4", _Log(), 100, 0.0)
+    assert chat["sent"] == ["NAUT done"]
@@ -0,0 +1,45 @@
+# test_thread_catalog.py
+"""
+Behaviour checks for the thread catalog backfill. file_storage is the
+primary, in the session's temporary directory.
+"""
+import file_storage
+import thread_catalog
+
+
+def _forget_backfill():
+    thread_catalog._conn().execute("DELETE FROM catalog_meta")
+
+
+def test_backfill_merges_with_live_rows():
+    _forget_backfill()
+    # Stored before the catalog existed: straight to the backend
+    file_storage.append_messages("cat.1", [{"role": "user", "content": str(i)} for i in range(5)])
+    file_storage.update_reaction("cat.1", "thumbsup")
+    file_storage.append_messages("cat.2", [{"role": "user", "content": "x"}])
+    # A live write after the upgrade creates a row that only counts itself
+    thread_catalog.record_messages("cat.1", 1)
+    file_storage.append_messages("cat.1", [{"role": "user", "content": "5"}])
+    assert thread_catalog.get_thread("cat.1")["message_count"] == 1
+    assert thread_catalog.backfill_completed_at() is None
+
+    assert thread_catalog.backfill() >= 2
+    row = thread_catalog.get_thread("cat.1")
+    assert row["message_count"] == 6
+    assert row["reaction"] == "thumbsup"
+    assert thread_catalog.get_thread("cat.2")["message_count"] == 1
+    assert thread_catalog.backfill_completed_at() is not None
+
+    # A second pass changes nothing
+    thread_catalog.backfill()
+    assert thread_catalog.get_thread("cat.1")["message_count"] == 6
+
+
+def test_backfill_if_needed_runs_once():
+    _forget_backfill()
+    file_storage.append_messages("cat.3", [{"role": "user", "content": "early"}])
+    thread_catalog.backfill_if_needed()
+    assert thread_catalog.get_thread("cat.3")["message_count"] == 1
+    file_storage.append_messages("cat.4", [{"role": "user", "content": "late"}])
+    thread_catalog.backfill_if_needed()
+    assert thread_catalog.get_thread("cat.4") is None
@@ -0,0 +1,168 @@
+# thread_cache.py
+"""
+In-process LRU cache of whole thread documents.
+
+generic_storage serves thread reads from here and updates cached entries
+write-through when it writes. The cache is bounded by the approximate size
+of the cached messages (THREAD_CACHE_MAX_BYTES, 0 = disabled) and evicts
+least recently used threads first.
+
+Each entry remembers the primary backend's version of the thread (file
+size/mtime, Elasticsearch seq_no) from when it was loaded. With
+THREAD_CACHE_VALIDATE=true, the default, a hit is only served after that
+version is re-checked, so writes from other workers or replicas are never
+hidden; that check is far cheaper than re-reading the thread.
+THREAD_CACHE_TTL (seconds, 0 = no expiry) bounds staleness when validation
+is turned off.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+
+THREAD_CACHE_MAX_BYTES = int(os.getenv("THREAD_CACHE_MAX_BYTES", 32 * 1024 * 1024))
+THREAD_CACHE_TTL = float(os.getenv("THREAD_CACHE_TTL", 0))
+THREAD_CACHE_VALIDATE = os.getenv("THREAD_CACHE_VALIDATE", "true").lower() == "true"
+
+_MISSING = object()
+
+# Rough per-message overhead on top of the content length (dict, role, ...)
+_MESSAGE_OVERHEAD = 64
+
+
+def _message_size(message):
+    if message is None:
+        # Placeholder for a compacted message in a hot-only document
+        return _MESSAGE_OVERHEAD
+    content = message.get("content", "")
+    return _MESSAGE_OVERHEAD + len(content if isinstance(content, str) else str(content))
+
+
+class _Entry:
+    __slots__ = ("doc", "size", "version", "loaded_at")
+
+    def __init__(self, doc, version):
+        self.doc = doc
+        self.size = sum(_message_size(m) for m in doc.get("messages", [])) + _MESSAGE_OVERHEAD
+        self.version = version
+        self.loaded_at = time.monotonic()
+
+
+def _copy(doc):
+    """Shallow copy that callers may modify without touching the cached doc."""
+    return {**doc, "messages": list(doc.get("messages", []))}
+
+
+class ThreadCache:
+    """Byte-bounded LRU of thread documents keyed by thread_ts."""
+
+    def __init__(self, max_bytes=THREAD_CACHE_MAX_BYTES, ttl=THREAD_CACHE_TTL):
+        self.max_bytes = int(max_bytes)
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0, "invalidations": 0}
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def __contains__(self, thread_ts):
+        with self._lock:
+            return thread_ts in self._entries
+
+    def _drop(self, thread_ts):
+        entry = self._entries.pop(thread_ts, None)
+        if entry is not None:
+            self._bytes -= entry.size
+        return entry
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            _, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+            self._counters["evictions"] += 1
+
+    def version(self, thread_ts):
+        """Backend version the cached entry was last synced at (_MISSING when not cached)."""
+        with self._lock:
+            entry = self._entries.get(thread_ts)
+            return entry.version if entry is not None else _MISSING
+
+    def get(self, thread_ts, validate=False, current_version=None):
+        """
+        Return a copy of the cached doc, or None on a miss. With validate=True
+        the entry only counts as a hit if its version equals current_version.
+        """
+        with self._lock:
+            entry = self._entries.get(thread_ts)
+            if entry is not None and self.ttl and time.monotonic() - entry.loaded_at > self.ttl:
+                self._drop(thread_ts)
+                entry = None
+            if entry is not None and validate and entry.version != current_version:
+                self._drop(thread_ts)
+                self._counters["stale"] += 1
+                entry = None
+            if entry is None:
+                self._counters["misses"] += 1
+                return None
+            self._entries.move_to_end(thread_ts)
+            self._counters["hits"] += 1
+            return _copy(entry.doc)
+
+    def put(self, thread_ts, doc, version=None):
+        with self._lock:
+            self._drop(thread_ts)
+            entry = _Entry(_copy(doc), version)
+            if entry.size > self.max_bytes:
+                return
+            self._entries[thread_ts] = entry
+            self._bytes += entry.size
+            self._evict()
+
+    def update(self, thread_ts, mutate, version=None):
+        """Apply mutate(doc) to a cached entry (write-through); no-op when not cached."""
+        with self._lock:
+            entry = self._entries.get(thread_ts)
+            if entry is None:
+                return
+            mutate(entry.doc)
+            self._bytes -= entry.size
+            entry.size = sum(_message_size(m) for m in entry.doc.get("messages", [])) + _MESSAGE_OVERHEAD
+            entry.version = version
+            self._bytes += entry.size
+            self._entries.move_to_end(thread_ts)
+            self._evict()
+
+    def invalidate(self, thread_ts=None):
+        """Drop one thread, or everything when thread_ts is None."""
+        with self._lock:
+            if thread_ts is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                count = 1 if self._drop(thread_ts) is not None else 0
+            self._counters["invalidations"] += count
+            return count
+
+    def stats(self):
+        with self._lock:
+            lookups = self._counters["hits"] + self._counters["misses"]
+            return {
+                "enabled": self.enabled,
+                "validate": THREAD_CACHE_VALIDATE,
+                "threads": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_rate": round(self._counters["hits"] / lookups, 3) if lookups else None,
+                **self._counters,
+            }
+
+
+_cache = ThreadCache()
+
+
+def get_thread_cache():
+    return _cache
@@ -0,0 +1,282 @@
+# thread_catalog.py
+"""
+Thread catalog: one indexed row of metadata per thread.
+
+Stores created_at, last_activity, message_count, channel, user, IO_type and
+reaction in a small SQLite database (THREAD_CATALOG_PATH, by default on the
+persistent volume at DATA_DIR, WAL mode, shared by all workers). generic_storage updates it on every append and
+reaction change, and process_event records where a thread came from, so
+GET /threads can page, sort and filter without touching thread storage.
+
+Threads stored before the catalog existed are added by backfill(), which
+reads only each thread's header from the primary backend; last_activity
+comes from the backend's updated_at (for file_storage, the mtime of the
+thread's files), or is the backfill time when the backend has none. It runs at
+startup until one pass has completed (recorded in the catalog's meta
+table, so a pass interrupted by a restart is resumed next time), or on
+demand with `python thread_catalog.py backfill`. Backfilled rows are
+merged into rows that live writes created meanwhile: counts and
+last_activity take the larger value, created_at the earlier one.
+"""
+import os
+import json
+import base64
+import sqlite3
+import threading
+import logging
+from datetime import datetime, timezone
+
+from data_dir import DATA_DIR
+
+THREAD_CATALOG_PATH = os.getenv("THREAD_CATALOG_PATH", os.path.join(DATA_DIR, "thread_catalog.db"))
+THREAD_CATALOG_PAGE_SIZE = int(os.getenv("THREAD_CATALOG_PAGE_SIZE", 50))
+THREAD_CATALOG_MAX_PAGE_SIZE = int(os.getenv("THREAD_CATALOG_MAX_PAGE_SIZE", 500))
+
+SORT_FIELDS = ("last_activity", "created_at", "message_count", "thread_ts")
+FILTER_FIELDS = ("channel", "user", "io_type", "reaction")
+COLUMNS = ("thread_ts", "created_at", "last_activity", "message_count", "channel", "user", "io_type", "reaction")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS threads (
+    thread_ts TEXT PRIMARY KEY,
+    created_at TEXT NOT NULL,
+    last_activity TEXT NOT NULL,
+    message_count INTEGER NOT NULL DEFAULT 0,
+    channel TEXT,
+    user TEXT,
+    io_type TEXT,
+    reaction TEXT
+);
+CREATE INDEX IF NOT EXISTS threads_last_activity ON threads (last_activity, thread_ts);
+CREATE INDEX IF NOT EXISTS threads_created_at ON threads (created_at, thread_ts);
+CREATE INDEX IF NOT EXISTS threads_message_count ON threads (message_count, thread_ts);
+CREATE INDEX IF NOT EXISTS threads_channel ON threads (channel, last_activity);
+CREATE INDEX IF NOT EXISTS threads_user ON threads (user, last_activity);
+CREATE INDEX IF NOT EXISTS threads_io_type ON threads (io_type, last_activity);
+CREATE TABLE IF NOT EXISTS catalog_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+_RECORD_MESSAGES_SQL = """
+INSERT INTO threads (thread_ts, created_at, last_activity, message_count) VALUES (?, ?, ?, ?)
+ON CONFLICT (thread_ts) DO UPDATE SET
+    message_count = message_count + excluded.message_count,
+    last_activity = excluded.last_activity
+"""
+_RECORD_METADATA_SQL = """
+INSERT INTO threads (thread_ts, created_at, last_activity, channel, user, io_type) VALUES (?, ?, ?, ?, ?, ?)
+ON CONFLICT (thread_ts) DO UPDATE SET
+    channel = COALESCE(excluded.channel, channel),
+    user = COALESCE(excluded.user, user),
+    io_type = COALESCE(excluded.io_type, io_type)
+"""
+_RECORD_REACTION_SQL = "UPDATE threads SET reaction = ?, last_activity = ? WHERE thread_ts = ?"
+_DELETE_SQL = "DELETE FROM threads WHERE thread_ts = ?"
+_BACKFILL_SQL = """
+INSERT INTO threads (thread_ts, created_at, last_activity, message_count, reaction) VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (thread_ts) DO UPDATE SET
+    created_at = MIN(created_at, excluded.created_at),
+    last_activity = MAX(last_activity, excluded.last_activity),
+    message_count = MAX(message_count, excluded.message_count),
+    reaction = COALESCE(reaction, excluded.reaction)
+"""
+_SET_META_SQL = "INSERT INTO catalog_meta (key, value) VALUES (?, ?) ON CONFLICT (key) DO UPDATE SET value = excluded.value"
+_BACKFILL_DONE_KEY = "backfill_completed_at"
+
+_local = threading.local()
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+def _conn():
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+    directory = os.path.dirname(THREAD_CATALOG_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(THREAD_CATALOG_PATH, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    with _schema_lock:
+        if not _schema_ready:
+            conn.executescript(_SCHEMA)
+            _schema_ready = True
+    _local.conn = conn
+    _local.pid = os.getpid()
+    return conn
+
+
+def record_messages(thread_ts, count, logger=None):
+    """Count new messages and bump last_activity; creates the row for a new thread."""
+    now = _now()
+    try:
+        _conn().execute(_RECORD_MESSAGES_SQL, (thread_ts, now, now, count))
+    except sqlite3.Error as e:
+        # The catalog is an index; a failed update must never fail the write itself
+        if logger:
+            logger.warning(f"Thread catalog update failed for {thread_ts}: {e}")
+
+
+def record_metadata(thread_ts, channel=None, user=None, io_type=None, logger=None):
+    """Remember where a thread came from. None leaves a stored value unchanged."""
+    now = _now()
+    try:
+        _conn().execute(_RECORD_METADATA_SQL, (thread_ts, now, now, channel, user, io_type))
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"Thread catalog update failed for {thread_ts}: {e}")
+
+
+def record_reaction(thread_ts, reaction, logger=None):
+    try:
+        _conn().execute(_RECORD_REACTION_SQL, (reaction, _now(), thread_ts))
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"Thread catalog update failed for {thread_ts}: {e}")
+
+
+def delete_threads(thread_ids, logger=None):
+    try:
+        _conn().executemany(_DELETE_SQL, [(thread_ts,) for thread_ts in thread_ids])
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"Thread catalog delete failed: {e}")
+
+
+def _encode_cursor(row, sort):
+    return base64.urlsafe_b64encode(json.dumps([row[sort], row["thread_ts"]]).encode()).decode()
+
+
+def _decode_cursor(cursor):
+    try:
+        value, thread_ts = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, thread_ts
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+def list_threads(sort="last_activity", order="desc", limit=None, cursor=None,
+                 active_since=None, active_before=None, **filters):
+    """
+    One page of catalog rows. Pages are keyset-paginated on (sort, thread_ts)
+    so deep pages cost the same as the first. Returns (rows, next_cursor).
+    """
+    if sort not in SORT_FIELDS:
+        raise ValueError(f"sort must be one of {', '.join(SORT_FIELDS)}")
+    if order not in ("asc", "desc"):
+        raise ValueError("order must be asc or desc")
+    limit = min(int(limit or THREAD_CATALOG_PAGE_SIZE), THREAD_CATALOG_MAX_PAGE_SIZE)
+    if limit <= 0:
+        raise ValueError("limit must be positive")
+
+    where, params = [], []
+    for field in FILTER_FIELDS:
+        if filters.get(field) is not None:
+            where.append(f"{field} = ?")
+            params.append(filters[field])
+    if active_since:
+        where.append("last_activity >= ?")
+        params.append(active_since)
+    if active_before:
+        where.append("last_activity < ?")
+        params.append(active_before)
+    if cursor:
+        value, thread_ts = _decode_cursor(cursor)
+        op = "<" if order == "desc" else ">"
+        if sort == "thread_ts":
+            where.append(f"thread_ts {op} ?")
+            params.append(thread_ts)
+        else:
+            where.append(f"({sort}, thread_ts) {op} (?, ?)")
+            params.extend([value, thread_ts])
+
+    direction = order.upper()
+    sql = f"SELECT {', '.join(COLUMNS)} FROM threads"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    order_by = "thread_ts" if sort == "thread_ts" else f"{sort} {direction}, thread_ts"
+    sql += f" ORDER BY {order_by} {direction} LIMIT ?"
+    params.append(limit + 1)
+
+    rows = [dict(zip(COLUMNS, r)) for r in _conn().execute(sql, params)]
+    next_cursor = _encode_cursor(rows[limit - 1], sort) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+
+def get_thread(thread_ts):
+    """The catalog row for one thread, or None."""
+    row = _conn().execute(f"SELECT {', '.join(COLUMNS)} FROM threads WHERE thread_ts = ?", (thread_ts,)).fetchone()
+    return dict(zip(COLUMNS, row)) if row else None
+
+
+def count_threads():
+    return _conn().execute("SELECT COUNT(*) FROM threads").fetchone()[0]
+
+
+def record_thread(thread_ts, created_at, last_activity, message_count, reaction=None, logger=None):
+    """Merge a whole thread's header into its row, as backfill() does (used by storage_migrate)."""
+    try:
+        _conn().execute(_BACKFILL_SQL, (thread_ts, created_at, last_activity, message_count, reaction))
+    except sqlite3.Error as e:
+        if logger:
+            logger.warning(f"Thread catalog update failed for {thread_ts}: {e}")
+
+
+def backfill_completed_at():
+    """When a backfill pass last ran to the end, or None."""
+    row = _conn().execute("SELECT value FROM catalog_meta WHERE key = ?", (_BACKFILL_DONE_KEY,)).fetchone()
+    return row[0] if row else None
+
+
+def backfill(logger=None):
+    """Merge the header of every thread in the primary backend into the catalog. Returns how many were read."""
+    import generic_storage
+
+    seen = 0
+    conn = _conn()
+    for thread_ts in generic_storage.list_thread_ids(logger):
+        header = generic_storage.load_header_on(generic_storage.STORAGE_PRIMARY, thread_ts)
+        if header is None:
+            continue
+        # Without a last write time the thread counts as active now: created_at would make live threads expire
+        last_activity = header.get("updated_at") or _now()
+        created_at = header.get("created_at") or last_activity
+        conn.execute(_BACKFILL_SQL, (thread_ts, created_at, last_activity,
+                                     header.get("message_count", 0), header.get("reaction")))
+        seen += 1
+    conn.execute(_SET_META_SQL, (_BACKFILL_DONE_KEY, _now()))
+    if logger:
+        logger.info(f"Thread catalog backfill merged {seen} thread(s).")
+    return seen
+
+
+def backfill_if_needed(logger=None):
+    """Run backfill() unless a pass has already completed against this catalog."""
+    if backfill_completed_at() is None:
+        backfill(logger)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Thread catalog tools")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("backfill", help="add threads from the primary storage backend")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("ThreadCatalog")
+    if args.command == "backfill":
+        backfill(logger)
+
+
+if __name__ == "__main__":
+    main()